@@ -0,0 +1,335 @@
+/*=========================================================================
+
+  Program:   Slicer4
+  Language:  C++
+  Module:    CMFregCommon
+
+  Copyright (c) Neuro Image Research and Analysis Lab, UNC-Chapel Hill All Rights Reserved.
+
+  See License.txt or http://www.slicer.org/copyright/copyright.txt for details.
+
+==========================================================================*/
+#include "CMFregCommon.h"
+
+#include <algorithm>
+#include <cstdlib>
+#include <cstring>
+#include <iostream>
+#include <map>
+#include <mutex>
+#include <sstream>
+#include <thread>
+
+#include <itksys/Process.h>
+#include <itksys/SystemInformation.hxx>
+#include <itksys/SystemTools.hxx>
+
+#include <vtkSlicerConfigure.h>
+
+#include "ModuleProcessInformation.h"
+
+#include "itkImageIOBase.h"
+#include "itkImageIOFactory.h"
+#include "itkMacro.h"
+
+namespace CMFreg
+{
+
+namespace
+{
+
+const char * const ProgressTag = "<filter-progress>";
+
+// State of one running job, shared with the thread waiting for it
+struct Job
+{
+	itksysProcess* process;
+	std::string name;
+	std::string output;
+	double progress;
+};
+
+class JobGroup
+{
+public:
+	JobGroup(ModuleProcessInformation * processInformation)
+		: ProcessInformation(processInformation), Aborted(false)
+	{
+	}
+
+	void Wait(Job * job);
+
+	std::vector<Job> Jobs;
+
+private:
+	void HandleOutput(Job * job, const char * data, int length);
+	void ReportProgress(const Job * job);
+
+	ModuleProcessInformation * ProcessInformation;
+	bool Aborted;
+	std::mutex Mutex;
+};
+
+// Wait for the data of the job. The wait only wakes up periodically when the
+// module can be cancelled, to check the abort flag.
+void JobGroup::Wait(Job * job)
+{
+	for(;;)
+	{
+		char* data = NULL;
+		int length = 0;
+		double timeout = 0.2;
+		int pipe = itksysProcess_WaitForData(job->process, &data, &length, this->ProcessInformation ? &timeout : NULL);
+		if (pipe == itksysProcess_Pipe_None)
+		{
+			break;
+		}
+		std::lock_guard<std::mutex> lock(this->Mutex);
+		if (this->ProcessInformation && this->ProcessInformation->Abort)
+		{
+			this->Aborted = true;
+		}
+		if (this->Aborted)
+		{
+			itksysProcess_Kill(job->process);
+			continue;
+		}
+		if (pipe == itksysProcess_Pipe_STDOUT)
+		{
+			this->HandleOutput(job, data, length);
+		}
+		else if (pipe == itksysProcess_Pipe_STDERR)
+		{
+			std::cerr.write(data, length);
+		}
+	}
+	itksysProcess_WaitForExit(job->process, NULL);
+}
+
+// Forward the complete lines of the standard output of the job: its progress
+// is reported, the other filter tags are dropped and the rest is printed.
+void JobGroup::HandleOutput(Job * job, const char * data, int length)
+{
+	job->output.append(data, length);
+	std::string::size_type lineEnd;
+	while((lineEnd = job->output.find('\n')) != std::string::npos)
+	{
+		std::string line = job->output.substr(0, lineEnd);
+		job->output.erase(0, lineEnd + 1);
+		std::string::size_type tag = line.find(ProgressTag);
+		if (tag != std::string::npos)
+		{
+			job->progress = atof(line.c_str() + tag + strlen(ProgressTag));
+			this->ReportProgress(job);
+		}
+		else if (line.find("<filter-") == std::string::npos)
+		{
+			std::cout << line << std::endl;
+		}
+	}
+}
+
+void JobGroup::ReportProgress(const Job * job)
+{
+	double progress = 0.0;
+	for(unsigned int i=0;i<this->Jobs.size();i++)
+	{
+		progress += this->Jobs[i].progress / this->Jobs.size();
+	}
+	if (this->ProcessInformation)
+	{
+		this->ProcessInformation->Progress = progress;
+		strncpy(this->ProcessInformation->ProgressMessage, job->name.c_str(),
+			sizeof(this->ProcessInformation->ProgressMessage) - 1);
+		if (this->ProcessInformation->ProgressCallbackFunc && this->ProcessInformation->ProgressCallbackClientData)
+		{
+			(*(this->ProcessInformation->ProgressCallbackFunc))(this->ProcessInformation->ProgressCallbackClientData);
+		}
+	}
+	else
+	{
+		std::cout << ProgressTag << progress << "</filter-progress>" << std::endl;
+	}
+}
+
+// Exit value of the finished process, 1 if it did not exit, and delete it
+int Finish(itksysProcess* gp, const std::string & name)
+{
+	int result = 1;
+	switch(itksysProcess_GetState(gp))
+	{
+		case itksysProcess_State_Exited:
+		{
+			result = itksysProcess_GetExitValue(gp);
+		} break;
+		case itksysProcess_State_Error:
+		{
+			std::cerr<<"Error: Could not run " << name<<":\n";
+			std::cerr<<itksysProcess_GetErrorString(gp)<<"\n";
+			std::cout<<"Error: Could not run " << name<<":\n";
+			std::cout<<itksysProcess_GetErrorString(gp)<<"\n";
+		} break;
+		case itksysProcess_State_Exception:
+		{
+			std::cerr<<"Error: "<<name<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
+			std::cout<<"Error: "<<name<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
+		} break;
+		case itksysProcess_State_Expired:
+		{
+			std::cerr<<"Error: "<<name<<" timed out"<<std::endl;
+			std::cout<<"Error: "<<name<<" timed out"<<std::endl;
+		} break;
+		case itksysProcess_State_Killed:
+		{
+			std::cerr<<name<<" was cancelled"<<std::endl;
+			std::cout<<name<<" was cancelled"<<std::endl;
+		} break;
+		case itksysProcess_State_Starting:
+		case itksysProcess_State_Executing:
+		{
+		// Should not get here.
+		std::cerr<<"Unexpected ending state after running "<<name<<std::endl;
+		std::cout<<"Unexpected ending state after running "<<name<<std::endl;
+		} break;
+	}
+	itksysProcess_Delete(gp);
+	return result;
+}
+
+}
+
+std::string FindTool(const std::string & name)
+{
+	static std::map<std::string, std::string> toolPaths;
+	std::map<std::string, std::string>::const_iterator found = toolPaths.find(name);
+	if (found != toolPaths.end())
+	{
+		return found->second;
+	}
+
+	std::vector<std::string> userPaths;
+#if defined(__APPLE__)
+	// on Mac, slicer does not provide a PATH variable that includes the built-in CLIs
+	// so we add it here.
+	std::string slicerHome;
+	if (itksys::SystemTools::GetEnv("SLICER_HOME", slicerHome))
+	{
+		// Slicer_CLIMODULES_BIN_DIR is defined in vtkSlicerConfigure.h which is configured in the inner-build
+		// directory of Slicer
+		userPaths.push_back( slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR  ) ;
+		std::cout<<"Additional Paths: " << slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR << std::endl ;
+	}
+#endif
+	std::string path = itksys::SystemTools::FindProgram(name.c_str(), userPaths);
+	std::cout << "Path to " << name << " executable: " << path << std::endl;
+	toolPaths[name] = path;
+	return path;
+}
+
+int Run(std::vector<const char*> args, ModuleProcessInformation * processInformation, double timeout)
+{
+	std::vector< std::vector<const char*> > jobs(1, args);
+	std::vector<std::string> names(1, args[0]);
+	return RunConcurrently(jobs, names, processInformation, timeout);
+}
+
+int RunConcurrently(const std::vector< std::vector<const char*> > & jobs, const std::vector<std::string> & names,
+	ModuleProcessInformation * processInformation, double timeout)
+{
+	JobGroup group(processInformation);
+	group.Jobs.resize(jobs.size());
+	for(unsigned int i=0;i<jobs.size();i++)
+	{
+		Job & job = group.Jobs[i];
+		job.process = itksysProcess_New();
+		job.name = names[i];
+		job.progress = 0.0;
+		itksysProcess_SetCommand(job.process, &*jobs[i].begin());
+		itksysProcess_SetOption(job.process, itksysProcess_Option_HideWindow, 1);
+		if (timeout > 0)
+		{
+			itksysProcess_SetTimeout(job.process, timeout);
+		}
+		itksysProcess_Execute(job.process);
+	}
+
+	// each job is waited for in its own thread, the last one in this thread
+	std::vector<std::thread> threads;
+	for(unsigned int i=0;i+1<group.Jobs.size();i++)
+	{
+		threads.push_back(std::thread(&JobGroup::Wait, &group, &group.Jobs[i]));
+	}
+	if (!group.Jobs.empty())
+	{
+		group.Wait(&group.Jobs.back());
+	}
+	for(unsigned int i=0;i<threads.size();i++)
+	{
+		threads[i].join();
+	}
+
+	int result = 0;
+	for(unsigned int i=0;i<group.Jobs.size();i++)
+	{
+		int jobResult = Finish(group.Jobs[i].process, group.Jobs[i].name);
+		if (group.Jobs.size() > 1)
+		{
+			std::cout << group.Jobs[i].name << " finished with exit value " << jobResult << std::endl;
+		}
+		if (jobResult != 0 && result == 0)
+		{
+			result = jobResult;
+		}
+	}
+	return result;
+}
+
+unsigned int NumberOfThreadsPerJob(unsigned int numberOfJobs)
+{
+	itksys::SystemInformation systemInformation;
+	systemInformation.RunCPUCheck();
+	unsigned int numberOfCPUs = std::max(1u, systemInformation.GetNumberOfLogicalCPU());
+	return std::max(1u, numberOfCPUs / std::max(1u, numberOfJobs));
+}
+
+std::vector<std::string> BRAINSFitSamplingArguments(const std::string & strategy, double percentage, int seed)
+{
+	std::vector<std::string> warnings;
+	if (strategy == "Regular"){
+		warnings.push_back("BRAINSFit only samples randomly: the voxels are sampled randomly, not regularly.");
+	}
+	if (strategy != "Full" && seed != 0){
+		warnings.push_back("BRAINSFit has its own random seed: the sampling seed is not used, the sampled voxels "
+			"and the registration may differ from one run to the next.");
+	}
+	for(size_t i=0;i<warnings.size();i++)
+	{
+		std::cerr << "Warning: " << warnings[i] << std::endl;
+		std::cout << "Warning: " << warnings[i] << std::endl;
+	}
+	std::ostringstream percentageString;
+	percentageString << (strategy == "Full" ? 1.0 : percentage);
+	std::vector<std::string> args;
+	args.push_back("--metricSamplingStrategy");
+	args.push_back("Random");
+	args.push_back("--samplingPercentage");
+	args.push_back(percentageString.str());
+	return args;
+}
+
+void CheckOutputImage(const std::string & fileName)
+{
+#if ITK_VERSION_MAJOR > 5 || (ITK_VERSION_MAJOR == 5 && ITK_VERSION_MINOR >= 1)
+	itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(fileName.c_str(), itk::IOFileModeEnum::ReadMode);
+#else
+	itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(fileName.c_str(), itk::ImageIOFactory::ReadMode);
+#endif
+	if (imageIO.IsNull())
+	{
+		itkGenericExceptionMacro(<< "Could not read the output image " << fileName);
+	}
+	imageIO->SetFileName(fileName);
+	imageIO->ReadImageInformation();
+}
+
+}
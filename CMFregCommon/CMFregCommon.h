@@ -0,0 +1,53 @@
+/*=========================================================================
+
+  Program:   Slicer4
+  Language:  C++
+  Module:    CMFregCommon
+
+  Copyright (c) Neuro Image Research and Analysis Lab, UNC-Chapel Hill All Rights Reserved.
+
+  See License.txt or http://www.slicer.org/copyright/copyright.txt for details.
+
+==========================================================================*/
+#ifndef __CMFregCommon_h
+#define __CMFregCommon_h
+
+#include <string>
+#include <vector>
+
+struct ModuleProcessInformation;
+
+namespace CMFreg
+{
+
+// Full path of a program (e.g. a Slicer CLI), looked up in the PATH and, on Mac, in the
+// CLI directory of Slicer. The paths found are cached for the next calls of the process.
+std::string FindTool(const std::string & name);
+
+// Run the program of the null terminated args and wait for its end. Its progress is
+// forwarded to processInformation, or written on the standard output when it is null,
+// and the abort flag of processInformation kills it. The program is killed after
+// timeout seconds if timeout is positive. Return its exit value, 1 if it did not exit.
+int Run(std::vector<const char*> args, ModuleProcessInformation * processInformation = 0, double timeout = 0);
+
+// Run the programs at the same time and wait for all of them, with their mean progress.
+// Return 0 if all of them succeeded, else the first nonzero exit value.
+int RunConcurrently(const std::vector< std::vector<const char*> > & jobs, const std::vector<std::string> & names,
+	ModuleProcessInformation * processInformation = 0, double timeout = 0);
+
+// Number of threads of each of numberOfJobs jobs sharing the logical CPUs
+unsigned int NumberOfThreadsPerJob(unsigned int numberOfJobs);
+
+// Sampling arguments of BRAINSFit for the strategy of the in process registration.
+// BRAINSFit only samples randomly, without seed: "Full" samples all the voxels and
+// "Regular" falls back to random sampling. A warning is written when the strategy is
+// "Regular" or when a seed is given, since BRAINSFit does not follow them.
+std::vector<std::string> BRAINSFitSamplingArguments(const std::string & strategy, double percentage, int seed);
+
+// Check that the image file exists and can be read, by reading its header only.
+// Throw an itk::ExceptionObject if it cannot.
+void CheckOutputImage(const std::string & fileName);
+
+}
+
+#endif
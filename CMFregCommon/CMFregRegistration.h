@@ -0,0 +1,427 @@
+/*=========================================================================
+
+  Program:   Slicer4
+  Language:  C++
+  Module:    CMFregCommon
+
+  Copyright (c) Neuro Image Research and Analysis Lab, UNC-Chapel Hill All Rights Reserved.
+
+  See License.txt or http://www.slicer.org/copyright/copyright.txt for details.
+
+==========================================================================*/
+#ifndef __CMFregRegistration_h
+#define __CMFregRegistration_h
+
+// In process registration and resampling of the voxel based modules: the volumes
+// and the masks are read once and stay in memory for all the stages.
+
+#include <algorithm>
+#include <iostream>
+#include <string>
+#include <vector>
+
+#include "itkImageFileReader.h"
+#include "itkImageFileWriter.h"
+#include "itkImageIOBase.h"
+#include "itkBinaryThresholdImageFilter.h"
+#include "itkCastImageFilter.h"
+#include "itkResampleImageFilter.h"
+#include "itkLinearInterpolateImageFunction.h"
+#include "itkNearestNeighborInterpolateImageFunction.h"
+#include "itkImageMaskSpatialObject.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
+#include "itkMersenneTwisterRandomVariateGenerator.h"
+#include "itkPointSet.h"
+#include "itkImageRegistrationMethodv4.h"
+#include "itkMattesMutualInformationImageToImageMetricv4.h"
+#include "itkRegularStepGradientDescentOptimizerv4.h"
+#include "itkRegistrationParameterScalesFromPhysicalShift.h"
+#include "itkVersorRigid3DTransform.h"
+#include "itkScaleVersor3DTransform.h"
+#include "itkScaleSkewVersor3DTransform.h"
+#include "itkAffineTransform.h"
+#include "itkTransformFileWriter.h"
+#include <vnl/algo/vnl_determinant.h>
+#include <vnl/algo/vnl_svd.h>
+
+namespace CMFreg
+{
+
+typedef itk::Image<float,3> FloatImageType;
+typedef itk::Image<int,3> LabelImageType;
+typedef itk::Image<unsigned char,3> MaskImageType;
+typedef itk::ImageMaskSpatialObject<3> MaskType;
+typedef itk::MatrixOffsetTransformBase<double,3,3> MatrixTransformType;
+typedef itk::PointSet<FloatImageType::PixelType,3> SampledPointSetType;
+#if ITK_VERSION_MAJOR > 5 || (ITK_VERSION_MAJOR == 5 && ITK_VERSION_MINOR >= 1)
+typedef itk::IOComponentEnum ComponentType;
+#else
+typedef itk::ImageIOBase ComponentType;
+#endif
+
+template <class TImage>
+typename TImage::Pointer ReadImage(const std::string & fileName, itk::ImageIOBase::IOComponentType & componentType)
+{
+	typedef itk::ImageFileReader<TImage> ImageReaderType;
+	typename ImageReaderType::Pointer reader = ImageReaderType::New();
+	reader->SetFileName( fileName.c_str() );
+	reader->Update();
+	componentType = reader->GetImageIO()->GetComponentType();
+	return reader->GetOutput();
+}
+
+// Nonzero voxels of the masked grayscale image
+inline MaskType::Pointer ReadMask(const std::string & fileName)
+{
+	itk::ImageIOBase::IOComponentType componentType;
+	FloatImageType::Pointer image = ReadImage<FloatImageType>(fileName, componentType);
+	typedef itk::BinaryThresholdImageFilter<FloatImageType,MaskImageType> ThresholdType;
+	ThresholdType::Pointer threshold = ThresholdType::New();
+	threshold->SetInput(image);
+	threshold->SetLowerThreshold(0);
+	threshold->SetUpperThreshold(0);
+	threshold->SetInsideValue(0);
+	threshold->SetOutsideValue(1);
+	threshold->Update();
+	MaskType::Pointer mask = MaskType::New();
+	mask->SetImage(threshold->GetOutput());
+#if ITK_VERSION_MAJOR >= 5
+	mask->Update();
+#endif
+	return mask;
+}
+
+template <class TOutputPixel, class TImage>
+void CastAndWrite(const TImage * image, const std::string & fileName)
+{
+	typedef itk::Image<TOutputPixel,3> OutputImageType;
+	typedef itk::CastImageFilter<TImage,OutputImageType> CastType;
+	typename CastType::Pointer cast = CastType::New();
+	cast->SetInput(image);
+	typedef itk::ImageFileWriter<OutputImageType> WriterType;
+	typename WriterType::Pointer writer = WriterType::New();
+	writer->SetInput(cast->GetOutput());
+	writer->SetFileName( fileName.c_str() );
+	writer->UseCompressionOn();
+	writer->Update();
+}
+
+// Write the image with the pixel type of the file it was read from, as ResampleScalarVectorDWIVolume does
+template <class TImage>
+void WriteImage(const TImage * image, const std::string & fileName, itk::ImageIOBase::IOComponentType componentType)
+{
+	switch(componentType)
+	{
+		case ComponentType::UCHAR: CastAndWrite<unsigned char>(image, fileName); break;
+		case ComponentType::CHAR: CastAndWrite<char>(image, fileName); break;
+		case ComponentType::USHORT: CastAndWrite<unsigned short>(image, fileName); break;
+		case ComponentType::SHORT: CastAndWrite<short>(image, fileName); break;
+		case ComponentType::UINT: CastAndWrite<unsigned int>(image, fileName); break;
+		case ComponentType::INT: CastAndWrite<int>(image, fileName); break;
+		case ComponentType::DOUBLE: CastAndWrite<double>(image, fileName); break;
+		default: CastAndWrite<float>(image, fileName); break;
+	}
+}
+
+// One level of a registration pyramid: the volumes are shrunk by shrinkFactor and smoothed by a
+// gaussian of smoothingSigma voxels, and the optimizer stops after numberOfIterations or when its
+// step is shorter than minimumStepLength
+struct RegistrationLevel
+{
+	unsigned int shrinkFactor;
+	double smoothingSigma;
+	unsigned int numberOfIterations;
+	double minimumStepLength;
+};
+
+// Single level at full resolution
+inline std::vector<RegistrationLevel> FullResolution(unsigned int numberOfIterations, double minimumStepLength)
+{
+	RegistrationLevel level;
+	level.shrinkFactor = 1;
+	level.smoothingSigma = 0;
+	level.numberOfIterations = numberOfIterations;
+	level.minimumStepLength = minimumStepLength;
+	return std::vector<RegistrationLevel>(1, level);
+}
+
+// Levels from the coarsest to the finest, from the vectors of the XML parameters
+inline std::vector<RegistrationLevel> MakeLevels(const std::vector<int> & shrinkFactors,
+	const std::vector<float> & smoothingSigmas, const std::vector<int> & numbersOfIterations,
+	const std::vector<float> & minimumStepLengths)
+{
+	if (shrinkFactors.empty() || smoothingSigmas.size() != shrinkFactors.size()
+		|| numbersOfIterations.size() != shrinkFactors.size() || minimumStepLengths.size() != shrinkFactors.size())
+	{
+		itkGenericExceptionMacro(<< "The shrink factors, smoothing sigmas, numbers of iterations and minimum step lengths "
+			<< "must have one value for each level");
+	}
+	std::vector<RegistrationLevel> levels(shrinkFactors.size());
+	for(unsigned int i=0;i<levels.size();i++)
+	{
+		levels[i].shrinkFactor = std::max(1, shrinkFactors[i]);
+		levels[i].smoothingSigma = smoothingSigmas[i];
+		levels[i].numberOfIterations = std::max(0, numbersOfIterations[i]);
+		levels[i].minimumStepLength = minimumStepLengths[i];
+	}
+	return levels;
+}
+
+// Voxels of the fixed mask where the metric is computed: "Full" takes all of them,
+// "Random" each one with the probability percentage, "Regular" one random voxel in each
+// stratum of 1/percentage consecutive voxels. The same nonzero seed gives the same voxels,
+// 0 a seed from the clock.
+struct Sampling
+{
+	std::string strategy;
+	double percentage;
+	int seed;
+};
+
+inline Sampling MakeSampling(const std::string & strategy, double percentage, int seed)
+{
+	if (strategy != "Full" && strategy != "Random" && strategy != "Regular"){
+		itkGenericExceptionMacro(<< "Unknown sampling strategy " << strategy);
+	}
+	if (strategy != "Full" && (percentage <= 0 || percentage > 1)){
+		itkGenericExceptionMacro(<< "The sampling percentage must be in ]0, 1]");
+	}
+	Sampling sampling;
+	sampling.strategy = strategy;
+	sampling.percentage = percentage;
+	sampling.seed = seed;
+	return sampling;
+}
+
+// Physical points of the sampled voxels of grid, only of its nonzero voxels if onlyNonzero.
+// The voxels are taken on the grid shrunk by shrinkFactor, the center voxel of each block
+// of shrinkFactor^3 voxels, as the registration level computes its metric.
+template <class TImage>
+SampledPointSetType::Pointer SampleVoxels(const TImage * grid, bool onlyNonzero, const Sampling & sampling,
+	unsigned int shrinkFactor = 1)
+{
+	typedef itk::Statistics::MersenneTwisterRandomVariateGenerator GeneratorType;
+	GeneratorType::Pointer generator = GeneratorType::New();
+	if (sampling.seed != 0){
+		generator->SetSeed(sampling.seed);
+	}
+	else{
+		generator->SetSeed();
+	}
+	double percentage = sampling.strategy == "Full" ? 1.0 : sampling.percentage;
+	double step = 1.0 / percentage;
+	// voxels [stratumStart, stratumEnd[ of the current stratum, and the one sampled in it
+	unsigned long stratum = 0;
+	unsigned long stratumStart = 0;
+	unsigned long stratumEnd = static_cast<unsigned long>(step + 0.5);
+	unsigned long chosenVoxel = static_cast<unsigned long>(generator->GetVariateWithOpenUpperRange() * stratumEnd);
+
+	SampledPointSetType::Pointer points = SampledPointSetType::New();
+	points->Initialize();
+	unsigned long numberOfVoxels = 0;
+	unsigned long numberOfPoints = 0;
+	typename TImage::RegionType region = grid->GetLargestPossibleRegion();
+	itk::ImageRegionConstIteratorWithIndex<TImage> it(grid, region);
+	for(it.GoToBegin();!it.IsAtEnd();++it)
+	{
+		bool onShrunkGrid = true;
+		for(unsigned int d=0;d<TImage::ImageDimension;d++)
+		{
+			unsigned long offset = static_cast<unsigned long>(it.GetIndex()[d] - region.GetIndex()[d]);
+			onShrunkGrid = onShrunkGrid && offset % shrinkFactor == shrinkFactor / 2;
+		}
+		if (!onShrunkGrid || (onlyNonzero && it.Get() == 0)){
+			continue;
+		}
+		bool sampled = true;
+		if (sampling.strategy == "Random"){
+			sampled = generator->GetVariateWithOpenUpperRange() < percentage;
+		}
+		else if (sampling.strategy == "Regular"){
+			sampled = numberOfVoxels == chosenVoxel;
+			if (numberOfVoxels + 1 == stratumEnd){
+				stratum++;
+				stratumStart = stratumEnd;
+				stratumEnd = static_cast<unsigned long>((stratum + 1) * step + 0.5);
+				chosenVoxel = stratumStart
+					+ static_cast<unsigned long>(generator->GetVariateWithOpenUpperRange() * (stratumEnd - stratumStart));
+			}
+		}
+		numberOfVoxels++;
+		if (sampled){
+			typename TImage::PointType physicalPoint;
+			grid->TransformIndexToPhysicalPoint(it.GetIndex(), physicalPoint);
+			SampledPointSetType::PointType point;
+			point.CastFrom(physicalPoint);
+			points->SetPoint(numberOfPoints++, point);
+		}
+	}
+	if (numberOfPoints == 0){
+		itkGenericExceptionMacro(<< "No voxel sampled out of " << numberOfVoxels);
+	}
+	std::cout << sampling.strategy << " sampling: " << numberOfPoints << " of " << numberOfVoxels
+		<< (onlyNonzero ? " mask voxels" : " voxels") << " shrunk by " << shrinkFactor << std::endl;
+	return points;
+}
+
+// Points of the metric: sampled in the fixed mask, or in the fixed image without mask.
+// Null when all the voxels of the fixed image are used: the metric is then dense.
+inline SampledPointSetType::Pointer SampleFixedPoints(const FloatImageType * fixed, const MaskType * fixedMask,
+	const Sampling & sampling, unsigned int shrinkFactor = 1)
+{
+	if (fixedMask){
+		return SampleVoxels(fixedMask->GetImage(), true, sampling, shrinkFactor);
+	}
+	if (sampling.strategy == "Full"){
+		return SampledPointSetType::Pointer();
+	}
+	return SampleVoxels(fixed, false, sampling, shrinkFactor);
+}
+
+// Mattes mutual information in the masks, regular step gradient descent, as BRAINSFit does with its defaults.
+// The metric is computed at the sampled points, all the voxels of the fixed image when there are none.
+template <class TTransform>
+void RegisterLevel(const FloatImageType * fixed, const FloatImageType * moving, const MaskType * fixedMask,
+	const MaskType * movingMask, TTransform * transform, const RegistrationLevel & level,
+	const SampledPointSetType * sampledPoints)
+{
+	unsigned int numberOfIterations = level.numberOfIterations;
+	double minimumStepLength = level.minimumStepLength;
+
+	typedef itk::MattesMutualInformationImageToImageMetricv4<FloatImageType,FloatImageType> MetricType;
+	typedef itk::RegularStepGradientDescentOptimizerv4<double> OptimizerType;
+	typedef itk::ImageRegistrationMethodv4<FloatImageType,FloatImageType,TTransform> RegistrationType;
+	typedef itk::RegistrationParameterScalesFromPhysicalShift<MetricType> ScalesEstimatorType;
+
+	typename MetricType::Pointer metric = MetricType::New();
+	metric->SetNumberOfHistogramBins(50);
+	metric->SetFixedImageMask(fixedMask);
+	metric->SetMovingImageMask(movingMask);
+	if (sampledPoints){
+		metric->SetFixedSampledPointSet(sampledPoints);
+		metric->SetUseSampledPointSet(true);
+	}
+
+	typename ScalesEstimatorType::Pointer scalesEstimator = ScalesEstimatorType::New();
+	scalesEstimator->SetMetric(metric);
+
+	typename OptimizerType::Pointer optimizer = OptimizerType::New();
+	optimizer->SetNumberOfIterations(numberOfIterations);
+	optimizer->SetMinimumStepLength(minimumStepLength);
+	optimizer->SetRelaxationFactor(0.5);
+	optimizer->SetScalesEstimator(scalesEstimator);
+
+	typename RegistrationType::Pointer registration = RegistrationType::New();
+	registration->SetFixedImage(fixed);
+	registration->SetMovingImage(moving);
+	registration->SetMetric(metric);
+	registration->SetOptimizer(optimizer);
+	registration->SetInitialTransform(transform);
+	registration->InPlaceOn();
+
+	typename RegistrationType::ShrinkFactorsArrayType shrinkFactors(1);
+	shrinkFactors[0] = level.shrinkFactor;
+	typename RegistrationType::SmoothingSigmasArrayType smoothingSigmas(1);
+	smoothingSigmas[0] = level.smoothingSigma;
+	registration->SetNumberOfLevels(1);
+	registration->SetShrinkFactorsPerLevel(shrinkFactors);
+	registration->SetSmoothingSigmasPerLevel(smoothingSigmas);
+	registration->SetSmoothingSigmasAreSpecifiedInPhysicalUnits(false);
+	// the sampled points of the metric are kept: the registration method does not sample
+#if ITK_VERSION_MAJOR > 5 || (ITK_VERSION_MAJOR == 5 && ITK_VERSION_MINOR >= 1)
+	registration->SetMetricSamplingStrategy(itk::ImageRegistrationMethodv4Enums::MetricSamplingStrategy::NONE);
+#else
+	registration->SetMetricSamplingStrategy(RegistrationType::NONE);
+#endif
+	registration->Update();
+
+	std::cout << "Shrink factor " << level.shrinkFactor << ", smoothing sigma " << level.smoothingSigma
+		<< ": stopped after " << optimizer->GetCurrentIteration() << " iterations: "
+		<< optimizer->GetStopConditionDescription() << std::endl;
+}
+
+// Register the levels one after the other, each one starting from the transform found by the previous one.
+// The voxels are sampled at each level on its shrunk grid, so that a coarse level has fewer points.
+template <class TTransform>
+void RegisterStage(const FloatImageType * fixed, const FloatImageType * moving, const MaskType * fixedMask,
+	const MaskType * movingMask, TTransform * transform, const std::vector<RegistrationLevel> & levels,
+	const Sampling & sampling)
+{
+	for(unsigned int i=0;i<levels.size();i++)
+	{
+		SampledPointSetType::Pointer sampledPoints = SampleFixedPoints(fixed, fixedMask, sampling, levels[i].shrinkFactor);
+		RegisterLevel(fixed, moving, fixedMask, movingMask, transform, levels[i], sampledPoints.GetPointer());
+	}
+}
+
+inline void WriteTransform(const itk::TransformBase * transform, const std::string & fileName)
+{
+	itk::TransformFileWriter::Pointer transformWriter = itk::TransformFileWriter::New();
+	transformWriter->SetInput(transform);
+	transformWriter->SetFileName( fileName.c_str() );
+	transformWriter->Update();
+}
+
+// Identity transform rotating around the center of the fixed image, like BRAINSFit without initialization
+template <class TTransform>
+typename TTransform::Pointer CenteredIdentity(const FloatImageType * fixed)
+{
+	typedef itk::ContinuousIndex<double,3> ContinuousIndexType;
+	FloatImageType::RegionType region = fixed->GetLargestPossibleRegion();
+	ContinuousIndexType centerIndex;
+	for(unsigned int i=0;i<3;i++)
+	{
+		centerIndex[i] = region.GetIndex()[i] + (region.GetSize()[i] - 1) / 2.0;
+	}
+	FloatImageType::PointType center;
+	fixed->TransformContinuousIndexToPhysicalPoint(centerIndex, center);
+	typename TTransform::Pointer transform = TTransform::New();
+	transform->SetIdentity();
+	transform->SetCenter(center);
+	return transform;
+}
+
+// Rotation of the first stage transform (the closest rotation matrix), with its center and translation
+inline itk::VersorRigid3DTransform<double>::Pointer ExtractRigid(const MatrixTransformType * transform)
+{
+	vnl_matrix<double> matrix(3,3);
+	for(unsigned int i=0;i<3;i++)
+	{
+		for(unsigned int j=0;j<3;j++)
+		{
+			matrix(i,j) = transform->GetMatrix()(i,j);
+		}
+	}
+	vnl_svd<double> svd(matrix);
+	vnl_matrix<double> u = svd.U();
+	// a reflection when the determinant is negative: the axis of the smallest singular value is flipped
+	if (vnl_determinant(u * svd.V().transpose()) < 0){
+		u.set_column(2, -u.get_column(2));
+	}
+	itk::Matrix<double,3,3> rotation;
+	rotation = u * svd.V().transpose();
+	itk::VersorRigid3DTransform<double>::Pointer rigid = itk::VersorRigid3DTransform<double>::New();
+	rigid->SetCenter(transform->GetCenter());
+	rigid->SetMatrix(rotation);
+	rigid->SetTranslation(transform->GetTranslation());
+	return rigid;
+}
+
+template <class TImage, class TInterpolator>
+typename TImage::Pointer ResampleImage(const TImage * image, const MatrixTransformType * transform)
+{
+	typedef itk::ResampleImageFilter<TImage,TImage> ResampleType;
+	typename ResampleType::Pointer resample = ResampleType::New();
+	resample->SetInput(image);
+	resample->SetTransform(transform);
+	resample->SetInterpolator(TInterpolator::New());
+	resample->UseReferenceImageOn();
+	resample->SetReferenceImage(image);
+	resample->SetDefaultPixelValue(0);
+	resample->Update();
+	return resample->GetOutput();
+}
+
+}
+
+#endif
@@ -49,6 +49,7 @@
 #include <vtkSlicerConfigure.h>
 
 #include "GrowingCLP.h"
+#include "CMFregCommon.h"
 # include "itkFactoryRegistration.h"
 //##################################
 
@@ -71,72 +72,77 @@
 extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
 
 #include "itkImageFileReader.h"
+#include "CMFregRegistration.h"
 
-int Run(std::vector<const char*> args, bool TimeOn)
-{		
-	//itk sys parameters
-	int length;
-	time_t start,end;
-	time (&start);
-
-	double timeout = 0.05;
-	int result;
-	char* dataitk = NULL;
-
-	itksysProcess* gp = itksysProcess_New();
-	itksysProcess_SetCommand(gp, &*args.begin());
-	itksysProcess_SetOption(gp,itksysProcess_Option_HideWindow,1);
-	itksysProcess_Execute(gp);
-	while(int Value = itksysProcess_WaitForData(gp,&dataitk,&length,&timeout)) // wait for 1s
-	{
-		if ( ((Value == itksysProcess_Pipe_STDOUT) || (Value == itksysProcess_Pipe_STDERR)) && dataitk[0]=='D' )
-		{
-			std::stringstream st;
-			for(int i=0;i<length;i++) 	
-			{
-				st<<dataitk[i];
-			}
-			std::string dim=st.str();
-		}
-			if(TimeOn){
-				time (&end);
-				cout<<"(processing since "<<difftime (end,start)<<" seconds) \r";
-				timeout = 0.05; 
-			}  	
+//##################################
+// Fused registration: the volumes and the masks are read once, the two
+// registration stages and the resampling run in this process.
+
+using namespace CMFreg;
+
+int RunFusedRegistration(const std::string & fixedVolume, const std::string & fixedMaskVolume,
+	const std::string & movingVolume, const std::string & movingMaskVolume, bool useAffine, bool useScaleSkewVersor3D,
+	const std::string & transformPath, const std::string & segmentation, const std::string & segmentationOut,
+	const std::string & outputVolume, const std::vector<RegistrationLevel> & levels, const Sampling & sampling)
+{
+	itk::ImageIOBase::IOComponentType fixedComponentType, movingComponentType;
+	FloatImageType::Pointer fixed = ReadImage<FloatImageType>(fixedVolume, fixedComponentType);
+	FloatImageType::Pointer moving = ReadImage<FloatImageType>(movingVolume, movingComponentType);
+	MaskType::Pointer fixedMask = ReadMask(fixedMaskVolume);
+	MaskType::Pointer movingMask = ReadMask(movingMaskVolume);
+
+	MatrixTransformType::Pointer stageTransform;
+	if (useAffine){
+		std::cout << "Affine registration..." << std::endl;
+		itk::AffineTransform<double,3>::Pointer affine = CenteredIdentity< itk::AffineTransform<double,3> >(fixed);
+		RegisterStage(fixed.GetPointer(), moving.GetPointer(), fixedMask.GetPointer(), movingMask.GetPointer(),
+			affine.GetPointer(), levels.empty() ? FullResolution(10000, 0.0000001) : levels,
+			sampling);
+		stageTransform = affine.GetPointer();
 	}
-	itksysProcess_WaitForExit(gp, 0);
-	result = 1;
-	switch(itksysProcess_GetState(gp))
-	{
-		case itksysProcess_State_Exited:
-		{
-			result = itksysProcess_GetExitValue(gp);
-		} break;
-		case itksysProcess_State_Error:
-		{
-			std::cerr<<"Error: Could not run " << args[0]<<":\n";
-			std::cerr<<itksysProcess_GetErrorString(gp)<<"\n";
-			std::cout<<"Error: Could not run " << args[0]<<":\n";
-			std::cout<<itksysProcess_GetErrorString(gp)<<"\n";
-		} break;
-		case itksysProcess_State_Exception:
-		{
-			std::cerr<<"Error: "<<args[0]<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
-			std::cout<<"Error: "<<args[0]<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
-		} break;
-		case itksysProcess_State_Starting:
-		case itksysProcess_State_Executing:
-		case itksysProcess_State_Expired:
-		case itksysProcess_State_Killed:
-		{
-		// Should not get here.
-		std::cerr<<"Unexpected ending state after running "<<args[0]<<std::endl;
-		std::cout<<"Unexpected ending state after running "<<args[0]<<std::endl;
-		} break;
+	else if(useScaleSkewVersor3D){
+		std::cout << "ScaleSkewVersor3D registration..." << std::endl;
+		itk::ScaleSkewVersor3DTransform<double>::Pointer scaleSkew =
+			CenteredIdentity< itk::ScaleSkewVersor3DTransform<double> >(fixed);
+		RegisterStage(fixed.GetPointer(), moving.GetPointer(), fixedMask.GetPointer(), movingMask.GetPointer(),
+			scaleSkew.GetPointer(), levels.empty() ? FullResolution(20000, 0.0000001) : levels,
+			sampling);
+		stageTransform = scaleSkew.GetPointer();
+	}
+	else{
+		std::cout << "ScaleVersor3D registration..." << std::endl;
+		itk::ScaleVersor3DTransform<double>::Pointer scaleVersor =
+			CenteredIdentity< itk::ScaleVersor3DTransform<double> >(fixed);
+		RegisterStage(fixed.GetPointer(), moving.GetPointer(), fixedMask.GetPointer(), movingMask.GetPointer(),
+			scaleVersor.GetPointer(), levels.empty() ? FullResolution(40000, 0.00000001) : levels,
+			sampling);
+		stageTransform = scaleVersor.GetPointer();
+	}
+
+	std::cout << "Rigid registration..." << std::endl;
+	itk::VersorRigid3DTransform<double>::Pointer rigid = ExtractRigid(stageTransform.GetPointer());
+	RegisterStage(fixed.GetPointer(), moving.GetPointer(), fixedMask.GetPointer(), movingMask.GetPointer(),
+		rigid.GetPointer(), levels.empty() ? FullResolution(20000, 0.0000001) : levels, sampling);
+
+	if(!transformPath.empty()){
+		WriteTransform(rigid, transformPath);
+	}
+
+	if(!segmentation.empty() && !segmentationOut.empty()){
+		itk::ImageIOBase::IOComponentType segmentationComponentType;
+		LabelImageType::Pointer labels = ReadImage<LabelImageType>(segmentation, segmentationComponentType);
+		LabelImageType::Pointer resampledLabels = ResampleImage< LabelImageType,
+			itk::NearestNeighborInterpolateImageFunction<LabelImageType,double> >(labels, rigid);
+		WriteImage(resampledLabels.GetPointer(), segmentationOut, segmentationComponentType);
 	}
-	itksysProcess_Delete(gp);  
 
-  return result;
+	if(!outputVolume.empty()){
+		FloatImageType::Pointer resampledMoving = ResampleImage< FloatImageType,
+			itk::LinearInterpolateImageFunction<FloatImageType,double> >(moving, rigid);
+		WriteImage(resampledMoving.GetPointer(), outputVolume, movingComponentType);
+	}
+
+	return EXIT_SUCCESS;
 }
 
 int main(int argc, char * argv [])
@@ -146,37 +152,32 @@ int main(int argc, char * argv [])
 
   itk::itkFactoryRegistration();
 
+  if (fusedRegistration){
+	try{
+		std::vector<RegistrationLevel> levels;
+		if (useMultiResolution){
+			levels = MakeLevels(shrinkFactors, smoothingSigmas, levelIterations, levelMinimumStepLengths);
+		}
+		return RunFusedRegistration(fixedVolume, fixedMaskVolume, movingVolume, movingMaskVolume, useAffine,
+			useScaleSkewVersor3D, transformPath, segmentation, segmentationOut, outputVolume, levels,
+			MakeSampling(samplingStrategy, samplingPercentage, samplingSeed));
+	}
+	catch(itk::ExceptionObject &excep){
+		std::cout << excep << ":exception caught!" << std::endl;
+		return EXIT_FAILURE;
+	}
+  }
+
 //  return ModuleEntryPoint(argc, argv);
   
-/*Get Environment Variable*/
-  std::vector<std::string> userPaths;
-
-#if defined(__APPLE__)
-  // on Mac, slicer does not provide a PATH variable that includes the built-in CLIs
-  // so we add it here.
-  std::string slicerHome;
-  if (itksys::SystemTools::GetEnv("SLICER_HOME", slicerHome))
-    {
-    // Slicer_CLIMODULES_BIN_DIR is defined in vtkSlicerConfigure.h which is configured in the inner-build
-    // directory of Slicer
-    userPaths.push_back( slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR  ) ;
-    std::cout<<"Additional Paths: " << slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR << std::endl ;
-    }
-
-#endif
-
-  std::string BFPath;
-  BFPath = itksys::SystemTools::FindProgram("BRAINSFit", userPaths);
-  std::cout << "Path to BRAINSFit executable: " << BFPath << std::endl ;
-  std::string RV2Path;
-  RV2Path = itksys::SystemTools::FindProgram("ResampleScalarVectorDWIVolume", userPaths);
-  std::cout << "Path to ResampleScalarVectorDWIVolume executable: " << RV2Path << std::endl ;
-
-/*Endvironment Variable*/
+  std::string BFPath = CMFreg::FindTool("BRAINSFit");
+  std::string RV2Path = CMFreg::FindTool("ResampleScalarVectorDWIVolume");
 
  
   try{
 
+	std::vector<std::string> samplingArgs = CMFreg::BRAINSFitSamplingArguments(samplingStrategy, samplingPercentage, samplingSeed);
+
 	std::vector<const char*> args;
 
 	args.push_back(BFPath.c_str());
@@ -198,6 +199,10 @@ int main(int argc, char * argv [])
 		args.push_back("--useScaleVersor3D");	
 	}
 	args.push_back("--maskProcessingMode ROI");
+	for(unsigned int i=0;i<samplingArgs.size();i++)
+	{
+		args.push_back(samplingArgs[i].c_str());
+	}
 	args.push_back("--movingBinaryVolume");
 	args.push_back(movingMaskVolume.c_str());
 	args.push_back("--fixedBinaryVolume");
@@ -208,7 +213,10 @@ int main(int argc, char * argv [])
 	args.push_back(fixedVolume.c_str());
 	args.push_back(0);
 
-	Run(args,0);
+	if(CMFreg::Run(args, CLPProcessInformation, timeout) != 0){
+		std::cout << "BRAINSFit failed" << std::endl;
+		return EXIT_FAILURE;
+	}
 	
 	std::vector<const char*> args2;
 
@@ -218,6 +226,10 @@ int main(int argc, char * argv [])
 	args2.push_back("--minimumStepLength 0.0000001");
 	args2.push_back("--numberOfIterations 20000");
 	args2.push_back("--maskProcessingMode ROI");
+	for(unsigned int i=0;i<samplingArgs.size();i++)
+	{
+		args2.push_back(samplingArgs[i].c_str());
+	}
 	args2.push_back("--useRigid");
 	args2.push_back("--initialTransform");
 	args2.push_back(transformPath.c_str());
@@ -231,19 +243,29 @@ int main(int argc, char * argv [])
 	args2.push_back(fixedVolume.c_str());
 	args2.push_back(0);
 
-	Run(args2,0);
+	if(CMFreg::Run(args2, CLPProcessInformation, timeout) != 0){
+		std::cout << "BRAINSFit failed" << std::endl;
+		return EXIT_FAILURE;
+	}
 
-	std::vector<const char*> args3;
+	// the two resamplings only depend on the transform, they run at the same time
+	std::vector< std::vector<const char*> > resampleJobs;
+	std::vector<std::string> resampleNames;
+
+	if(!segmentationOut.empty()){
+		std::vector<const char*> args3;
 		
-	args3.push_back(RV2Path.c_str());
-	args3.push_back("--interpolation nn");
-	args3.push_back("--transformationFile");
-	args3.push_back(transformPath.c_str());
-	args3.push_back(segmentation.c_str());
-	args3.push_back(segmentationOut.c_str());
-	args3.push_back(0);
+		args3.push_back(RV2Path.c_str());
+		args3.push_back("--interpolation nn");
+		args3.push_back("--transformationFile");
+		args3.push_back(transformPath.c_str());
+		args3.push_back(segmentation.c_str());
+		args3.push_back(segmentationOut.c_str());
+		args3.push_back(0);
 		
-	Run(args3,0);
+		resampleJobs.push_back(args3);
+		resampleNames.push_back("Resampling of the segmentation");
+	}
 
 	if(!outputVolume.empty()){
 		std::vector<const char*> args4;
@@ -256,17 +278,28 @@ int main(int argc, char * argv [])
 		args4.push_back(outputVolume.c_str());
 		args4.push_back(0);
 			
-		Run(args4,0);
+		resampleJobs.push_back(args4);
+		resampleNames.push_back("Resampling of the moving volume");
 	}
 
-  	typedef itk::Image<short,3> ImageType;
-  	typedef itk::ImageFileReader<ImageType> ReaderType;
-
-	ReaderType::Pointer reader = ReaderType::New();
+	// each resampling gets its share of the threads
+	std::stringstream numberOfThreads;
+	numberOfThreads << CMFreg::NumberOfThreadsPerJob(resampleJobs.size());
+	std::string numberOfThreadsString = numberOfThreads.str();
+	for(unsigned int i=0;i<resampleJobs.size();i++)
+	{
+		// before the terminating null pointer
+		resampleJobs[i].insert(resampleJobs[i].end() - 1, "--number_of_thread");
+		resampleJobs[i].insert(resampleJobs[i].end() - 1, numberOfThreadsString.c_str());
+	}
 
-	reader->SetFileName( segmentationOut.c_str() );
-	reader->ReleaseDataFlagOn();
-	reader->Update();
+	if(CMFreg::RunConcurrently(resampleJobs, resampleNames, CLPProcessInformation, timeout) != 0){
+		std::cout << "ResampleScalarVectorDWIVolume failed" << std::endl;
+		return EXIT_FAILURE;
+	}
+	if(!segmentationOut.empty()){
+		CMFreg::CheckOutputImage(segmentationOut);
+	}
 	
   }
   catch(itk::ExceptionObject &excep){
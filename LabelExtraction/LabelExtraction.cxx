@@ -48,6 +48,7 @@
 #include <vtkSmartPointer.h>
 
 #include "LabelExtractionCLP.h"
+#include "CMFregCommon.h"
 
 //#################################
 
@@ -166,16 +167,7 @@ int main(int argc, char * argv [])
         if (true) writer->UseCompressionOn();
 	writer->SetInput(castFilter->GetOutput());
 	writer->Write();
-
-	typedef itk::Image<short,3> ImageType;
-	typedef itk::ImageFileReader<ImageType> ReaderType;
-	
-	ReaderType::Pointer reader = ReaderType::New();
-	
-	reader->SetFileName( outputVolume.c_str() );
-	reader->ReleaseDataFlagOn();
-	
-	reader->Update();
+	CMFreg::CheckOutputImage(outputVolume);
 	
   }
   catch(itk::ExceptionObject &excep){
@@ -50,6 +50,7 @@
 #include <vtkSlicerConfigure.h>
 
 #include "MaskCreationCLP.h"
+#include "CMFregCommon.h"
 
 //#################################
 
@@ -68,100 +69,13 @@
 #include "itkResampleImageFilter.h"
 #include "itkConstrainedValueAdditionImageFilter.h"
 
-int Run(std::vector<const char*> args, bool TimeOn)
-{		
-	//itk sys parameters
-	int length;
-	time_t start,end;
-	time (&start);
-
-	double timeout = 0.05;
-	int result;
-	char* dataitk = NULL;
-
-	itksysProcess* gp = itksysProcess_New();
-	itksysProcess_SetCommand(gp, &*args.begin());
-	itksysProcess_SetOption(gp,itksysProcess_Option_HideWindow,1);
-	itksysProcess_Execute(gp);
-	while(int Value = itksysProcess_WaitForData(gp,&dataitk,&length,&timeout)) // wait for 1s
-	{
-		if ( ((Value == itksysProcess_Pipe_STDOUT) || (Value == itksysProcess_Pipe_STDERR)) && dataitk[0]=='D' )
-		{
-			std::stringstream st;
-			for(int i=0;i<length;i++) 	
-			{
-				st<<dataitk[i];
-			}
-			std::string dim=st.str();
-		}
-			if(TimeOn){
-				time (&end);
-				cout<<"(processing since "<<difftime (end,start)<<" seconds) \r";
-				timeout = 0.05; 
-			}  	
-	}
-	itksysProcess_WaitForExit(gp, 0);
-	result = 1;
-	switch(itksysProcess_GetState(gp))
-	{
-		case itksysProcess_State_Exited:
-		{
-			result = itksysProcess_GetExitValue(gp);
-		} break;
-		case itksysProcess_State_Error:
-		{
-			std::cerr<<"Error: Could not run " << args[0]<<":\n";
-			std::cerr<<itksysProcess_GetErrorString(gp)<<"\n";
-			std::cout<<"Error: Could not run " << args[0]<<":\n";
-			std::cout<<itksysProcess_GetErrorString(gp)<<"\n";
-		} break;
-		case itksysProcess_State_Exception:
-		{
-			std::cerr<<"Error: "<<args[0]<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
-			std::cout<<"Error: "<<args[0]<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
-		} break;
-		case itksysProcess_State_Starting:
-		case itksysProcess_State_Executing:
-		case itksysProcess_State_Expired:
-		case itksysProcess_State_Killed:
-		{
-		// Should not get here.
-		std::cerr<<"Unexpected ending state after running "<<args[0]<<std::endl;
-		std::cout<<"Unexpected ending state after running "<<args[0]<<std::endl;
-		} break;
-	}
-	itksysProcess_Delete(gp);  
-
-  return result;
-}
-
 int main(int argc, char * argv [])
 {
   PARSE_ARGS;
   std::cout << "Running Mask Creation Proccesses..." << std::endl;
 
 
-/*Get Environment Variable*/
-  std::vector<std::string> userPaths;
-
-#if defined(__APPLE__)
-  // on Mac, slicer does not provide a PATH variable that includes the built-in CLIs
-  // so we add it here.
-  std::string slicerHome;
-  if (itksys::SystemTools::GetEnv("SLICER_HOME", slicerHome))
-    {
-    // Slicer_CLIMODULES_BIN_DIR is defined in vtkSlicerConfigure.h which is configured in the inner-build
-    // directory of Slicer
-    std::cout<<"Additional Paths: " << slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR << std::endl ;
-    }
-
-#endif
-
-  std::string IMPath;
-  IMPath =  itksys::SystemTools::FindProgram("MaskScalarVolume", userPaths);
-  std::cout << "Path to MaskScalarVolume executable: " << IMPath << std::endl ;
-
-/*Endvironment Variable*/
+  std::string IMPath = CMFreg::FindTool("MaskScalarVolume");
 
 
   try{
@@ -175,17 +89,11 @@ int main(int argc, char * argv [])
 	args.push_back(outputVolume.c_str());
 	args.push_back(0);
 
-	Run(args,0);
-
-	typedef itk::Image<short,3> ImageType;
-	typedef itk::ImageFileReader<ImageType> ReaderType;
-	
-	ReaderType::Pointer reader = ReaderType::New();
-	
-	reader->SetFileName( outputVolume.c_str() );
-	reader->ReleaseDataFlagOn();
-	
-	reader->Update();
+	if(CMFreg::Run(args, CLPProcessInformation) != 0){
+		std::cout << "MaskScalarVolume failed" << std::endl;
+		return EXIT_FAILURE;
+	}
+	CMFreg::CheckOutputImage(outputVolume);
 	
   }
   catch(itk::ExceptionObject &excep){
@@ -51,6 +51,7 @@
 #include <vtkSlicerConfigure.h>
 
 #include "NonGrowingCLP.h"
+#include "CMFregCommon.h"
 
 //#################################
 
@@ -74,77 +75,9 @@
 
 // #include "itkOrientedImage.h"
 #include "itkImageFileReader.h"
+#include "CMFregRegistration.h"
 //#include "itkPluginUtilities.h"
 
-int Run(std::vector<const char*> args, bool TimeOn)
-{		
-	cout << "Entered in the Run" << std::endl;
-	//itk sys parameters
-	int length;
-	time_t start,end;
-	time (&start);
-
-	double timeout = 0.05;
-	int result;
-	char* dataitk = NULL;
-
-	itksysProcess* gp = itksysProcess_New();
-	itksysProcess_SetCommand(gp, &*args.begin());
-	itksysProcess_SetOption(gp,itksysProcess_Option_HideWindow,1);
-	itksysProcess_Execute(gp);
-	cout << "Executed Process gp " << std::endl;
-	while(int Value = itksysProcess_WaitForData(gp,&dataitk,&length,&timeout)) // wait for 1s
-	{
-		if ( ((Value == itksysProcess_Pipe_STDOUT) || (Value == itksysProcess_Pipe_STDERR)) && dataitk[0]=='D' )
-		{
-			std::stringstream st;
-			for(int i=0;i<length;i++) 	
-			{
-				st<<dataitk[i];
-			}
-			std::string dim=st.str();
-		}
-			if(TimeOn){
-				time (&end);
-				cout<<"(processing since "<<difftime (end,start)<<" seconds) \r";
-				timeout = 0.05; 
-			}  	
-	}
-	itksysProcess_WaitForExit(gp, 0);
-	result = 1;
-	switch(itksysProcess_GetState(gp))
-	{
-		case itksysProcess_State_Exited:
-		{
-			result = itksysProcess_GetExitValue(gp);
-		} break;
-		case itksysProcess_State_Error:
-		{
-			std::cerr<<"Error: Could not run " << args[0]<<":\n";
-			std::cerr<<itksysProcess_GetErrorString(gp)<<"\n";
-			std::cout<<"Error: Could not run " << args[0]<<":\n";
-			std::cout<<itksysProcess_GetErrorString(gp)<<"\n";
-		} break;
-		case itksysProcess_State_Exception:
-		{
-			std::cerr<<"Error: "<<args[0]<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
-			std::cout<<"Error: "<<args[0]<<" terminated with an exception: "<<itksysProcess_GetExceptionString(gp)<<"\n";
-		} break;
-		case itksysProcess_State_Starting:
-		case itksysProcess_State_Executing:
-		case itksysProcess_State_Expired:
-		case itksysProcess_State_Killed:
-		{
-		// Should not get here.
-		std::cerr<<"Unexpected ending state after running "<<args[0]<<std::endl;
-		std::cout<<"Unexpected ending state after running "<<args[0]<<std::endl;
-		} break;
-	}
-	itksysProcess_Delete(gp);  
-
-  return result;
-}
-
 int main(int argc, char * argv [])
 {
   PARSE_ARGS;
@@ -155,34 +88,33 @@ int main(int argc, char * argv [])
 //  return ModuleEntryPoint(argc, argv);
   
   
-/*Get Environment Variable*/
-  std::vector<std::string> userPaths;
-
-#if defined(__APPLE__)
-  // on Mac, slicer does not provide a PATH variable that includes the built-in CLIs
-  // so we add it here.
-  std::string slicerHome;
-  if (itksys::SystemTools::GetEnv("SLICER_HOME", slicerHome))
-    {
-    // Slicer_CLIMODULES_BIN_DIR is defined in vtkSlicerConfigure.h which is configured in the inner-build
-    // directory of Slicer
-    userPaths.push_back( slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR  ) ;
-    std::cout<<"Additional Paths: " << slicerHome + "/" + Slicer_CLIMODULES_BIN_DIR << std::endl ;
-    }
-
-#endif
-
-
-  std::string BFPath;
-  BFPath = itksys::SystemTools::FindProgram("BRAINSFit", userPaths); //getenv("SLICER");
-  std::cout << "Path to BRAINSFit executable: " << BFPath << std::endl ;
-
-  std::string RV2Path;
-  RV2Path = itksys::SystemTools::FindProgram("ResampleScalarVectorDWIVolume", userPaths); //getenv("SLICER");
-  std::cout << "Path to ResampleScalarVectorDWIVolume executable: " << RV2Path << std::endl ;
+  std::string BFPath = CMFreg::FindTool("BRAINSFit");
+  std::string RV2Path = CMFreg::FindTool("ResampleScalarVectorDWIVolume");
 
   try{
-	if (!movingMaskVolume.empty() && !fixedMaskVolume.empty()){
+	if (useMultiResolution){
+		// the rigid registration runs in this process, on the levels of the pyramid
+		std::vector<CMFreg::RegistrationLevel> levels =
+			CMFreg::MakeLevels(shrinkFactors, smoothingSigmas, levelIterations, levelMinimumStepLengths);
+		itk::ImageIOBase::IOComponentType componentType;
+		CMFreg::FloatImageType::Pointer fixed = CMFreg::ReadImage<CMFreg::FloatImageType>(fixedVolume, componentType);
+		CMFreg::FloatImageType::Pointer moving = CMFreg::ReadImage<CMFreg::FloatImageType>(movingVolume, componentType);
+		CMFreg::MaskType::Pointer fixedMask;
+		CMFreg::MaskType::Pointer movingMask;
+		if (!fixedMaskVolume.empty()){
+			fixedMask = CMFreg::ReadMask(fixedMaskVolume);
+		}
+		if (!movingMaskVolume.empty()){
+			movingMask = CMFreg::ReadMask(movingMaskVolume);
+		}
+		itk::VersorRigid3DTransform<double>::Pointer rigid =
+			CMFreg::CenteredIdentity< itk::VersorRigid3DTransform<double> >(fixed);
+		CMFreg::RegisterStage(fixed.GetPointer(), moving.GetPointer(), fixedMask.GetPointer(), movingMask.GetPointer(),
+			rigid.GetPointer(), levels, CMFreg::MakeSampling(samplingStrategy, samplingPercentage, samplingSeed));
+		CMFreg::WriteTransform(rigid, transformPath);
+	}
+	else if (!movingMaskVolume.empty() && !fixedMaskVolume.empty()){
+		std::vector<std::string> samplingArgs = CMFreg::BRAINSFitSamplingArguments(samplingStrategy, samplingPercentage, samplingSeed);
 		std::vector<const char*> args;
 
 		args.push_back(BFPath.c_str());
@@ -191,6 +123,10 @@ int main(int argc, char * argv [])
 		args.push_back("--minimumStepLength 0.000001");
 		args.push_back("--numberOfIterations 15000");
 		args.push_back("--maskProcessingMode ROI");
+		for(unsigned int i=0;i<samplingArgs.size();i++)
+		{
+			args.push_back(samplingArgs[i].c_str());
+		}
 		args.push_back("--useRigid");
 		args.push_back("--movingBinaryVolume");
 		args.push_back(movingMaskVolume.c_str());
@@ -202,9 +138,16 @@ int main(int argc, char * argv [])
 		args.push_back(fixedVolume.c_str());
 		args.push_back(0);
 
-		Run(args,0);
+		if(CMFreg::Run(args, CLPProcessInformation, timeout) != 0){
+			std::cout << "BRAINSFit failed" << std::endl;
+			return EXIT_FAILURE;
+		}
 	}
 
+	// the two resamplings only depend on the transform, they run at the same time
+	std::vector< std::vector<const char*> > resampleJobs;
+	std::vector<std::string> resampleNames;
+
 	if(!segmentationOut.empty()){
 		std::vector<const char*> args2;
 		
@@ -216,7 +159,8 @@ int main(int argc, char * argv [])
 		args2.push_back(segmentationOut.c_str());
 		args2.push_back(0);
 			
-		Run(args2,0);
+		resampleJobs.push_back(args2);
+		resampleNames.push_back("Resampling of the segmentation");
 	}	
 	
 	if(!outputVolume.empty()){
@@ -230,17 +174,28 @@ int main(int argc, char * argv [])
 		args3.push_back(outputVolume.c_str());
 		args3.push_back(0);
 		
-		Run(args3,0);
+		resampleJobs.push_back(args3);
+		resampleNames.push_back("Resampling of the moving volume");
 	}
 
-  	typedef itk::Image<short,3> ImageType;
-  	typedef itk::ImageFileReader<ImageType> ReaderType;
-
-	ReaderType::Pointer reader = ReaderType::New();
+	// each resampling gets its share of the threads
+	std::stringstream numberOfThreads;
+	numberOfThreads << CMFreg::NumberOfThreadsPerJob(resampleJobs.size());
+	std::string numberOfThreadsString = numberOfThreads.str();
+	for(unsigned int i=0;i<resampleJobs.size();i++)
+	{
+		// before the terminating null pointer
+		resampleJobs[i].insert(resampleJobs[i].end() - 1, "--number_of_thread");
+		resampleJobs[i].insert(resampleJobs[i].end() - 1, numberOfThreadsString.c_str());
+	}
 
-	reader->SetFileName( segmentationOut.c_str() );
-	reader->ReleaseDataFlagOn();
-	reader->Update();
+	if(CMFreg::RunConcurrently(resampleJobs, resampleNames, CLPProcessInformation, timeout) != 0){
+		std::cout << "ResampleScalarVectorDWIVolume failed" << std::endl;
+		return EXIT_FAILURE;
+	}
+	if(!segmentationOut.empty()){
+		CMFreg::CheckOutputImage(segmentationOut);
+	}
   }
   catch(itk::ExceptionObject &excep){
 	std::cout << excep << ":exception caught!" << std::endl;
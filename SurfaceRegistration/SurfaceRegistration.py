@@ -1,13 +1,15 @@
 import os
-from collections import defaultdict
 
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
 import numpy
 import json
 
+from vtk.util import numpy_support
+
+import SurfaceRegistrationLib
+
 
 #
 # SurfaceRegistration
@@ -123,6 +125,9 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.landmarkTransformTypeButtonsRigidBody = self.logic.get("landmarkTransformTypeButtonsRigidBody")
         self.landmarkTransformTypeButtonsSimilarity = self.logic.get("landmarkTransformTypeButtonsSimilarity")
         self.landmarkTransformTypeButtonsAffine = self.logic.get("landmarkTransformTypeButtonsAffine")
+        self.landmarkTransformTypeButtonsPointToPlane = self.logic.get("landmarkTransformTypeButtonsPointToPlane")
+        self.icpEngineButtonsVTK = self.logic.get("icpEngineButtonsVTK")
+        self.icpEngineButtonsNumPy = self.logic.get("icpEngineButtonsNumPy")
         self.meanDistanceTypeBox = self.logic.get("meanDistanceTypeBox")
         self.meanDistanceTypeButtonsRootMeanSquare = self.logic.get("meanDistanceTypeButtonsRootMeanSquare")
         self.meanDistanceTypeButtonsAbsoluteValue = self.logic.get("meanDistanceTypeButtonsAbsoluteValue")
@@ -131,6 +136,12 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.numberOfIterations = self.logic.get("numberOfIterations")
         self.numberOfLandmarks = self.logic.get("numberOfLandmarks")
         self.maxDistance = self.logic.get("maxDistance")
+        self.numberOfLevels = self.logic.get("numberOfLevels")
+        self.iterationsPerLevel = self.logic.get("iterationsPerLevel")
+        self.numberOfStarts = self.logic.get("numberOfStarts")
+        self.numberOfRefinedStarts = self.logic.get("numberOfRefinedStarts")
+        self.trimPercentage = self.logic.get("trimPercentage")
+        self.tracePath = self.logic.get("tracePath")
         self.computeButton = self.logic.get("computeButton")
         self.undoButton = self.logic.get("undoButton")
         self.applyButton = self.logic.get("applyButton")
@@ -168,6 +179,9 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.landmarkTransformTypeButtonsRigidBody.connect("clicked()", lambda:self.onLandmarkTrandformType("RigidBody"))
         self.landmarkTransformTypeButtonsSimilarity.connect("clicked()", lambda:self.onLandmarkTrandformType("Similarity"))
         self.landmarkTransformTypeButtonsAffine.connect("clicked()", lambda:self.onLandmarkTrandformType("Affine"))
+        self.landmarkTransformTypeButtonsPointToPlane.connect("clicked()", lambda:self.onLandmarkTrandformType("PointToPlane"))
+        self.icpEngineButtonsVTK.connect("clicked()", lambda:self.onICPEngine("VTK"))
+        self.icpEngineButtonsNumPy.connect("clicked()", lambda:self.onICPEngine("NumPy"))
         self.meanDistanceTypeButtonsRootMeanSquare.connect("clicked()",lambda:self.onMeanDistanceType("Root Mean Square"))
         self.meanDistanceTypeButtonsAbsoluteValue.connect("clicked()",lambda:self.onMeanDistanceType("Absolute Value"))
         self.startMatchingCentroids.connect("toggled(bool)", self.onMatchCentroidsLinearActive)
@@ -175,8 +189,17 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.numberOfIterations.connect('valueChanged(double)', self.numberOfIterationsValueChanged)
         self.numberOfLandmarks.connect('valueChanged(double)', self.numberOfLandmarksValueChanged)
         self.maxDistance.connect('valueChanged(double)', self.maxDistanceValueChanged)
+        self.numberOfLevels.connect('valueChanged(double)', self.onNumberOfLevelsChanged)
+        self.iterationsPerLevel.connect('valueChanged(double)', self.onIterationsPerLevelChanged)
+        self.numberOfStarts.connect('valueChanged(double)', self.onNumberOfStartsChanged)
+        self.numberOfRefinedStarts.connect('valueChanged(double)', self.onNumberOfRefinedStartsChanged)
+        self.trimPercentage.connect('valueChanged(double)', self.onTrimPercentageChanged)
+        self.tracePath.connect('currentPathChanged(QString)', self.onTracePathChanged)
 
         self.sceneCloseTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onCloseScene)
+        self.nodeRemovedTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.logic.onNodeRemovedEvent)
+        self.sceneSaveTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.StartSaveEvent, self.logic.onSceneStartSave)
+        self.sceneImportTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndImportEvent, self.logic.onSceneEndImport)
 
         # ------------------------------------------------------------------------------------
         #                                   INITIALISATION
@@ -185,10 +208,17 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.numberOfIterationsValueChanged = 2000
         self.maxDistanceValueChanged = 0.001
         self.numberOfLandmarksValueChanged = 200
+        self.numberOfLevelsValue = 1
+        self.iterationsPerLevelValue = 100
+        self.numberOfStartsValue = 1
+        self.numberOfRefinedStartsValue = 3
+        self.trimFractionValue = 0.0
+        self.tracePathValue = None
         self.checkMeanDistanceActive = False
         self.matchCentroidsLinearActive = False
         self.onMeanDistanceType("Absolute Value")
         self.onLandmarkTrandformType("RigidBody")
+        self.onICPEngine("VTK")
         self.onSurfaceRegistration()
         self.UpdateInterface()
 
@@ -215,13 +245,11 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         end = list.GetNumberOfItems()
         for i in range(0,end):
             fidList = list.GetItemAsObject(i)
-            landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            if landmarkDescription:
-                for n in range(fidList.GetNumberOfMarkups()):
-                    markupID = fidList.GetNthMarkupID(n)
-                    markupLabel = fidList.GetNthMarkupLabel(n)
-                    landmarkDescription[markupID]["landmarkLabel"] = markupLabel
-                fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+            self.logic.updateLandmarkLabels(fidList)
+
+    def exit(self):
+        # the landmarks are written in the fiducial lists when leaving the module
+        self.logic.saveLandmarkRegistries()
 
     def onCloseScene(self, obj, event):
 
@@ -237,6 +265,11 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.logic.selectedFidList = None
         self.logic.fixedFidList = None
         self.logic.movingFidList = None
+        self.logic.meshCache.clear()
+        self.logic.roiArrays.clear()
+        self.logic.hardenModelStates.clear()
+        self.logic.connectedFidListIDs = None
+        self.logic.landmarkRegistries.clear()
         self.inputFixedModelSelector.setCurrentNode(None)
         self.inputMovingModelSelector.setCurrentNode(None)
         self.inputFixedLandmarksSelector.setCurrentNode(None)
@@ -264,11 +297,11 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
 
         if activeInput:
             # Update values on widgets.
-            landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            if landmarkDescription and selectedFidReflID:
-                activeDictLandmarkValue = landmarkDescription[selectedFidReflID]
-                self.radiusDefinitionWidget.value = activeDictLandmarkValue["ROIradius"]
-                if activeDictLandmarkValue["projection"]["isProjected"]:
+            landmarkRegistry = self.logic.getLandmarkRegistry(fidList)
+            if landmarkRegistry and selectedFidReflID:
+                activeLandmarkRecord = landmarkRegistry[selectedFidReflID]
+                self.radiusDefinitionWidget.value = activeLandmarkRecord.ROIradius
+                if activeLandmarkRecord.isProjected:
                     self.surfaceDeplacementCheckBox.setChecked(True)
                 else:
                     self.surfaceDeplacementCheckBox.setChecked(False)
@@ -318,6 +351,7 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
 
     # Registration
     def onComputeButton(self):
+        self.logic.processPendingLandmarks()
         if not self.outputTransformSelector.currentNode():
             self.logic.warningMessage("Please select an output transform")
             return
@@ -344,6 +378,7 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         self.outputTransformSelector.setCurrentNode(None)
         movingModel = self.inputMovingModelSelector.currentNode()
         self.logic.displayResult(movingModel, outputTrans)
+        self.logic.computeSurfaceDistances(self.logic.fixedModel, movingModel)
         self.undoButton.enabled = True
         self.fixedModel.setChecked(True)
         self.onFixedModelRadio()
@@ -354,7 +389,7 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
             return False
         fixedLandmarks = self.logic.fixedFidList
         movingLandmarks = self.logic.movingFidList
-        saveTransform = outputTrans.GetID()
+        saveTransform = outputTrans
         if self.fiducialTransformTypeButtonsRigid.isChecked():
             tranformType = "Rigid"
         elif self.fiducialTransformTypeButtonsTranslation.isChecked():
@@ -376,8 +411,8 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         print("-------surface registration--------")
         fixedModel = self.logic.fixedModel
         movingModel = self.logic.movingModel
-        fixedHarden = slicer.app.mrmlScene().GetNodeByID(fixedModel.GetAttribute("hardenModelID"))
-        movingHarden = slicer.app.mrmlScene().GetNodeByID(movingModel.GetAttribute("hardenModelID"))
+        fixedHarden = self.logic.getHardenModel(fixedModel)
+        movingHarden = self.logic.getHardenModel(movingModel)
         fixed = fixedHarden.GetPolyData()
         moving = movingHarden.GetPolyData()
         meanDistanceType = self.meanDistanceType
@@ -387,10 +422,19 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         numberOfIterations = self.numberOfIterationsValueChanged
         matchCentroids = self.matchCentroidsLinearActive
         checkMeanDistance = self.checkMeanDistanceActive
+        icpEngine = self.icpEngine
+        numberOfLevels = self.numberOfLevelsValue
+        iterationsPerLevel = self.iterationsPerLevelValue
+        numberOfStarts = self.numberOfStartsValue
+        numberOfRefinedStarts = self.numberOfRefinedStartsValue
+        trimFraction = self.trimFractionValue
+        tracePath = self.tracePathValue
         self.logic.runICP(fixed, moving, outputTrans,
                           meanDistanceType, landmarkTransformType,
                           numberOfLandmarks, maxDistance, numberOfIterations,
-                          matchCentroids, checkMeanDistance)
+                          matchCentroids, checkMeanDistance, icpEngine,
+                          numberOfLevels, iterationsPerLevel, numberOfStarts, numberOfRefinedStarts,
+                          tracePath=tracePath, trimFraction=trimFraction)
 
     def applyROIRegistration(self, outputTrans):
         print("-------ROI Registration---------")
@@ -403,10 +447,19 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
         numberOfIterations = self.numberOfIterationsValueChanged
         matchCentroids = self.matchCentroidsLinearActive
         checkMeanDistance = self.checkMeanDistanceActive
+        icpEngine = self.icpEngine
+        numberOfLevels = self.numberOfLevelsValue
+        iterationsPerLevel = self.iterationsPerLevelValue
+        numberOfStarts = self.numberOfStartsValue
+        numberOfRefinedStarts = self.numberOfRefinedStartsValue
+        trimFraction = self.trimFractionValue
+        tracePath = self.tracePathValue
         self.logic.runICP(fixedROIPolydata, movingROIPolydata, outputTrans,
                           meanDistanceType, landmarkTransformType,
                           numberOfLandmarks, maxDistance, numberOfIterations,
-                          matchCentroids, checkMeanDistance)
+                          matchCentroids, checkMeanDistance, icpEngine,
+                          numberOfLevels, iterationsPerLevel, numberOfStarts, numberOfRefinedStarts,
+                          tracePath=tracePath, trimFraction=trimFraction)
 
     def onUndoButton(self):
         print("---------undo-------------")
@@ -456,6 +509,8 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
 
     def onFixedLandmarksChanged(self):
         if self.inputFixedModelSelector.currentNode():
+            if self.logic.fixedFidList != self.inputFixedLandmarksSelector.currentNode():
+                self.logic.saveLandmarkRegistry(self.logic.fixedFidList)
             self.logic.fixedFidList = self.inputFixedLandmarksSelector.currentNode()
             self.logic.selectedFidList = self.inputFixedLandmarksSelector.currentNode()
             self.logic.selectedModel = self.inputFixedModelSelector.currentNode()
@@ -471,6 +526,8 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
 
     def onMovingLandmarksCganged(self):
         if self.inputMovingModelSelector.currentNode():
+            if self.logic.movingFidList != self.inputMovingLandmarksSelector.currentNode():
+                self.logic.saveLandmarkRegistry(self.logic.movingFidList)
             self.logic.movingFidList = self.inputMovingLandmarksSelector.currentNode()
             self.logic.selectedFidList = self.inputMovingLandmarksSelector.currentNode()
             self.logic.selectedModel = self.inputMovingModelSelector.currentNode()
@@ -537,17 +594,18 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
             return
         selectedFidReflID = self.logic.findIDFromLabel(fidList, self.landmarkComboBox.currentText)
         isOnSurface = self.surfaceDeplacementCheckBox.isChecked()
-        landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        activeLandmarkRecord = self.logic.getLandmarkRegistry(fidList).get(selectedFidReflID)
+        if not activeLandmarkRecord:
+            return
         if isOnSurface:
-            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-            landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = True
-            landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] =\
+            hardenModel = self.logic.getHardenModel(fidList)
+            activeLandmarkRecord.isProjected = True
+            activeLandmarkRecord.closestPointIndex = \
                 self.logic.projectOnSurface(hardenModel, fidList, selectedFidReflID)
         else:
-            landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = False
-            landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] = None
-            landmarkDescription[selectedFidReflID]["ROIradius"] = 0
-        fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+            activeLandmarkRecord.isProjected = False
+            activeLandmarkRecord.closestPointIndex = None
+            activeLandmarkRecord.ROIradius = 0
 
     def onLandmarkComboBoxChanged(self):
         print("-------- ComboBox change --------")
@@ -560,17 +618,15 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
             return
         selectedFidReflID = self.logic.findIDFromLabel(fidList, self.landmarkComboBox.currentText)
         if selectedFidReflID:
-            landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            activeLandmarkState = landmarkDescription[selectedFidReflID]
-            activeLandmarkState["ROIradius"] = self.radiusDefinitionWidget.value
-            if not activeLandmarkState["projection"]["isProjected"]:
+            activeLandmarkRecord = self.logic.getLandmarkRegistry(fidList)[selectedFidReflID]
+            activeLandmarkRecord.ROIradius = self.radiusDefinitionWidget.value
+            if not activeLandmarkRecord.isProjected:
                 self.surfaceDeplacementCheckBox.setChecked(True)
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-                landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = True
-                landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] =\
+                hardenModel = self.logic.getHardenModel(fidList)
+                activeLandmarkRecord.isProjected = True
+                activeLandmarkRecord.closestPointIndex = \
                     self.logic.projectOnSurface(hardenModel, fidList, selectedFidReflID)
-            fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
-            self.logic.findROI(fidList)
+            self.logic.updateROI(fidList)
 
     def onCleanButton(self):
         messageBox = ctk.ctkMessageBox()
@@ -610,10 +666,38 @@ class SurfaceRegistrationWidget(ScriptedLoadableModuleWidget):
     def numberOfLandmarksValueChanged(self, newValue2):
         self.numberOfLandmarksValueChanged = int(newValue2)
 
+    def onNumberOfLevelsChanged(self, newValue):
+        """number of resolution levels of the ICP pyramid (1: full resolution only)"""
+        self.numberOfLevelsValue = int(newValue)
+
+    def onIterationsPerLevelChanged(self, newValue):
+        self.iterationsPerLevelValue = int(newValue)
+
+    def onNumberOfStartsChanged(self, newValue):
+        """number of initial rotations of the multi-start ICP (1: single start)"""
+        self.numberOfStartsValue = int(newValue)
+        # every start matches the centroids
+        self.startMatchingCentroids.setEnabled(self.numberOfStartsValue == 1)
+
+    def onNumberOfRefinedStartsChanged(self, newValue):
+        self.numberOfRefinedStartsValue = int(newValue)
+
+    def onTrimPercentageChanged(self, newValue):
+        """percentage of the pairs with the largest distances left out of each ICP iteration"""
+        self.trimFractionValue = newValue / 100.0
+
+    def onTracePathChanged(self, newPath):
+        """JSON file of the trace of the ICP iterations (none if empty)"""
+        self.tracePathValue = newPath or None
+
     def onLandmarkTrandformType(self, landmarkTransformType):
         """Pick which landmark transform"""
         self.LandmarkTransformType = landmarkTransformType
 
+    def onICPEngine(self, icpEngine):
+        """Pick which ICP implementation (vtk or numpy with a KD-tree)"""
+        self.icpEngine = icpEngine
+
     def onMeanDistanceType(self, meanDistanceType):
         """Pick which distance mode"""
         self.meanDistanceType = meanDistanceType
@@ -638,6 +722,29 @@ class SurfaceRegistrationLogic():
         self.fixedFidList = None
         self.movingFidList = None
         self.interface = interface
+        # structures computed on the harden polydata (point locator...), keyed by harden model ID
+        self.meshCache = dict()
+        # ROI arrays of the models: numpy buffers shared with vtk, keyed by (model ID, array name)
+        self.roiArrays = dict()
+        # transform state and point buffers of the harden models, keyed by harden model ID
+        self.hardenModelStates = dict()
+        self.lastICPTrace = None
+        self.lastSurfaceDistanceMetrics = None
+        # ICP results keyed by the content of the polydata and the parameters
+        self.registrationCache = SurfaceRegistrationLib.RegistrationCache()
+        # IDs of the fiducial lists connected to each model, keyed by model ID. None until it is needed.
+        self.connectedFidListIDs = None
+        # landmark records of the fiducial lists, keyed by fiducial list ID. They are only written
+        # in the landmarkDescription attribute when the scene is saved or the list is disconnected.
+        self.landmarkRegistries = dict()
+        # landmarks moved since the last update, keyed by (fiducial list ID, markup ID). Only their
+        # latest position is processed, on the next timeout of the timer.
+        self.pendingLandmarks = dict()
+        self.isProcessingLandmarks = False
+        self.landmarkUpdateTimer = qt.QTimer()
+        self.landmarkUpdateTimer.setSingleShot(True)
+        self.landmarkUpdateTimer.setInterval(16)
+        self.landmarkUpdateTimer.connect('timeout()', self.processPendingLandmarks)
 
     def get(self, objectName):
         return self.findWidget(self.interface.widget, objectName)
@@ -665,8 +772,10 @@ class SurfaceRegistrationLogic():
         selectedFidReflID = self.findIDFromLabel(active,landmarkLabel)
         for i in range(0,end):
             fidList = list.GetItemAsObject(i)
-            landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            for key in landmarkDescription.keys():
+            landmarkRegistry = self.getLandmarkRegistry(fidList)
+            if not landmarkRegistry:
+                continue
+            for key in landmarkRegistry:
                 markupsIndex = fidList.GetNthControlPointIndexByID(key)
                 if key != selectedFidReflID:
                     fidList.SetNthMarkupLocked(markupsIndex, True)
@@ -678,90 +787,325 @@ class SurfaceRegistrationLogic():
             displayNode.SetScalarVisibility(True)
 
     def getROIPolydata(self, inputFidList):
-        hardenInputModel = slicer.app.mrmlScene().GetNodeByID(inputFidList.GetAttribute("hardenModelID"))
-        hardenInputPolydata = hardenInputModel.GetPolyData()
-        markupID = inputFidList.GetNthMarkupID(0)
-        landmarkDescription = self.decodeJSON(inputFidList.GetAttribute("landmarkDescription"))
-        activeLandmarkState = landmarkDescription[markupID]
-        inputROIPointListID = self.findROI(inputFidList)
-        nbOfPoints = inputROIPointListID.GetNumberOfIds()
-        ids = vtk.vtkIdTypeArray()
-        ids.SetNumberOfComponents(1)
-        for i in range(0, nbOfPoints):
-            ids.InsertNextValue(inputROIPointListID.GetId(i))
-        selectionNode = vtk.vtkSelectionNode()
-        selectionNode.SetFieldType(vtk.vtkSelectionNode.POINT)
-        selectionNode.SetContentType(vtk.vtkSelectionNode.INDICES)
-        selectionNode.SetSelectionList(ids)
-        selectionNode.GetProperties().Set(vtk.vtkSelectionNode.CONTAINING_CELLS(), 1)
-        selection = vtk.vtkSelection()
-        selection.AddNode(selectionNode)
-        extractSelection = vtk.vtkExtractSelection()
-        extractSelection.SetInputData(0, hardenInputPolydata)
-        extractSelection.SetInputData(1, selection)
-        extractSelection.Update()
-        geometryFilter = vtk.vtkGeometryFilter()
-        geometryFilter.SetInputData(extractSelection.GetOutput())
-        geometryFilter.Update()
-        inputROIPolydata = geometryFilter.GetOutput()
-        return inputROIPolydata
+        hardenInputModel = self.getHardenModel(inputFidList)
+        roiPointIds = numpy.flatnonzero(self.updateROI(inputFidList))
+        return SurfaceRegistrationLib.extractROIPolyData(hardenInputModel.GetPolyData(), roiPointIds)
 
     def runFiducialRegistration(self, fixedLandmarks, movingLandmarks,
                                 saveTransform, tranformType):
-        parameters = {}
-        parameters["fixedLandmarks"] = fixedLandmarks
-        parameters["movingLandmarks"] = movingLandmarks
-        parameters["saveTransform"] = saveTransform
-        parameters["transformType"] = tranformType
-        fiducialRegistration = slicer.modules.fiducialregistration
-        slicer.cli.run(fiducialRegistration, None, parameters, wait_for_completion=True)
+        """Least square "Translation", "Rigid" or "Similarity" registration of the moving landmarks on the fixed
+        ones, solved in closed form. The matrix is written in saveTransform (a transform node or its ID).
+        Return the root mean square distance between the registered landmarks."""
+        if isinstance(saveTransform, str):
+            saveTransform = slicer.mrmlScene.GetNodeByID(saveTransform)
+        fixedPoints = slicer.util.arrayFromMarkupsControlPoints(fixedLandmarks)
+        movingPoints = slicer.util.arrayFromMarkupsControlPoints(movingLandmarks)
+        matrix, rmsError = SurfaceRegistrationLib.registerFiducials(fixedPoints, movingPoints, tranformType)
+        saveTransform.SetMatrixTransformToParent(SurfaceRegistrationLib.matrixToVTK(matrix))
+        print("Fiducial registration RMS error:", rmsError)
+        return rmsError
 
     def runICP(self, fixed, moving, outputTrans, meanDistanceType,
                landmarkTransformType, numberOfLandmarks, maxDistance,
-               numberOfIterations, matchCentroids, checkMeanDistance):
-        """Run the actual algorithm"""
-        icp = vtk.vtkIterativeClosestPointTransform()
-        icp.SetSource(moving)
-        icp.SetTarget(fixed)
-        if landmarkTransformType == "RigidBody":
-            icp.GetLandmarkTransform().SetModeToRigidBody()
-        elif landmarkTransformType == "Similarity":
-            icp.GetLandmarkTransform().SetModeToSimilarity()
-        elif landmarkTransformType == "Affine":
-            icp.GetLandmarkTransform().SetModeToAffine()
-        if meanDistanceType == "Root Mean Square":
-            icp.SetMeanDistanceModeToRMS()
-        elif meanDistanceType == "Absolute Value":
-            icp.SetMeanDistanceModeToAbsoluteValue()
-        icp.SetMaximumNumberOfIterations(numberOfIterations)
-        icp.SetMaximumMeanDistance(maxDistance)
-        icp.SetMaximumNumberOfLandmarks(numberOfLandmarks)
-        icp.SetCheckMeanDistance(int(checkMeanDistance))
-        icp.SetStartByMatchingCentroids(int(matchCentroids))
-        icp.Update()
-        outputMatrix = vtk.vtkMatrix4x4()
-        icp.GetMatrix(outputMatrix)
+               numberOfIterations, matchCentroids, checkMeanDistance, icpEngine="VTK",
+               numberOfLevels=1, iterationsPerLevel=100, numberOfStarts=1, numberOfRefinedStarts=3,
+               tracePath=None, traceMemory=False, trimFraction=0.0, useCache=True):
+        """Run the actual algorithm.
+        Return the ICPTrace of the registration, also kept in lastICPTrace and written to tracePath if given.
+        traceMemory measures the peak memory, at the cost of a slower registration.
+        The PointToPlane transform type and the trimming of the worst pairs use the NumPy engine.
+        With useCache, the result of a previous registration of the same polydata with the same parameters
+        is reused."""
+        trace = SurfaceRegistrationLib.ICPTrace({"meanDistanceType": meanDistanceType,
+                                                 "landmarkTransformType": landmarkTransformType,
+                                                 "numberOfLandmarks": numberOfLandmarks,
+                                                 "maxDistance": maxDistance,
+                                                 "numberOfIterations": numberOfIterations,
+                                                 "matchCentroids": bool(matchCentroids),
+                                                 "checkMeanDistance": bool(checkMeanDistance),
+                                                 "icpEngine": icpEngine,
+                                                 "numberOfLevels": numberOfLevels,
+                                                 "iterationsPerLevel": iterationsPerLevel,
+                                                 "numberOfStarts": numberOfStarts,
+                                                 "numberOfRefinedStarts": numberOfRefinedStarts,
+                                                 "trimFraction": trimFraction,
+                                                 "numberOfFixedPoints": fixed.GetNumberOfPoints(),
+                                                 "numberOfMovingPoints": moving.GetNumberOfPoints()},
+                                                traceMemory)
+        cachedResult = None
+        if useCache:
+            cacheKey = self.registrationCache.key(fixed, moving, trace.parameters)
+            cachedResult = self.registrationCache.get(cacheKey)
+        if cachedResult is not None:
+            matrix, trace = cachedResult
+            outputMatrix = SurfaceRegistrationLib.matrixToVTK(matrix)
+            print("ICP result found in the cache")
+        else:
+            trace.start()
+            if numberOfStarts > 1:
+                outputMatrix = self.runMultiStartICP(fixed, moving, meanDistanceType,
+                                                     landmarkTransformType, numberOfLandmarks, maxDistance,
+                                                     numberOfIterations, checkMeanDistance, icpEngine,
+                                                     numberOfStarts, numberOfRefinedStarts, numberOfLevels,
+                                                     iterationsPerLevel, trace, trimFraction)
+            elif numberOfLevels > 1:
+                outputMatrix = self.runMultiResolutionICP(fixed, moving, meanDistanceType,
+                                                          landmarkTransformType, numberOfLandmarks, maxDistance,
+                                                          numberOfIterations, matchCentroids, checkMeanDistance,
+                                                          icpEngine, numberOfLevels, iterationsPerLevel, trace,
+                                                          trimFraction)
+            else:
+                outputMatrix = self.computeICPMatrix(fixed, moving, meanDistanceType,
+                                                     landmarkTransformType, numberOfLandmarks, maxDistance,
+                                                     numberOfIterations, matchCentroids, checkMeanDistance,
+                                                     icpEngine, trace, trimFraction)
+            trace.stop()
+            if useCache:
+                self.registrationCache.put(cacheKey, SurfaceRegistrationLib.matrixFromVTK(outputMatrix), trace)
         outputTrans.SetMatrixTransformToParent(outputMatrix)
-        return
+        print(trace.summary())
+        self.lastICPTrace = trace
+        if tracePath:
+            trace.writeJSON(tracePath)
+        return trace
+
+    def computeICPMatrix(self, fixed, moving, meanDistanceType,
+                         landmarkTransformType, numberOfLandmarks, maxDistance,
+                         numberOfIterations, matchCentroids, checkMeanDistance, icpEngine, trace=None,
+                         trimFraction=0.0):
+        """Return the vtkMatrix4x4 registering moving on fixed with the selected ICP engine"""
+        # vtkIterativeClosestPointTransform has neither point to plane distances nor trimming
+        if icpEngine == "NumPy" or landmarkTransformType == "PointToPlane" or trimFraction > 0:
+            return self.runNumpyICP(fixed, moving, meanDistanceType,
+                                    landmarkTransformType, numberOfLandmarks, maxDistance,
+                                    numberOfIterations, matchCentroids, checkMeanDistance, trace, trimFraction)
+        result = SurfaceRegistrationLib.runVTKICP(fixed, moving, meanDistanceType,
+                                                  landmarkTransformType, numberOfLandmarks, maxDistance,
+                                                  numberOfIterations, matchCentroids, checkMeanDistance, trace)
+        return SurfaceRegistrationLib.matrixToVTK(result.matrix)
+
+    def runNumpyICP(self, fixed, moving, meanDistanceType,
+                    landmarkTransformType, numberOfLandmarks, maxDistance,
+                    numberOfIterations, matchCentroids, checkMeanDistance, trace=None, trimFraction=0.0):
+        """ICP on numpy views of the polydata points, with a KD-tree built once on the fixed points"""
+        fixedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(fixed)
+        movingPoints = SurfaceRegistrationLib.polyDataPointsAsArray(moving)
+        fixedNormals = None
+        if landmarkTransformType == "PointToPlane":
+            fixedNormals = SurfaceRegistrationLib.polyDataPointNormals(fixed)
+        result = SurfaceRegistrationLib.runICP(fixedPoints, movingPoints, meanDistanceType,
+                                               landmarkTransformType, numberOfLandmarks, maxDistance,
+                                               numberOfIterations, matchCentroids, checkMeanDistance,
+                                               trace=trace, fixedNormals=fixedNormals, trimFraction=trimFraction)
+        return SurfaceRegistrationLib.matrixToVTK(result.matrix)
+
+    def runMultiStartICP(self, fixed, moving, meanDistanceType,
+                         landmarkTransformType, numberOfLandmarks, maxDistance,
+                         numberOfIterations, checkMeanDistance, icpEngine, numberOfStarts, numberOfRefinedStarts,
+                         numberOfLevels=1, iterationsPerLevel=100, trace=None, trimFraction=0.0):
+        """ICP from several initial rotations around the centroid, keeping the lowest residual.
+        The starts always match the centroids and are tried with the NumPy engine on subsampled points.
+        The best starts are refined with icpEngine, on the levels of the pyramid if numberOfLevels > 1."""
+        fixedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(fixed)
+        movingPoints = SurfaceRegistrationLib.polyDataPointsAsArray(moving)
+        fixedNormals = None
+        if landmarkTransformType == "PointToPlane":
+            fixedNormals = SurfaceRegistrationLib.polyDataPointNormals(fixed)
+
+        def refine(startMatrix, startTrace):
+            transform = vtk.vtkTransform()
+            transform.SetMatrix(SurfaceRegistrationLib.matrixToVTK(startMatrix))
+            transformFilter = vtk.vtkTransformPolyDataFilter()
+            transformFilter.SetInputData(moving)
+            transformFilter.SetTransform(transform)
+            transformFilter.Update()
+            if startTrace is None:
+                startTrace = SurfaceRegistrationLib.ICPTrace()
+            # the start already matches the centroids
+            if numberOfLevels > 1:
+                matrix = self.runMultiResolutionICP(fixed, transformFilter.GetOutput(), meanDistanceType,
+                                                    landmarkTransformType, numberOfLandmarks, maxDistance,
+                                                    numberOfIterations, False, checkMeanDistance, icpEngine,
+                                                    numberOfLevels, iterationsPerLevel, startTrace, trimFraction)
+            else:
+                matrix = self.computeICPMatrix(fixed, transformFilter.GetOutput(), meanDistanceType,
+                                               landmarkTransformType, numberOfLandmarks, maxDistance,
+                                               numberOfIterations, False, checkMeanDistance, icpEngine,
+                                               startTrace, trimFraction)
+            return SurfaceRegistrationLib.ICPResult(SurfaceRegistrationLib.matrixFromVTK(matrix),
+                                                    startTrace.numberOfIterations, startTrace.meanDistance)
+
+        # the NumPy engine on a single level is refined in the threads of runMultiStartICP
+        result = SurfaceRegistrationLib.runMultiStartICP(fixedPoints, movingPoints, meanDistanceType,
+                                                         landmarkTransformType, numberOfLandmarks, maxDistance,
+                                                         numberOfIterations, checkMeanDistance,
+                                                         numberOfStarts, numberOfRefinedStarts, trace=trace,
+                                                         fixedNormals=fixedNormals, trimFraction=trimFraction,
+                                                         refine=None if icpEngine == "NumPy" and numberOfLevels == 1
+                                                         else refine)
+        print("Multi-start ICP:", numberOfStarts, "starts, residual", result.meanDistance)
+        return SurfaceRegistrationLib.matrixToVTK(result.matrix)
+
+    def runMultiResolutionICP(self, fixed, moving, meanDistanceType,
+                              landmarkTransformType, numberOfLandmarks, maxDistance,
+                              numberOfIterations, matchCentroids, checkMeanDistance, icpEngine,
+                              numberOfLevels, iterationsPerLevel, trace=None, trimFraction=0.0):
+        """Coarse to fine ICP: each level starts from the transform found on the coarser one.
+        The decimated levels run up to iterationsPerLevel iterations, the full resolution up to numberOfIterations."""
+        fixedLevels = self.decimationPyramid(fixed, numberOfLevels)
+        movingLevels = self.decimationPyramid(moving, numberOfLevels)
+        outputMatrix = vtk.vtkMatrix4x4()
+        totalIterations = 0
+        for level in range(numberOfLevels - 1, -1, -1):
+            transform = vtk.vtkTransform()
+            transform.SetMatrix(outputMatrix)
+            transformFilter = vtk.vtkTransformPolyDataFilter()
+            transformFilter.SetInputData(movingLevels[level])
+            transformFilter.SetTransform(transform)
+            transformFilter.Update()
+            levelTrace = SurfaceRegistrationLib.ICPTrace()
+            levelTrace.stage = "level %d" % level
+            # the centroids are only matched once, on the coarsest level
+            levelMatrix = self.computeICPMatrix(fixedLevels[level], transformFilter.GetOutput(),
+                                                meanDistanceType, landmarkTransformType, numberOfLandmarks,
+                                                maxDistance, numberOfIterations if level == 0 else iterationsPerLevel,
+                                                matchCentroids and level == numberOfLevels - 1,
+                                                checkMeanDistance, icpEngine, levelTrace, trimFraction)
+            totalIterations += levelTrace.numberOfIterations
+            if trace is not None:
+                trace.extend(levelTrace)
+                trace.setResult(totalIterations, levelTrace.meanDistance)
+            accumulatedMatrix = vtk.vtkMatrix4x4()
+            vtk.vtkMatrix4x4.Multiply4x4(levelMatrix, outputMatrix, accumulatedMatrix)
+            outputMatrix = accumulatedMatrix
+            print("ICP level", level, ":", movingLevels[level].GetNumberOfPoints(), "moving points,",
+                  fixedLevels[level].GetNumberOfPoints(), "fixed points")
+        return outputMatrix
+
+    def decimationPyramid(self, polyData, numberOfLevels):
+        """List of the polydata decimated by quadric clustering, each level having about 4 times less points"""
+        levels = [polyData]
+        numberOfPoints = polyData.GetNumberOfPoints()
+        for level in range(1, numberOfLevels):
+            # the clustered surface keeps about one point per occupied division
+            divisions = max(2, int(numpy.sqrt(numberOfPoints / (4.0 * 4 ** level))))
+            clustering = vtk.vtkQuadricClustering()
+            clustering.SetInputData(levels[-1])
+            clustering.AutoAdjustNumberOfDivisionsOff()
+            clustering.SetNumberOfDivisions(divisions, divisions, divisions)
+            clustering.Update()
+            levels.append(clustering.GetOutput())
+        return levels
 
     def createIntermediateHardenModel(self, model):
         hardenModel = slicer.mrmlScene.GetNodesByName("SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(
             slicer.app.applicationPid())).GetItemAsObject(0)
         if hardenModel is None:
             hardenModel = slicer.vtkMRMLModelNode()
-        hardenPolyData = vtk.vtkPolyData()
-        hardenPolyData.DeepCopy(model.GetPolyData())
-        hardenModel.SetAndObservePolyData(hardenPolyData)
         hardenModel.SetName(
             "SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(slicer.app.applicationPid()))
-        if model.GetParentTransformNode():
-            hardenModel.SetAndObserveTransformNodeID(model.GetParentTransformNode().GetID())
         hardenModel.HideFromEditorsOn()
-        slicer.mrmlScene.AddNode(hardenModel)
-        logic = slicer.vtkSlicerTransformLogic()
-        logic.hardenTransform(hardenModel)
+        if hardenModel.GetScene() is None:
+            slicer.mrmlScene.AddNode(hardenModel)
+        # the point buffer of a previous harden model of the same model is reused
+        hardenModelState = self.hardenModelStates.setdefault(hardenModel.GetID(), dict())
+        hardenModelState["sourceModel"] = model
+        hardenModelState["isModified"] = True
+        self.updateHardenModel(hardenModel)
+        return hardenModel
+
+    def getHardenModel(self, node):
+        """Harden model of a model, or of the model connected to a fiducial list, with up to date points"""
+        hardenModel = slicer.app.mrmlScene().GetNodeByID(node.GetAttribute("hardenModelID"))
+        if hardenModel and hardenModel.GetID() in self.hardenModelStates:
+            self.updateHardenModel(hardenModel)
         return hardenModel
 
+    def updateHardenModel(self, hardenModel):
+        """Apply the transform of the source model to its harden model, if it changed.
+
+        For linear transforms, the cells and the point data are shared with the source
+        polydata and the points are transformed in a buffer kept for the model. The
+        other transforms are hardened on a deep copy of the source polydata."""
+        hardenModelState = self.hardenModelStates[hardenModel.GetID()]
+        model = hardenModelState["sourceModel"]
+        sourcePolyData = model.GetPolyData()
+        sourcePoints = sourcePolyData.GetPoints()
+        parentTransform = model.GetParentTransformNode()
+        if (parentTransform and not parentTransform.IsTransformToWorldLinear()) or sourcePoints is None\
+                or sourcePolyData.GetPointData().GetVectors() or sourcePolyData.GetCellData().GetVectors():
+            # the copy is also rebuilt when the source geometry or one of the polydata is replaced
+            sourcePointsMTime = sourcePoints.GetMTime() if sourcePoints else None
+            if not hardenModelState["isModified"] and hardenModelState.get("copiedFrom") == \
+                    (hardenModel.GetPolyData(), sourcePolyData, sourcePoints, sourcePointsMTime):
+                return
+            hardenPolyData = vtk.vtkPolyData()
+            hardenPolyData.DeepCopy(sourcePolyData)
+            hardenModel.SetAndObservePolyData(hardenPolyData)
+            self.invalidateMeshCache(hardenModel)
+            if parentTransform:
+                hardenModel.SetAndObserveTransformNodeID(parentTransform.GetID())
+                logic = slicer.vtkSlicerTransformLogic()
+                logic.hardenTransform(hardenModel)
+            hardenModelState.clear()
+            hardenModelState["sourceModel"] = model
+            hardenModelState["isModified"] = False
+            hardenModelState["copiedFrom"] = (hardenModel.GetPolyData(), sourcePolyData, sourcePoints,
+                                              sourcePointsMTime)
+            return
+
+        # the harden polydata is rebuilt when the source geometry or one of the polydata is replaced
+        if hardenModel.GetPolyData() is None or hardenModel.GetPolyData() is not hardenModelState.get("polyData")\
+                or sourcePolyData is not hardenModelState.get("sourcePolyData")\
+                or sourcePoints is not hardenModelState.get("sourcePoints")\
+                or sourcePoints.GetMTime() != hardenModelState.get("sourcePointsMTime"):
+            hardenPolyData = vtk.vtkPolyData()
+            hardenPolyData.ShallowCopy(sourcePolyData)
+            sourceArray = SurfaceRegistrationLib.polyDataPointsAsArray(sourcePolyData)
+            pointsBuffer = numpy.empty(sourceArray.shape, dtype=sourceArray.dtype)
+            hardenPoints = vtk.vtkPoints()
+            hardenPoints.SetData(numpy_support.numpy_to_vtk(pointsBuffer, deep=0))
+            hardenPolyData.SetPoints(hardenPoints)
+            # (source normals, buffer, harden normals) of the point and cell data
+            normals = list()
+            for sourceData, hardenData in ((sourcePolyData.GetPointData(), hardenPolyData.GetPointData()),
+                                           (sourcePolyData.GetCellData(), hardenPolyData.GetCellData())):
+                sourceNormals = sourceData.GetNormals()
+                if sourceNormals:
+                    sourceNormals = numpy_support.vtk_to_numpy(sourceNormals)
+                    normalsBuffer = numpy.empty(sourceNormals.shape, dtype=sourceNormals.dtype)
+                    hardenNormals = numpy_support.numpy_to_vtk(normalsBuffer, deep=0)
+                    hardenNormals.SetName(sourceData.GetNormals().GetName())
+                    hardenData.SetNormals(hardenNormals)
+                    normals.append((sourceNormals, normalsBuffer, hardenNormals))
+            hardenModel.SetAndObservePolyData(hardenPolyData)
+            self.invalidateMeshCache(hardenModel)
+            hardenModelState.update({"polyData": hardenPolyData,
+                                     "sourcePolyData": sourcePolyData,
+                                     "sourcePoints": sourcePoints,
+                                     "sourcePointsMTime": sourcePoints.GetMTime(),
+                                     "points": (sourceArray, pointsBuffer, hardenPoints),
+                                     "normals": normals,
+                                     "matrix": None})
+        elif not hardenModelState["isModified"]:
+            return
+        hardenModelState["isModified"] = False
+
+        matrix = numpy.identity(4)
+        if parentTransform:
+            vtkMatrix = vtk.vtkMatrix4x4()
+            parentTransform.GetMatrixTransformToWorld(vtkMatrix)
+            matrix = SurfaceRegistrationLib.matrixFromVTK(vtkMatrix)
+        if hardenModelState["matrix"] is not None and numpy.array_equal(matrix, hardenModelState["matrix"]):
+            return
+        hardenModelState["matrix"] = matrix
+        sourceArray, pointsBuffer, hardenPoints = hardenModelState["points"]
+        SurfaceRegistrationLib.transformPoints(sourceArray, matrix, pointsBuffer)
+        hardenPoints.Modified()
+        for sourceNormals, normalsBuffer, hardenNormals in hardenModelState["normals"]:
+            SurfaceRegistrationLib.transformNormals(sourceNormals, matrix, normalsBuffer)
+            hardenNormals.Modified()
+
     def displayResult(self, movingModel, outputTrans):
         parentTrans = movingModel.GetParentTransformNode()
         nextParentTrans = parentTrans
@@ -801,9 +1145,14 @@ class SurfaceRegistrationLogic():
                 self.movingFidList.SetAttribute("lastTransformID",parentTrans.GetID())
 
     def applyTransforms(self, outputModel, inputModel):
-        inputHardenModel = slicer.app.mrmlScene().GetNodeByID(inputModel.GetAttribute("hardenModelID"))
+        inputHardenModel = self.getHardenModel(inputModel)
         hardenPolyData = vtk.vtkPolyData()
         hardenPolyData.DeepCopy(inputHardenModel.GetPolyData())
+        if self.fixedModel and self.getHardenModel(self.fixedModel):
+            metrics, distances = self.computeSurfaceDistances(self.fixedModel, inputModel)
+            distanceArray = numpy_support.numpy_to_vtk(distances, deep=1)
+            distanceArray.SetName("SurfaceDistance")
+            hardenPolyData.GetPointData().AddArray(distanceArray)
         outputModel.SetAndObservePolyData(hardenPolyData)
         outputModel.SetAndObserveTransformNodeID(None)
         displayNode = outputModel.GetDisplayNode()
@@ -818,30 +1167,80 @@ class SurfaceRegistrationLogic():
             displayNode.VisibilityOn()
 
     def onModelModified(self, obj, event):
-        #recompute the harden model
-        hardenModel = self.createIntermediateHardenModel(obj)
-        obj.SetAttribute("hardenModelID",hardenModel.GetID())
-        # for each fiducial list
-        list = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
-        end = list.GetNumberOfItems()
-        for i in range(0,end):
-            # If landmarks are projected on the modified model
-            fidList = list.GetItemAsObject(i)
-            if fidList.GetAttribute("connectedModelID"):
-                if fidList.GetAttribute("connectedModelID") == obj.GetID():
-                    #replace the harden model with the new one
-                    fidList.SetAttribute("hardenModelID",hardenModel.GetID())
-                    #reproject the fiducials on the new model
-                    landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-                    for n in range(fidList.GetNumberOfMarkups()):
-                        markupID = fidList.GetNthMarkupID(n)
-                        if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-                            markupsIndex = fidList.GetNthControlPointIndexByID(markupID)
-                            self.replaceLandmark(hardenModel.GetPolyData(), fidList, markupsIndex,
-                                                 landmarkDescription[markupID]["projection"]["closestPointIndex"])
-                        self.updateMidPoint(fidList, markupID)
-                        fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+        # the harden model will be recomputed the next time it is used
+        hardenModel = slicer.app.mrmlScene().GetNodeByID(obj.GetAttribute("hardenModelID"))
+        if hardenModel and hardenModel.GetID() in self.hardenModelStates:
+            self.hardenModelStates[hardenModel.GetID()]["isModified"] = True
+        else:
+            hardenModel = self.createIntermediateHardenModel(obj)
+            obj.SetAttribute("hardenModelID",hardenModel.GetID())
+        # for each fiducial list connected to the modified model
+        for fidList in self.getConnectedFidLists(obj):
+            #replace the harden model with the new one
+            fidList.SetAttribute("hardenModelID",hardenModel.GetID())
+            #reproject the fiducials on the new model
+            self.reprojectLandmarks(fidList)
+
+    def reprojectLandmarks(self, fidList):
+        """Move all the projected landmarks of the list on their closest point of the harden model at once"""
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
+        if not landmarkRegistry:
+            return
+        markupIDs = [fidList.GetNthMarkupID(n) for n in range(fidList.GetNumberOfMarkups())]
+        markupsIndices = list()
+        closestPointIndices = list()
+        for markupsIndex, markupID in enumerate(markupIDs):
+            landmarkRecord = landmarkRegistry.get(markupID)
+            if landmarkRecord and landmarkRecord.isProjected and landmarkRecord.closestPointIndex is not None:
+                markupsIndices.append(markupsIndex)
+                closestPointIndices.append(landmarkRecord.closestPointIndex)
+        isProcessingLandmarks = self.isProcessingLandmarks
+        # the landmarks moved here must not be projected again by onPointModifiedEvent
+        self.isProcessingLandmarks = True
+        try:
+            if markupsIndices:
+                hardenPoints = SurfaceRegistrationLib.polyDataPointsAsArray(self.getHardenModel(fidList).GetPolyData())
+                positions = hardenPoints[numpy.array(closestPointIndices)].astype(numpy.float64)
+                disabledModify = fidList.StartModify()
+                for markupsIndex, position in zip(markupsIndices, positions):
+                    fidList.SetNthControlPointPositionFromArray(markupsIndex, position, fidList.PositionPreview)
+                fidList.EndModify(disabledModify)
+            for markupID in markupIDs:
+                if markupID in landmarkRegistry:
+                    self.updateMidPoint(fidList, markupID)
+        finally:
+            self.isProcessingLandmarks = isProcessingLandmarks
+
+    def getConnectedFidLists(self, model):
+        """Fiducial lists connected to the model. The reverse index of the connectedModelID
+        attributes is built from the scene the first time it is needed."""
+        if self.connectedFidListIDs is None:
+            self.connectedFidListIDs = dict()
+            fidListNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
+            for i in range(0, fidListNodes.GetNumberOfItems()):
+                fidList = fidListNodes.GetItemAsObject(i)
+                if fidList.GetAttribute("connectedModelID"):
+                    self.connectedFidListIDs.setdefault(fidList.GetAttribute("connectedModelID"), set()).add(
+                        fidList.GetID())
+        fidLists = list()
+        for fidListID in self.connectedFidListIDs.get(model.GetID(), set()):
+            fidList = slicer.mrmlScene.GetNodeByID(fidListID)
+            if fidList and fidList.GetAttribute("connectedModelID") == model.GetID():
+                fidLists.append(fidList)
+        return fidLists
+
+    def setConnectedModel(self, fidList, model):
+        """Connect the fiducial list to the model and update the reverse index"""
+        if self.connectedFidListIDs is not None:
+            previousModelID = fidList.GetAttribute("connectedModelID")
+            if previousModelID in self.connectedFidListIDs:
+                self.connectedFidListIDs[previousModelID].discard(fidList.GetID())
+            self.connectedFidListIDs.setdefault(model.GetID(), set()).add(fidList.GetID())
+        fidList.SetAttribute("connectedModelID",model.GetID())
+
+    def onSceneEndImport(self, caller, event):
+        # the imported fiducial lists may be connected to models
+        self.connectedFidListIDs = None
 
     def ModelChanged(self, inputModelSelector, inputLandmarksSelector):
         inputModel = inputModelSelector.currentNode()
@@ -903,30 +1302,18 @@ class SurfaceRegistrationLogic():
             return False
 
     def createNewDataStructure(self,landmarks, model, onSurface):
-        landmarks.SetAttribute("connectedModelID",model.GetID())
+        self.setConnectedModel(landmarks, model)
         landmarks.SetAttribute("hardenModelID",model.GetAttribute("hardenModelID"))
-        landmarkDescription = dict()
+        landmarkRegistry = SurfaceRegistrationLib.LandmarkRegistry()
+        self.landmarkRegistries[landmarks.GetID()] = landmarkRegistry
         for n in range(landmarks.GetNumberOfMarkups()):
             markupID = landmarks.GetNthMarkupID(n)
-            landmarkDescription[markupID] = dict()
             landmarkLabel = landmarks.GetNthMarkupLabel(n)
-            landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-            landmarkDescription[markupID]["ROIradius"] = 0
-            landmarkDescription[markupID]["projection"] = dict()
+            landmarkRecord = landmarkRegistry.add(markupID, SurfaceRegistrationLib.LandmarkRecord(landmarkLabel))
             if onSurface:
-                landmarkDescription[markupID]["projection"]["isProjected"] = True
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(landmarks.GetAttribute("hardenModelID"))
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, landmarks, markupID)
-            else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
-            landmarkDescription[markupID]["midPoint"] = dict()
-            landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = list()
-            landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-            landmarkDescription[markupID]["midPoint"]["Point1"] = None
-            landmarkDescription[markupID]["midPoint"]["Point2"] = None
-        landmarks.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                landmarkRecord.isProjected = True
+                hardenModel = self.getHardenModel(landmarks)
+                landmarkRecord.closestPointIndex = self.projectOnSurface(hardenModel, landmarks, markupID)
         planeDescription = dict()
         landmarks.SetAttribute("planeDescription",self.encodeJSON(planeDescription))
         landmarks.SetAttribute("isClean",self.encodeJSON({"isClean":False}))
@@ -934,20 +1321,19 @@ class SurfaceRegistrationLogic():
         landmarks.SetAttribute("arrayName",model.GetName() + "_ROI")
 
     def changementOfConnectedModel(self,landmarks, model, onSurface):
-        landmarks.SetAttribute("connectedModelID",model.GetID())
+        self.setConnectedModel(landmarks, model)
         landmarks.SetAttribute("hardenModelID",model.GetAttribute("hardenModelID"))
-        landmarkDescription = self.decodeJSON(landmarks.GetAttribute("landmarkDescription"))
+        landmarkRegistry = self.getLandmarkRegistry(landmarks)
         for n in range(landmarks.GetNumberOfMarkups()):
             markupID = landmarks.GetNthMarkupID(n)
+            landmarkRecord = landmarkRegistry[markupID]
             if onSurface:
-                if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(landmarks.GetAttribute("hardenModelID"))
-                    landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, landmarks, markupID)
+                if landmarkRecord.isProjected == True:
+                    hardenModel = self.getHardenModel(landmarks)
+                    landmarkRecord.closestPointIndex = self.projectOnSurface(hardenModel, landmarks, markupID)
             else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
-            landmarks.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                landmarkRecord.isProjected = False
+                landmarkRecord.closestPointIndex = None
         landmarks.SetAttribute("isClean",self.encodeJSON({"isClean":False}))
 
     def connectLandmarks(self, modelSelector, landmarkSelector, onSurface):
@@ -1005,26 +1391,16 @@ class SurfaceRegistrationLogic():
     # Called when a landmark is added on a model
     def onPointAddedEvent(self, obj, event):
         print("------markup adding-------")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
+        landmarkRegistry = self.getLandmarkRegistry(obj)
         numOfMarkups = obj.GetNumberOfMarkups()
         markupID = obj.GetNthMarkupID(numOfMarkups - 1)  # because everytime a new node is added, its index is the last one on the list
-        landmarkDescription[markupID] = dict()
         landmarkLabel = obj.GetNthMarkupLabel(numOfMarkups - 1)
-        landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-        landmarkDescription[markupID]["ROIradius"] = 0
-        landmarkDescription[markupID]["projection"] = dict()
-        landmarkDescription[markupID]["projection"]["isProjected"] = True
-        # The landmark will be projected by onPointModifiedEvent
-        landmarkDescription[markupID]["midPoint"] = dict()
-        landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = list()
-        landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-        landmarkDescription[markupID]["midPoint"]["Point1"] = None
-        landmarkDescription[markupID]["midPoint"]["Point2"] = None
-        obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+        landmarkRegistry.add(markupID, SurfaceRegistrationLib.LandmarkRecord(landmarkLabel, isProjected=True))
         self.interface.landmarkComboBox.addItem(landmarkLabel)
         self.interface.landmarkComboBox.setCurrentIndex(self.interface.landmarkComboBox.count - 1)
         self.interface.UpdateInterface()
-        qt.QTimer.singleShot(0, lambda : self.onPointModifiedEvent(obj,None))
+        # The landmark will be projected with the next landmark updates
+        self.scheduleLandmarkUpdate(obj, markupID)
 
     def calculateMidPointCoord(self, fidList, landmark1ID, landmark2ID):
         """Set the midpoint when you know the the mrml nodes"""
@@ -1041,74 +1417,84 @@ class SurfaceRegistrationLogic():
         return midCoord
 
     def updateMidPoint(self, fidList, landmarkID):
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        for midPointID in landmarkDescription[landmarkID]["midPoint"]["definedByThisMarkup"]:
-            if landmarkDescription[midPointID]["midPoint"]["isMidPoint"]:
-                landmark1ID = landmarkDescription[midPointID]["midPoint"]["Point1"]
-                landmark2ID = landmarkDescription[midPointID]["midPoint"]["Point2"]
-                coord = self.calculateMidPointCoord(fidList, landmark1ID, landmark2ID)
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
+        for midPointID in landmarkRegistry[landmarkID].definedByThisMarkup:
+            midPointRecord = landmarkRegistry[midPointID]
+            if midPointRecord.isMidPoint:
+                coord = self.calculateMidPointCoord(fidList, midPointRecord.point1, midPointRecord.point2)
                 index = fidList.GetNthControlPointIndexByID(midPointID)
                 fidList.SetNthControlPointPositionFromArray(index, coord, fidList.PositionPreview)
-                if landmarkDescription[midPointID]["projection"]["isProjected"]:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-                    landmarkDescription[midPointID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, fidList, landmarkID)
-                    fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                if midPointRecord.isProjected:
+                    hardenModel = self.getHardenModel(fidList)
+                    midPointRecord.closestPointIndex = self.projectOnSurface(hardenModel, fidList, landmarkID)
                 self.updateMidPoint(fidList, midPointID)
 
     # Called when a landmarks is moved
     def onPointModifiedEvent(self, obj, event):
+        # the landmarks moved by the projection are ignored
+        if self.isProcessingLandmarks:
+            return
         print("----onPointModifiedEvent SR-----")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
-        if not landmarkDescription:
+        if not self.getLandmarkRegistry(obj):
             return
         selectedLandmarkID = self.findIDFromLabel(obj, self.interface.landmarkComboBox.currentText)
-        # remove observer to make sure, the callback function won't work..
-        tag = self.decodeJSON(obj.GetAttribute("PointModifiedEventTag"))
-        obj.RemoveObserver(tag["PointModifiedEventTag"])
-        if selectedLandmarkID:
-            activeLandmarkState = landmarkDescription[selectedLandmarkID]
-            if activeLandmarkState["projection"]["isProjected"]:
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(obj.GetAttribute("hardenModelID"))
-                activeLandmarkState["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, obj, selectedLandmarkID)
-                obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
-            self.updateMidPoint(obj,selectedLandmarkID)
-            self.findROI(obj)
-        time.sleep(0.08)
-        # Add the observer again
-        PointModifiedEventTag = obj.AddObserver(obj.PointModifiedEvent, self.onPointModifiedEvent)
-        obj.SetAttribute("PointModifiedEventTag",self.encodeJSON({"PointModifiedEventTag":PointModifiedEventTag}))
+        self.scheduleLandmarkUpdate(obj, selectedLandmarkID)
+        # when called directly (not by an observer), the landmark is updated right away
+        if event is None:
+            self.processPendingLandmarks()
+
+    def scheduleLandmarkUpdate(self, fidList, markupID):
+        """Mark the landmark as moved, it will be updated on the next timeout of the timer"""
+        if not markupID:
+            return
+        self.pendingLandmarks[(fidList.GetID(), markupID)] = fidList
+        if not self.landmarkUpdateTimer.isActive():
+            self.landmarkUpdateTimer.start()
+
+    def processPendingLandmarks(self):
+        """Projection, midpoints and ROI update of the landmarks moved since the last call"""
+        self.landmarkUpdateTimer.stop()
+        pendingLandmarks = self.pendingLandmarks
+        self.pendingLandmarks = dict()
+        self.isProcessingLandmarks = True
+        try:
+            for (fidListID, markupID), fidList in pendingLandmarks.items():
+                if slicer.mrmlScene.GetNodeByID(fidListID) is fidList:
+                    self.updateLandmark(fidList, markupID)
+        finally:
+            self.isProcessingLandmarks = False
+
+    def updateLandmark(self, fidList, markupID):
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
+        if not landmarkRegistry or markupID not in landmarkRegistry:
+            return
+        activeLandmarkRecord = landmarkRegistry[markupID]
+        if activeLandmarkRecord.isProjected:
+            hardenModel = self.getHardenModel(fidList)
+            activeLandmarkRecord.closestPointIndex = self.projectOnSurface(hardenModel, fidList, markupID)
+        self.updateMidPoint(fidList, markupID)
+        self.updateROI(fidList)
 
     def onPointRemovedEvent(self, obj, event):
         print("------markup deleting-------")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
-        IDs = []
-        for ID, value in landmarkDescription.items():
-            isFound = False
-            for n in range(obj.GetNumberOfMarkups()):
-                markupID = obj.GetNthMarkupID(n)
-                if ID == markupID:
-                    isFound = True
-            if not isFound:
-                print(ID)
-                IDs.append(ID)
-        for ID in IDs:
-            landmarkDescription.pop(ID,None)
-        obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+        landmarkRegistry = self.getLandmarkRegistry(obj)
+        markupIDs = set(obj.GetNthMarkupID(n) for n in range(obj.GetNumberOfMarkups()))
+        for ID in [ID for ID in landmarkRegistry if ID not in markupIDs]:
+            print(ID)
+            landmarkRegistry.remove(ID)
         self.updateLandmarkComboBox(obj)
 
     def updateLandmarkComboBox(self, fidList):
         if not fidList:
             return
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
         self.interface.landmarkComboBox.blockSignals(True)
         self.interface.landmarkComboBox.clear()
         numOfFid = fidList.GetNumberOfMarkups()
         if numOfFid > 0:
             for i in range(0, numOfFid):
                 ID = fidList.GetNthMarkupID(i)
-                if not landmarkDescription[ID]["midPoint"]["isMidPoint"]:
+                if not landmarkRegistry[ID].isMidPoint:
                     landmarkLabel = fidList.GetNthMarkupLabel(i)
                     self.interface.landmarkComboBox.addItem(landmarkLabel)
         self.interface.landmarkComboBox.setCurrentIndex(self.interface.landmarkComboBox.count - 1)
@@ -1116,20 +1502,143 @@ class SurfaceRegistrationLogic():
 
     def findIDFromLabel(self, fidList, landmarkLabel):
         # find the ID of the markupsNode from the label of a landmark!
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        for ID, value in landmarkDescription.items():
-            if value["landmarkLabel"] == landmarkLabel:
-                return ID
-        return None
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
+        if not landmarkRegistry:
+            return None
+        ID = landmarkRegistry.findID(landmarkLabel)
+        if ID is None:
+            # the landmark may have been renamed outside of the module
+            self.updateLandmarkLabels(fidList)
+            ID = landmarkRegistry.findID(landmarkLabel)
+        return ID
+
+    def getLandmarkRegistry(self, fidList):
+        """Landmark records of the fiducial list, read from its landmarkDescription attribute
+        the first time. Return None if the list has never been connected to a model."""
+        if not fidList:
+            return None
+        landmarkRegistry = self.landmarkRegistries.get(fidList.GetID())
+        if landmarkRegistry is None:
+            landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+            if landmarkDescription is None:
+                return None
+            landmarkRegistry = SurfaceRegistrationLib.LandmarkRegistry.fromDescription(landmarkDescription)
+            self.landmarkRegistries[fidList.GetID()] = landmarkRegistry
+        return landmarkRegistry
+
+    def updateLandmarkLabels(self, fidList):
+        """Copy the labels of the markups in the landmark records"""
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
+        if not landmarkRegistry:
+            return
+        for n in range(fidList.GetNumberOfMarkups()):
+            markupID = fidList.GetNthMarkupID(n)
+            if markupID in landmarkRegistry:
+                landmarkRegistry.setLabel(markupID, fidList.GetNthMarkupLabel(n))
+
+    def saveLandmarkRegistry(self, fidList):
+        """Write the landmark records in the landmarkDescription attribute of the fiducial list"""
+        if not fidList:
+            return
+        landmarkRegistry = self.landmarkRegistries.get(fidList.GetID())
+        if landmarkRegistry is not None:
+            fidList.SetAttribute("landmarkDescription", self.encodeJSON(landmarkRegistry.toDescription()))
 
-    def getClosestPointIndex(self, fidNode, inputPolyData, landmarkID):
+    def saveLandmarkRegistries(self):
+        for fidListID in list(self.landmarkRegistries):
+            self.saveLandmarkRegistry(slicer.mrmlScene.GetNodeByID(fidListID))
+
+    def onSceneStartSave(self, caller, event):
+        self.processPendingLandmarks()
+        self.saveLandmarkRegistries()
+
+    def getMeshCache(self, hardenModel):
+        """Dictionary of the structures cached for the polydata of hardenModel.
+        It is emptied when the polydata is replaced or when its points or cells are modified."""
+        polyData = hardenModel.GetPolyData()
+        # the point data is shared with the source model and is not taken into account
+        geometry = (polyData.GetPoints(), polyData.GetVerts(), polyData.GetLines(),
+                    polyData.GetPolys(), polyData.GetStrips())
+        geometryMTime = max([0] + [data.GetMTime() for data in geometry if data is not None])
+        cache = self.meshCache.get(hardenModel.GetID())
+        if cache is None or cache["MTime"] != geometryMTime:
+            cache = {"MTime": geometryMTime}
+            self.meshCache[hardenModel.GetID()] = cache
+        return cache
+
+    def invalidateMeshCache(self, hardenModel):
+        if hardenModel.GetID():
+            self.meshCache.pop(hardenModel.GetID(), None)
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemovedEvent(self, caller, event, calldata):
+        if calldata and calldata.GetID():
+            self.meshCache.pop(calldata.GetID(), None)
+            self.landmarkRegistries.pop(calldata.GetID(), None)
+            self.hardenModelStates.pop(calldata.GetID(), None)
+            if self.connectedFidListIDs is not None:
+                self.connectedFidListIDs.pop(calldata.GetID(), None)
+                for fidListIDs in self.connectedFidListIDs.values():
+                    fidListIDs.discard(calldata.GetID())
+            for key in [key for key in self.roiArrays if key[0] == calldata.GetID()]:
+                self.roiArrays.pop(key)
+
+    def getPointLocator(self, hardenModel):
+        cache = self.getMeshCache(hardenModel)
+        if "pointLocator" not in cache:
+            pointLocator = vtk.vtkPointLocator()
+            pointLocator.SetDataSet(hardenModel.GetPolyData())
+            pointLocator.AutomaticOn()
+            pointLocator.BuildLocator()
+            cache["pointLocator"] = pointLocator
+        return cache["pointLocator"]
+
+    def getClosestPointFinder(self, hardenModel):
+        """KD-tree on the points of the harden model, built once per geometry"""
+        cache = self.getMeshCache(hardenModel)
+        if "closestPointFinder" not in cache:
+            points = SurfaceRegistrationLib.polyDataPointsAsArray(hardenModel.GetPolyData())
+            cache["closestPointFinder"] = SurfaceRegistrationLib.ClosestPointFinder(points)
+        return cache["closestPointFinder"]
+
+    def getPointNormals(self, hardenModel):
+        cache = self.getMeshCache(hardenModel)
+        if "pointNormals" not in cache:
+            cache["pointNormals"] = SurfaceRegistrationLib.polyDataPointNormals(hardenModel.GetPolyData())
+        return cache["pointNormals"]
+
+    def computeSurfaceDistances(self, fixedModel, movingModel):
+        """Distance metrics between the harden models, and signed distances from each moving vertex
+        to the closest fixed vertex (positive outside of the fixed model)"""
+        fixedHarden = self.getHardenModel(fixedModel)
+        movingHarden = self.getHardenModel(movingModel)
+        metrics, distances = SurfaceRegistrationLib.surfaceDistanceMetrics(
+            SurfaceRegistrationLib.polyDataPointsAsArray(movingHarden.GetPolyData()),
+            SurfaceRegistrationLib.polyDataPointsAsArray(fixedHarden.GetPolyData()),
+            self.getPointNormals(fixedHarden),
+            self.getClosestPointFinder(fixedHarden),
+            self.getClosestPointFinder(movingHarden))
+        print("Surface distance: mean %(mean).4g, RMS %(rms).4g, median %(median).4g, "
+              "95%% %(percentile95).4g, Hausdorff %(hausdorff).4g" % metrics)
+        self.lastSurfaceDistanceMetrics = metrics
+        return metrics, distances
+
+    def getPointAdjacency(self, hardenModel):
+        """Point to point adjacency (CSR arrays) of the harden model, built once per geometry"""
+        cache = self.getMeshCache(hardenModel)
+        if "pointAdjacency" not in cache:
+            cache["pointAdjacency"] = SurfaceRegistrationLib.pointAdjacency(hardenModel.GetPolyData())
+        return cache["pointAdjacency"]
+
+    def getClosestPointIndex(self, fidNode, inputPolyData, landmarkID, pointLocator=None):
         landmarkCoord = numpy.zeros(3)
         landmarkCoord[1] = 42
         fidNode.GetNthFiducialPosition(landmarkID, landmarkCoord)
-        pointLocator = vtk.vtkPointLocator()
-        pointLocator.SetDataSet(inputPolyData)
-        pointLocator.AutomaticOn()
-        pointLocator.BuildLocator()
+        if pointLocator is None:
+            pointLocator = vtk.vtkPointLocator()
+            pointLocator.SetDataSet(inputPolyData)
+            pointLocator.AutomaticOn()
+            pointLocator.BuildLocator()
         indexClosestPoint = pointLocator.FindClosestPoint(landmarkCoord)
         return indexClosestPoint
 
@@ -1142,7 +1651,8 @@ class SurfaceRegistrationLogic():
     def projectOnSurface(self, modelOnProject, fidNode, selectedFidReflID):
         if selectedFidReflID:
             markupsIndex = fidNode.GetNthControlPointIndexByID(selectedFidReflID)
-            indexClosestPoint = self.getClosestPointIndex(fidNode, modelOnProject.GetPolyData(), markupsIndex)
+            indexClosestPoint = self.getClosestPointIndex(fidNode, modelOnProject.GetPolyData(), markupsIndex,
+                                                          self.getPointLocator(modelOnProject))
             self.replaceLandmark(modelOnProject.GetPolyData(), fidNode, markupsIndex, indexClosestPoint)
             return indexClosestPoint
 
@@ -1191,18 +1701,25 @@ class SurfaceRegistrationLogic():
     def addArrayFromIdList(self, connectedIdList, inputModelNode, arrayName):
         if not inputModelNode:
             return
+        numberofIds = connectedIdList.GetNumberOfIds()
+        pointIds = numpy.fromiter((connectedIdList.GetId(i) for i in range(0, numberofIds)),
+                                  dtype=numpy.int64, count=numberofIds)
+        return self.setROIArray(pointIds, inputModelNode, arrayName)
+
+    def getROIArray(self, inputModelNode, arrayName):
+        """Return the ROI array of the model: a uint8 numpy buffer shared with the vtk point data array.
+        The array and its lookup table are only created once for each geometry of the model."""
         inputModelNodePolydata = inputModelNode.GetPolyData()
         pointData = inputModelNodePolydata.GetPointData()
-        numberofIds = connectedIdList.GetNumberOfIds()
-        hasArrayInt = pointData.HasArray(arrayName)
-        if hasArrayInt == 1:  # ROI Array found
-            pointData.RemoveArray(arrayName)
-        arrayToAdd = vtk.vtkDoubleArray()
+        numberOfPoints = inputModelNodePolydata.GetNumberOfPoints()
+        key = (inputModelNode.GetID(), arrayName)
+        roiArray = self.roiArrays.get(key)
+        if roiArray is not None and pointData.GetArray(arrayName) is roiArray["vtkArray"]\
+                and len(roiArray["buffer"]) == numberOfPoints:
+            return roiArray
+        buffer = numpy.zeros(numberOfPoints, dtype=numpy.uint8)
+        arrayToAdd = numpy_support.numpy_to_vtk(buffer, deep=0, array_type=vtk.VTK_UNSIGNED_CHAR)
         arrayToAdd.SetName(arrayName)
-        for i in range(0, inputModelNodePolydata.GetNumberOfPoints()):
-            arrayToAdd.InsertNextValue(0.0)
-        for i in range(0, numberofIds):
-            arrayToAdd.SetValue(connectedIdList.GetId(i), 1.0)
         lut = vtk.vtkLookupTable()
         tableSize = 2
         lut.SetNumberOfTableValues(tableSize)
@@ -1215,13 +1732,43 @@ class SurfaceRegistrationLogic():
             lut.SetTableValue(0, 0.0, 0.0, 1.0, 1)
         lut.SetTableValue(1, 1.0, 0.0, 0.0, 1)
         arrayToAdd.SetLookupTable(lut)
+        if pointData.HasArray(arrayName) == 1:  # ROI Array found
+            pointData.RemoveArray(arrayName)
         pointData.AddArray(arrayToAdd)
-        inputModelNodePolydata.Modified()
+        roiArray = {"buffer": buffer, "vtkArray": arrayToAdd, "pointIds": numpy.zeros(0, dtype=numpy.int64)}
+        self.roiArrays[key] = roiArray
+        return roiArray
+
+    def setROIArray(self, pointIds, inputModelNode, arrayName):
+        """Set the ROI array of the model to 1 on pointIds and 0 elsewhere, in place"""
+        if not inputModelNode:
+            return
+        roiArray = self.getROIArray(inputModelNode, arrayName)
+        buffer = roiArray["buffer"]
+        if roiArray["pointIds"] is None:
+            buffer.fill(0)
+        else:
+            buffer[roiArray["pointIds"]] = 0
+        buffer[pointIds] = 1
+        roiArray["pointIds"] = pointIds
+        roiArray["vtkArray"].Modified()
+        return True
+
+    def updateROIArray(self, modifiedPointIds, coverage, inputModelNode, arrayName):
+        """Only update the ROI array on modifiedPointIds: points covered by at least one landmark ROI are set to 1"""
+        if not inputModelNode:
+            return
+        previousROIArray = self.roiArrays.get((inputModelNode.GetID(), arrayName))
+        roiArray = self.getROIArray(inputModelNode, arrayName)
+        if roiArray is not previousROIArray:
+            # the array has just been created, it has to be filled entirely
+            return self.setROIArray(numpy.flatnonzero(coverage), inputModelNode, arrayName)
+        roiArray["buffer"][modifiedPointIds] = coverage[modifiedPointIds] > 0
+        roiArray["pointIds"] = None
+        roiArray["vtkArray"].Modified()
         return True
 
     def displayROI(self, inputModelNode, scalarName):
-        PolyData = inputModelNode.GetPolyData()
-        PolyData.Modified()
         displayNode = inputModelNode.GetModelDisplayNode()
         displayNode.SetScalarVisibility(False)
         disabledModify = displayNode.StartModify()
@@ -1230,118 +1777,115 @@ class SurfaceRegistrationLogic():
             displayNode.SetScalarVisibility(True)
         displayNode.EndModify(disabledModify)
 
-    def getCellPoints(self, polyData, cellId):
-        """
-        Generator which yields all of a given cell's point ids.
-
-        :param polyData: A vtkPolyData.
-        :param cellId: A cell id in polyData.
-        :return: All point ids of cellId.
-        """
-
-        points = vtk.vtkIdList()
-        polyData.GetCellPoints(cellId, points)
-        for i in range(points.GetNumberOfIds()):
-            yield points.GetId(i)
-
-    def getPointCells(self, polyData, pointId):
-        """
-        Generator which yields all of a given point's cell ids.
-
-        :param polyData: A vtkPolyData.
-        :param pointId: A point id in polyData
-        :return: All cell ids of pointId
-        """
-
-        cells = vtk.vtkIdList()
-        polyData.GetPointCells(pointId, cells)
-        for i in range(cells.GetNumberOfIds()):
-            yield cells.GetId(i)
-
     def findROI(self, fidList):
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
+        roiPointIds = numpy.flatnonzero(self.updateROI(fidList))
+        # Copy the points of the ROI into a vtkIdList.
+        pointIds = vtk.vtkIdList()
+        pointIds.SetNumberOfIds(len(roiPointIds))
+        for i, pointId in enumerate(roiPointIds):
+            pointIds.SetId(i, int(pointId))
+        return pointIds
+
+    def updateROI(self, fidList):
+        """Update the ROI of the fiducial list and its display, only recomputing the ROI of the
+        landmarks whose closest point or radius changed. Return the number of landmark ROIs
+        covering each point of the mesh."""
+        hardenModel = self.getHardenModel(fidList)
         connectedModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("connectedModelID"))
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
         arrayName = fidList.GetAttribute("arrayName")
 
-        polyData = hardenModel.GetPolyData()
+        # The ROI of each landmark is kept with the other structures computed on the mesh,
+        # so that everything is recomputed when the geometry changes.
+        roiStates = self.getMeshCache(hardenModel).setdefault("roiStates", dict())
+        roiState = roiStates.get(fidList.GetID())
+        isNewState = roiState is None
+        if isNewState:
+            roiState = {"coverage": numpy.zeros(hardenModel.GetPolyData().GetNumberOfPoints(), dtype=numpy.int32),
+                        "landmarkROIs": dict()}
+            roiStates[fidList.GetID()] = roiState
+        coverage = roiState["coverage"]
+        landmarkROIs = roiState["landmarkROIs"]
+        modifiedPointIds = list()
+
+        # remove the contribution of the deleted landmarks
+        for markupID in [markupID for markupID in landmarkROIs if markupID not in landmarkRegistry]:
+            seed, landmarkPointIds = landmarkROIs.pop(markupID)
+            coverage[landmarkPointIds] -= 1
+            modifiedPointIds.append(landmarkPointIds)
 
         # Consider the ROI radius as a "weight" in the graph of points. We do a
-        # breadth-first traversal of the mesh, decrementing the weight as we go
-        # and being careful not to backtrack into the already-traversed ROI. We
-        # stop traversing at weight 0.
-
-        # For each weight, associate a set of points which have that weight.
-        weights = defaultdict(set)
-
-        # Initially, this structure will contain only the fiducials, keyed by
-        # their ROI radii.
-        for state in landmarkDescription.values():
-            weight = int(state['ROIradius'])
-            pointId = state['projection']['closestPointIndex']
-            weights[weight].add(pointId)
-
-        allPoints = set()
-        allCells = set()
-
-        # Avoid backtracking by first processing all points with highest weight,
-        # then next highest, and so on until weight 0. At each iteration, mark
-        # all the neighboring points which have not yet been processed with weight-1,
-        # so that they are processed on the next iteration.
-        for weight in range(max(weights), 0, -1):
-            pointIds = weights.pop(weight)
-
-            # Find the set of cells that neighbor the current set of points
-            cellIdsToAdd = set()
-            for pointId in pointIds:
-                cellIdsToAdd.update(self.getPointCells(polyData, pointId))
-            cellIdsToAdd -= allCells  # Exclude already-seen cells
-            allCells.update(cellIdsToAdd)
-
-            # Find the set of points that neighbor the current set of cells
-            pointIdsToAdd = set()
-            for cell in cellIdsToAdd:
-                pointIdsToAdd.update(self.getCellPoints(polyData, cell))
-            pointIdsToAdd -= allPoints # Exclude already-seen points
-            allPoints.update(pointIdsToAdd)
-
-            # All those neighboring points should be traversed next with lesser weight.
-            # If a markup with smaller ROI exists, it will still be included in that set.
-            weights[weight - 1].update(pointIdsToAdd)
-
-        # Copy that set of all points into a vtkIdList.
-        pointIds = vtk.vtkIdList()
-        for point in allPoints:
-            pointIds.InsertNextId(point)
-
-        self.addArrayFromIdList(pointIds, connectedModel, arrayName)
+        # breadth-first traversal of the mesh from the landmark, decrementing the
+        # weight as we go. We stop traversing at weight 0. Each step expands the
+        # whole frontier at once on the point adjacency of the mesh.
+        indptr, indices = self.getPointAdjacency(hardenModel)
+        for markupID, landmarkRecord in landmarkRegistry.items():
+            seed = (landmarkRecord.closestPointIndex, int(landmarkRecord.ROIradius))
+            previousROI = landmarkROIs.get(markupID)
+            if previousROI is not None:
+                if previousROI[0] == seed:
+                    continue
+                coverage[previousROI[1]] -= 1
+                modifiedPointIds.append(previousROI[1])
+            if seed[0] is None:
+                landmarkPointIds = numpy.zeros(0, dtype=numpy.int64)
+            else:
+                landmarkPointIds = SurfaceRegistrationLib.growRegion(indptr, indices, [seed[0]], [seed[1]],
+                                                                     len(coverage))
+            coverage[landmarkPointIds] += 1
+            modifiedPointIds.append(landmarkPointIds)
+            landmarkROIs[markupID] = (seed, landmarkPointIds)
+
+        if isNewState:
+            self.setROIArray(numpy.flatnonzero(coverage), connectedModel, arrayName)
+        elif modifiedPointIds:
+            self.updateROIArray(numpy.unique(numpy.concatenate(modifiedPointIds)), coverage,
+                                connectedModel, arrayName)
         self.displayROI(connectedModel, arrayName)
-        return pointIds
+        return coverage
 
     def cleanerAndTriangleFilter(self, inputModel):
-        cleanerPolydata = vtk.vtkCleanPolyData()
-        cleanerPolydata.SetInputData(inputModel.GetPolyData())
-        cleanerPolydata.Update()
-        triangleFilter = vtk.vtkTriangleFilter()
-        triangleFilter.SetInputData(cleanerPolydata.GetOutput())
-        triangleFilter.Update()
-        inputModel.SetAndObservePolyData(triangleFilter.GetOutput())
+        """Clean and triangulate the polydata of the model. Return the new id of each of its former points"""
+        cleanedPolyData, pointIdMap = SurfaceRegistrationLib.cleanPolyData(inputModel.GetPolyData())
+        inputModel.SetAndObservePolyData(cleanedPolyData)
+        self.invalidateMeshCache(inputModel)
+        # the harden model is rebuilt from the cleaned polydata the next time it is used
+        hardenModel = slicer.app.mrmlScene().GetNodeByID(inputModel.GetAttribute("hardenModelID"))
+        if hardenModel and hardenModel.GetID() in self.hardenModelStates:
+            self.hardenModelStates[hardenModel.GetID()]["isModified"] = True
+            self.invalidateMeshCache(hardenModel)
+        return pointIdMap
+
+    def remapClosestPointIndices(self, fidList, pointIdMap):
+        """Renumber the closest points of all the landmarks of the list after a change of the point ids"""
+        landmarkRegistry = self.getLandmarkRegistry(fidList)
+        if not landmarkRegistry:
+            return
+        landmarkRecords = [landmarkRecord for markupID, landmarkRecord in landmarkRegistry.items()
+                           if landmarkRecord.closestPointIndex is not None]
+        if not landmarkRecords:
+            return
+        closestPointIndices = pointIdMap[numpy.array([landmarkRecord.closestPointIndex
+                                                      for landmarkRecord in landmarkRecords])]
+        for landmarkRecord, closestPointIndex in zip(landmarkRecords, closestPointIndices):
+            landmarkRecord.closestPointIndex = int(closestPointIndex)
 
     def cleanMesh(self, selectedLandmark):
         activeInput = self.selectedModel
         fidList = self.selectedFidList
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(activeInput.GetAttribute("hardenModelID"))
         if activeInput:
-            # Clean the mesh with vtkCleanPolyData cleaner and vtkTriangleFilter:
-            self.cleanerAndTriangleFilter(activeInput)
-            self.cleanerAndTriangleFilter(hardenModel)
+            # Clean the mesh with vtkCleanPolyData cleaner and vtkTriangleFilter, only once:
+            # the harden model is rebuilt from the cleaned mesh
+            pointIdMap = self.cleanerAndTriangleFilter(activeInput)
+            # the landmarks of every list on the model follow the new point ids
+            for connectedFidList in self.getConnectedFidLists(activeInput):
+                self.remapClosestPointIndices(connectedFidList, pointIdMap)
+                self.reprojectLandmarks(connectedFidList)
             # Define the new ROI:
             selectedLandmarkID = self.findIDFromLabel(fidList, selectedLandmark)
-            if selectedLandmarkID:
-                landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-                landmarkDescription[selectedLandmarkID]["projection"]["closestPointIndex"] =\
-                    self.projectOnSurface(hardenModel, fidList, selectedLandmarkID)
-                fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+            if selectedLandmarkID and self.getLandmarkRegistry(fidList)[selectedLandmarkID].closestPointIndex is None:
+                self.getLandmarkRegistry(fidList)[selectedLandmarkID].closestPointIndex = \
+                    self.projectOnSurface(self.getHardenModel(activeInput), fidList, selectedLandmarkID)
             fidList.SetAttribute("isClean",self.encodeJSON({"isClean":True}))
             activeInput.SetAttribute("isClean",self.encodeJSON({"isClean":True}))
 
@@ -1415,6 +1959,12 @@ class SurfaceRegistrationTest(ScriptedLoadableModuleTest):
         self.delayDisplay(' Test DefineNeighbors Function ')
         self.assertTrue(self.testDefineNeighborsFunction())
 
+        self.delayDisplay(' Test growRegion Function ')
+        self.assertTrue(self.testGrowRegionFunction())
+
+        self.delayDisplay(' Test landmark registry ')
+        self.assertTrue(self.testLandmarkRegistry())
+
         self.delayDisplay(' Test addArrayFromIdList Function ')
         self.assertTrue(self.testAddArrayFromIdListFunction())
 
@@ -1427,6 +1977,30 @@ class SurfaceRegistrationTest(ScriptedLoadableModuleTest):
         self.delayDisplay(' Test ICP Function ')
         self.assertTrue(self.testRunICP())
 
+        self.delayDisplay(' Test NumPy ICP Function ')
+        self.assertTrue(self.testRunNumpyICP())
+
+        self.delayDisplay(' Test point to plane ICP ')
+        self.assertTrue(self.testPointToPlaneICP())
+
+        self.delayDisplay(' Test registration cache ')
+        self.assertTrue(self.testRegistrationCache())
+
+        self.delayDisplay(' Test surface distance metrics ')
+        self.assertTrue(self.testSurfaceDistanceMetrics())
+
+        self.delayDisplay(' Test clean PolyData ')
+        self.assertTrue(self.testCleanPolyData())
+
+        self.delayDisplay(' Test cleanMesh under a non-linear transform ')
+        self.assertTrue(self.testCleanMeshNonLinearTransform())
+
+        self.delayDisplay(' Test extract ROI PolyData ')
+        self.assertTrue(self.testExtractROIPolyData())
+
+        self.delayDisplay(' Test batch registration ')
+        self.assertTrue(self.testBatchRegistration())
+
         # globaltests
         self.setUp()
         self.delayDisplay("Download and load datas")
@@ -1555,6 +2129,62 @@ class SurfaceRegistrationTest(ScriptedLoadableModuleTest):
                 print("test ",i ," ReplaceLandmark: succeed")
         return True
 
+    def testGrowRegionFunction(self):
+        polyData = self.defineSphere().GetPolyData()
+        seeds = [[0, 2], [9, 1], [35, 0]]
+        # reference: traversal through the cells of each point
+        roiPoints = set()
+        cellIds = vtk.vtkIdList()
+        cellPointIds = vtk.vtkIdList()
+        for pointId, radius in seeds:
+            pointIds = set([pointId])
+            for i in range(0, radius):
+                for point in list(pointIds):
+                    polyData.GetPointCells(point, cellIds)
+                    for j in range(0, cellIds.GetNumberOfIds()):
+                        polyData.GetCellPoints(cellIds.GetId(j), cellPointIds)
+                        pointIds.update(cellPointIds.GetId(k) for k in range(0, cellPointIds.GetNumberOfIds()))
+            if radius > 0:
+                roiPoints.update(pointIds)
+        indptr, indices = SurfaceRegistrationLib.pointAdjacency(polyData)
+        roiPointIds = SurfaceRegistrationLib.growRegion(indptr, indices, [seed[0] for seed in seeds],
+                                                        [seed[1] for seed in seeds], polyData.GetNumberOfPoints())
+        if sorted(roiPoints) != list(roiPointIds):
+            print("test GrowRegion: failed")
+            return False
+        indptr, indices = SurfaceRegistrationLib.pointAdjacency(vtk.vtkPolyData())
+        if list(indptr) != [0] or len(indices) != 0:
+            print("test GrowRegion: failed on an empty polydata")
+            return False
+        print("test GrowRegion: succeed")
+        return True
+
+    def testLandmarkRegistry(self):
+        logic = SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
+        fidList = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(fidList)
+        fidList.AddFiducial(0.0, 0.0, 0.0)
+        fidList.AddFiducial(0.0, 10.0, 0.0)
+        landmarkRegistry = SurfaceRegistrationLib.LandmarkRegistry()
+        logic.landmarkRegistries[fidList.GetID()] = landmarkRegistry
+        for n in range(fidList.GetNumberOfMarkups()):
+            landmarkRegistry.add(fidList.GetNthMarkupID(n), SurfaceRegistrationLib.LandmarkRecord("old" + str(n)))
+        landmarkRegistry[fidList.GetNthMarkupID(1)].ROIradius = 3
+        # the labels changed outside of the module are found again
+        fidList.SetNthMarkupLabel(1, "renamed")
+        if logic.findIDFromLabel(fidList, "renamed") != fidList.GetNthMarkupID(1):
+            print("test LandmarkRegistry: failed")
+            return False
+        # round trip through the landmarkDescription attribute
+        logic.saveLandmarkRegistry(fidList)
+        logic.landmarkRegistries.clear()
+        landmarkRecord = logic.getLandmarkRegistry(fidList)[fidList.GetNthMarkupID(1)]
+        if landmarkRecord.landmarkLabel != "renamed" or landmarkRecord.ROIradius != 3:
+            print("test LandmarkRegistry: failed")
+            return False
+        print("test LandmarkRegistry: succeed")
+        return True
+
     def testRunFiducialRegistration(self):
         logic = SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
         referenceMarkupsFiducial = slicer.vtkMRMLMarkupsFiducialNode()
@@ -1582,21 +2212,27 @@ class SurfaceRegistrationTest(ScriptedLoadableModuleTest):
         outTransform.SetName("testTransform")
         slicer.mrmlScene.AddNode(outTransform)
         outMatrix = list()
-        logic.runFiducialRegistration(referenceMarkupsFiducial,referenceMarkupsFiducial,outTransform,"Rigid")
+        rmsErrors = list()
+        rmsErrors.append(logic.runFiducialRegistration(referenceMarkupsFiducial,referenceMarkupsFiducial,outTransform,"Rigid"))
         self.matrixToList(outTransform.GetMatrixTransformFromParent(),outMatrix)
-        logic.runFiducialRegistration(referenceMarkupsFiducial,Fiducial1,outTransform,"Rigid")
+        rmsErrors.append(logic.runFiducialRegistration(referenceMarkupsFiducial,Fiducial1,outTransform.GetID(),"Rigid"))
         self.matrixToList(outTransform.GetMatrixTransformFromParent(),outMatrix)
-        logic.runFiducialRegistration(referenceMarkupsFiducial,Fiducial2,outTransform,"Rigid")
+        rmsErrors.append(logic.runFiducialRegistration(referenceMarkupsFiducial,Fiducial2,outTransform,"Rigid"))
         self.matrixToList(outTransform.GetMatrixTransformFromParent(),outMatrix)
 
         controlMatrix = list()
         controlMatrix.append([1.0, -0.0, 0.0, -0.0, -0.0, 1.0, -0.0, 0.0, 0.0, -0.0, 1.0, -0.0, -0.0, 0.0, -0.0, 1.0])
         controlMatrix.append([1.0, -0.0, 0.0, 10.0, -0.0, 1.0, -0.0, 0.0, 0.0, -0.0, 1.0, -0.0, -0.0, 0.0, -0.0, 1.0])
-        controlMatrix.append([-1.0000000000000004, -0.0, 0.0, -0.0, -0.0, -0.7071067811865479, 0.7071067811865477, 0.0, 0.0, 0.7071067811865477, 0.7071067811865475, -0.0, -0.0, 0.0, -0.0, 1.0])
+        # the reference landmarks are collinear: the rotation around their line is the one of the closed form solution
+        controlMatrix.append([1.0, 0.0, 0.0, 0.0, 0.0, -0.7071067811865476, -0.7071067811865476, 0.0, 0.0, 0.7071067811865476, -0.7071067811865476, 0.0, 0.0, 0.0, 0.0, 1.0])
+        controlErrors = [0.0, 0.0, 3.3820395745152]
 
         for i in range(0, 3):
+            if abs(rmsErrors[i] - controlErrors[i]) > 1e-5:
+                print("test ",i ," RunFiducialRegistration: failed")
+                return False
             for j in range (0,16):
-                if outMatrix[i][j] - controlMatrix[i][j] > 1e-5:
+                if abs(outMatrix[i][j] - controlMatrix[i][j]) > 1e-5:
                     print("test ",i ," RunFiducialRegistration: failed")
                     return False
             print("test ",i ," RunFiducialRegistration: succeed")
@@ -1640,6 +2276,233 @@ class SurfaceRegistrationTest(ScriptedLoadableModuleTest):
             print("test ",i ," RunICP: succeed")
         return True
 
+    def testRunNumpyICP(self):
+        logic = SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
+        fixedModel = self.defineSphere()
+        outTransform = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(outTransform)
+        outTransform.SetName("test")
+        centers = [[50, 50, 50], [-500, 50, 390], [590, 450, 550]]
+        parameters = [["Absolute Value", "RigidBody", 200, 0.01, 200, False, False],
+                      ["Absolute Value", "Similarity", 1000, 0.01, 200, True, False],
+                      ["Root Mean Square", "RigidBody", 200, 0.0001, 500, True, True]]
+        for i in range(0, 3):
+            sphereModel = self.defineSphere(centers[i])
+            trace = logic.runICP(fixedModel.GetPolyData(), sphereModel.GetPolyData(), outTransform,
+                                 *(parameters[i] + ["NumPy"]))
+            if trace.numberOfIterations != len(trace.iterations) or trace is not logic.lastICPTrace:
+                print("test ",i ," RunNumpyICP: trace failed")
+                return False
+            outMatrix = outTransform.GetMatrixTransformFromParent()
+            controlMatrix = vtk.vtkMatrix4x4()
+            for j in range(0, 3):
+                controlMatrix.SetElement(j, 3, centers[i][j])
+            if not self.areMatrixEquals(controlMatrix, outMatrix):
+                print("test ",i ," RunNumpyICP: failed")
+                return False
+            print("test ",i ," RunNumpyICP: succeed")
+        return True
+
+    def testPointToPlaneICP(self):
+        logic = SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
+        # a sphere does not constrain the rotation of a point to plane ICP
+        superEllipsoid = vtk.vtkParametricSuperEllipsoid()
+        superEllipsoid.SetXRadius(40)
+        superEllipsoid.SetYRadius(30)
+        superEllipsoid.SetZRadius(20)
+        superEllipsoid.SetN1(0.6)
+        superEllipsoid.SetN2(0.8)
+        source = vtk.vtkParametricFunctionSource()
+        source.SetParametricFunction(superEllipsoid)
+        cleaner = vtk.vtkCleanPolyData()
+        cleaner.SetInputConnection(source.GetOutputPort())
+        cleaner.Update()
+        fixed = cleaner.GetOutput()
+        controlMatrix = vtk.vtkMatrix4x4()
+        transform = vtk.vtkTransform()
+        transform.Translate(5, -3, 2)
+        transform.RotateZ(15)
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(fixed)
+        transformFilter.SetTransform(transform)
+        transformFilter.Update()
+        vtk.vtkMatrix4x4.Invert(transform.GetMatrix(), controlMatrix)
+        outTransform = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(outTransform)
+        for trimFraction in [0.0, 0.2]:
+            trace = logic.runICP(fixed, transformFilter.GetOutput(), outTransform, "Absolute Value", "PointToPlane",
+                                 1000, 0.0001, 100, False, True, trimFraction=trimFraction)
+            outMatrix = vtk.vtkMatrix4x4()
+            outTransform.GetMatrixTransformToParent(outMatrix)
+            if not self.areMatrixEquals(controlMatrix, outMatrix) or trace.numberOfIterations >= 100:
+                print("test PointToPlaneICP trim", trimFraction, ": failed")
+                return False
+        print("test PointToPlaneICP: succeed")
+        return True
+
+    def testRegistrationCache(self):
+        logic = SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
+        fixedModel = self.defineSphere()
+        movingModel = self.defineSphere([10, 0, 0])
+        outTransform = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(outTransform)
+        parameters = ["Absolute Value", "RigidBody", 200, 0.01, 200, False, False]
+        trace = logic.runICP(fixedModel.GetPolyData(), movingModel.GetPolyData(), outTransform, *parameters)
+        outMatrix = vtk.vtkMatrix4x4()
+        outTransform.GetMatrixTransformToParent(outMatrix)
+        outTransform.SetMatrixTransformToParent(vtk.vtkMatrix4x4())
+        # same content in a new polydata: the result is found in the cache
+        moving = vtk.vtkPolyData()
+        moving.DeepCopy(movingModel.GetPolyData())
+        cachedTrace = logic.runICP(fixedModel.GetPolyData(), moving, outTransform, *parameters)
+        cachedMatrix = vtk.vtkMatrix4x4()
+        outTransform.GetMatrixTransformToParent(cachedMatrix)
+        if len(logic.registrationCache) != 1 or cachedTrace.numberOfIterations != trace.numberOfIterations:
+            print("test RegistrationCache: failed")
+            return False
+        for i in range(0, 4):
+            for j in range(0, 4):
+                if cachedMatrix.GetElement(i, j) != outMatrix.GetElement(i, j):
+                    print("test RegistrationCache: failed")
+                    return False
+        # moving points changed: the registration is run again
+        moving.GetPoints().SetPoint(0, 0, 0, 0)
+        logic.runICP(fixedModel.GetPolyData(), moving, outTransform, *parameters)
+        if len(logic.registrationCache) != 2:
+            print("test RegistrationCache: failed")
+            return False
+        print("test RegistrationCache: succeed")
+        return True
+
+    def testSurfaceDistanceMetrics(self):
+        fixed = self.defineSphere().GetPolyData()
+        fixedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(fixed)
+        # the sphere scaled by 1.1: every moving vertex is 10 mm outside of the fixed one
+        movingPoints = fixedPoints * 1.1
+        metrics, distances = SurfaceRegistrationLib.surfaceDistanceMetrics(
+            movingPoints, fixedPoints, SurfaceRegistrationLib.polyDataPointNormals(fixed), chunkSize=16)
+        for name in ["mean", "rms", "median", "percentile95", "hausdorff"]:
+            if abs(metrics[name] - 10.0) > 1e-3:
+                print("test SurfaceDistanceMetrics", name, ": failed")
+                return False
+        if len(distances) != len(movingPoints) or distances.min() < 9.999:
+            print("test SurfaceDistanceMetrics signed distances: failed")
+            return False
+        print("test SurfaceDistanceMetrics: succeed")
+        return True
+
+    def testCleanPolyData(self):
+        sphere = self.defineSphere().GetPolyData()
+        # each triangle gets its own copy of its points
+        shrinkFilter = vtk.vtkShrinkPolyData()
+        shrinkFilter.SetShrinkFactor(1.0)
+        shrinkFilter.SetInputData(sphere)
+        shrinkFilter.Update()
+        unmerged = shrinkFilter.GetOutput()
+        cleaned, pointIdMap = SurfaceRegistrationLib.cleanPolyData(unmerged)
+        if cleaned.GetNumberOfPoints() != sphere.GetNumberOfPoints() or len(pointIdMap) != unmerged.GetNumberOfPoints():
+            print("test CleanPolyData number of points: failed")
+            return False
+        unmergedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(unmerged)
+        cleanedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(cleaned)
+        if not numpy.allclose(cleanedPoints[pointIdMap], unmergedPoints):
+            print("test CleanPolyData point id map: failed")
+            return False
+        print("test CleanPolyData: succeed")
+        return True
+
+    def testCleanMeshNonLinearTransform(self):
+        logic = SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
+        # each triangle gets its own copy of its points, which the cleaning merges
+        shrinkFilter = vtk.vtkShrinkPolyData()
+        shrinkFilter.SetShrinkFactor(1.0)
+        shrinkFilter.SetInputData(self.defineSphere().GetPolyData())
+        shrinkFilter.Update()
+        model = slicer.modules.models.logic().AddModel(shrinkFilter.GetOutput())
+        sourceLandmarks = vtk.vtkPoints()
+        targetLandmarks = vtk.vtkPoints()
+        for source, target in (([0, 0, 0], [0, 0, 0]), ([100, 0, 0], [110, 0, 0]), ([0, 100, 0], [0, 95, 5]),
+                               ([0, 0, 100], [5, 0, 100]), ([-100, 0, 0], [-100, 0, 0])):
+            sourceLandmarks.InsertNextPoint(source)
+            targetLandmarks.InsertNextPoint(target)
+        thinPlateSpline = vtk.vtkThinPlateSplineTransform()
+        thinPlateSpline.SetBasisToR()
+        thinPlateSpline.SetSourceLandmarks(sourceLandmarks)
+        thinPlateSpline.SetTargetLandmarks(targetLandmarks)
+        transform = slicer.vtkMRMLTransformNode()
+        slicer.mrmlScene.AddNode(transform)
+        transform.SetAndObserveTransformToParent(thinPlateSpline)
+        model.SetAndObserveTransformNodeID(transform.GetID())
+        model.SetAttribute("hardenModelID", logic.createIntermediateHardenModel(model).GetID())
+        hardenPolyData = logic.getHardenModel(model).GetPolyData()
+        hardenPoints = numpy.array(SurfaceRegistrationLib.polyDataPointsAsArray(hardenPolyData))
+        pointIdMap = logic.cleanerAndTriangleFilter(model)
+        cleanedPolyData = logic.getHardenModel(model).GetPolyData()
+        if cleanedPolyData.GetNumberOfPoints() != model.GetPolyData().GetNumberOfPoints():
+            print("test CleanMeshNonLinearTransform harden model not rebuilt: failed")
+            return False
+        # the remapped closest points are at the same position on the harden model
+        cleanedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(cleanedPolyData)
+        if not numpy.allclose(cleanedPoints[pointIdMap], hardenPoints, atol=1e-4):
+            print("test CleanMeshNonLinearTransform point id map: failed")
+            return False
+        print("test CleanMeshNonLinearTransform: succeed")
+        return True
+
+    def testExtractROIPolyData(self):
+        sphere = self.defineSphere().GetPolyData()
+        sphere.BuildLinks()
+        pointId = sphere.GetNumberOfPoints() // 2
+        pointCells = vtk.vtkIdList()
+        sphere.GetPointCells(pointId, pointCells)
+        roiPolyData = SurfaceRegistrationLib.extractROIPolyData(sphere, [pointId])
+        if roiPolyData.GetNumberOfCells() != pointCells.GetNumberOfIds():
+            print("test ExtractROIPolyData number of cells: failed")
+            return False
+        # the points of the ROI are the points of these cells, in the order of the sphere
+        cellPointIds = set()
+        cellPoints = vtk.vtkIdList()
+        for i in range(pointCells.GetNumberOfIds()):
+            sphere.GetCellPoints(pointCells.GetId(i), cellPoints)
+            cellPointIds.update(cellPoints.GetId(j) for j in range(cellPoints.GetNumberOfIds()))
+        spherePoints = SurfaceRegistrationLib.polyDataPointsAsArray(sphere)
+        roiPoints = SurfaceRegistrationLib.polyDataPointsAsArray(roiPolyData)
+        if not numpy.allclose(roiPoints, spherePoints[sorted(cellPointIds)]):
+            print("test ExtractROIPolyData points: failed")
+            return False
+        print("test ExtractROIPolyData: succeed")
+        return True
+
+    def testBatchRegistration(self):
+        from SurfaceRegistrationLib import BatchRegistration
+        directory = os.path.join(slicer.app.temporaryPath, "SurfaceRegistrationBatch")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        centers = {"fixed": [0, 0, 0], "moving": [50, 50, 50]}
+        for name, center in centers.items():
+            writer = vtk.vtkPolyDataWriter()
+            writer.SetFileName(os.path.join(directory, name + ".vtk"))
+            writer.SetInputData(self.defineSphere(center).GetPolyData())
+            writer.Write()
+        with open(os.path.join(directory, "manifest.csv"), "w") as manifest:
+            manifest.write("caseID,mode,fixedModel,movingModel,numberOfIterations\n")
+            manifest.write("sphere,surface,fixed.vtk,moving.vtk,200\n")
+        cases = BatchRegistration.readManifest(os.path.join(directory, "manifest.csv"), directory)
+        summary = BatchRegistration.registerCase(cases[0])
+        if summary["status"] != "succeeded":
+            print("test BatchRegistration: failed", summary["message"])
+            return False
+        # the transform written is loaded by Slicer as the parent transform of the moving model
+        outTransform = slicer.util.loadTransform(summary["transform"])
+        controlMatrix = vtk.vtkMatrix4x4()
+        for j in range(0, 3):
+            controlMatrix.SetElement(j, 3, centers["moving"][j])
+        if not self.areMatrixEquals(controlMatrix, outTransform.GetMatrixTransformFromParent()):
+            print("test BatchRegistration: failed")
+            return False
+        print("test BatchRegistration: succeed")
+        return True
+
     # ------------------------------------------------------------
     #                          global tests
     # ------------------------------------------------------------
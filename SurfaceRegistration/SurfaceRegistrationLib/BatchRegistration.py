@@ -0,0 +1,292 @@
+"""Registration of a cohort of model pairs without the Slicer interface.
+
+The manifest is a CSV file with one case per row and the columns:
+
+    caseID, mode, fixedModel, movingModel, fixedLandmarks, movingLandmarks
+
+followed by optional parameter columns named as in DEFAULT_PARAMETERS. The
+mode is "surface", "fiducial" or "ROI". The paths are relative to the
+manifest. The models are read in RAS, except for the legacy .vtk files
+written in LPS by Slicer. The landmarks are Slicer .fcsv or .mrk.json
+files.
+
+One ITK transform file (<caseID>.tfm, loadable in Slicer as the parent
+transform of the moving model) is written per case, and summary.csv lists
+the result of all the cases. With writeTrace set, the convergence trace of
+the ICP (see ICPTrace) is written next to the transform as
+<caseID>_ICPTrace.json, and the peak memory of the case is measured.
+With a cache directory, the ICP results are stored there (see
+RegistrationCache) and reused when a case is run again with the same models
+and parameters. The cases are run in parallel in a process
+pool:
+
+    PythonSlicer -m SurfaceRegistrationLib.BatchRegistration manifest.csv outputDirectory
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from .ICPTrace import ICPTrace
+from .IterativeClosestPoint import ClosestPointFinder, polyDataPointNormals, polyDataPointsAsArray, registerFiducials, \
+    runICP, runVTKICP
+from .MeshTopology import extractROIPolyData, growRegion, pointAdjacency
+from .RegistrationCache import RegistrationCache
+
+__all__ = ["DEFAULT_PARAMETERS", "readManifest", "readModel", "readLandmarks", "writeITKTransform",
+           "registerCase", "runBatch"]
+
+# same defaults as the module interface. matchCentroids is only set by default for ROI registration.
+DEFAULT_PARAMETERS = {
+    "icpEngine": "VTK",
+    "meanDistanceType": "Absolute Value",
+    "landmarkTransformType": "RigidBody",
+    "numberOfLandmarks": 200,
+    "maxDistance": 0.001,
+    "numberOfIterations": 2000,
+    "matchCentroids": None,
+    "checkMeanDistance": False,
+    "fiducialTransformType": "Rigid",
+    "roiRadius": 0,
+    "trimFraction": 0.0,
+    "writeTrace": False,
+}
+
+SUMMARY_COLUMNS = ["caseID", "mode", "status", "transform", "numberOfIterations", "meanDistance", "seconds",
+                   "peakMemory", "message"]
+
+
+def _parseBoolean(value):
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _parseParameter(name, value):
+    default = DEFAULT_PARAMETERS[name]
+    if default is None or isinstance(default, bool):
+        return _parseBoolean(value)
+    return type(default)(value)
+
+
+def readManifest(manifestPath, outputDirectory):
+    """List of the cases described in the manifest"""
+    manifestDirectory = os.path.dirname(os.path.abspath(manifestPath))
+    cases = list()
+    with open(manifestPath, newline="") as manifestFile:
+        for row in csv.DictReader(manifestFile):
+            row = dict((key.strip(), (value or "").strip()) for key, value in row.items() if key)
+            case = {"caseID": row.get("caseID") or "case%03d" % len(cases),
+                    "mode": row.get("mode") or "surface",
+                    "outputDirectory": outputDirectory,
+                    "cacheDirectory": None,
+                    "parameters": dict(DEFAULT_PARAMETERS)}
+            for key in ("fixedModel", "movingModel", "fixedLandmarks", "movingLandmarks"):
+                case[key] = os.path.join(manifestDirectory, row[key]) if row.get(key) else None
+            for key in DEFAULT_PARAMETERS:
+                if row.get(key):
+                    case["parameters"][key] = _parseParameter(key, row[key])
+            cases.append(case)
+    return cases
+
+
+def readModel(path):
+    """vtkPolyData read from a model file, in RAS coordinates"""
+    readers = {".vtk": vtk.vtkPolyDataReader,
+               ".vtp": vtk.vtkXMLPolyDataReader,
+               ".stl": vtk.vtkSTLReader,
+               ".ply": vtk.vtkPLYReader,
+               ".obj": vtk.vtkOBJReader}
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in readers:
+        raise ValueError("Unsupported model file: " + path)
+    if not os.path.exists(path):
+        raise ValueError("Model file not found: " + path)
+    reader = readers[extension]()
+    reader.SetFileName(path)
+    reader.Update()
+    polyData = reader.GetOutput()
+    if polyData.GetNumberOfPoints() == 0:
+        raise ValueError("No points read in " + path)
+    if extension == ".vtk" and "SPACE=LPS" in (reader.GetHeader() or ""):
+        points = polyDataPointsAsArray(polyData)
+        points[:, 0:2] *= -1
+        polyData.GetPoints().Modified()
+        if polyData.GetPointData().GetNormals() is not None:
+            numpy_support.vtk_to_numpy(polyData.GetPointData().GetNormals())[:, 0:2] *= -1
+    return polyData
+
+
+def readLandmarks(path):
+    """(n, 3) array of the landmarks of a .fcsv or .mrk.json file, in RAS coordinates"""
+    if not path or not os.path.exists(path):
+        raise ValueError("Landmark file not found: %s" % path)
+    positions = list()
+    if path.lower().endswith(".json"):
+        with open(path) as landmarkFile:
+            markups = json.load(landmarkFile)["markups"][0]
+        isLPS = markups.get("coordinateSystem", "LPS") == "LPS"
+        for controlPoint in markups.get("controlPoints", list()):
+            positions.append(controlPoint["position"])
+    else:
+        isLPS = False
+        with open(path, newline="") as landmarkFile:
+            for fields in csv.reader(landmarkFile):
+                if not fields:
+                    continue
+                if fields[0].startswith("#"):
+                    if "CoordinateSystem" in fields[0]:
+                        isLPS = fields[0].split("=")[-1].strip() in ("LPS", "1")
+                    continue
+                positions.append([float(value) for value in fields[1:4]])
+    landmarks = numpy.array(positions, dtype=numpy.float64).reshape(-1, 3)
+    if isLPS:
+        landmarks[:, 0:2] *= -1
+    return landmarks
+
+
+def writeITKTransform(matrix, path):
+    """Write the RAS to parent matrix as an ITK transform file (from parent, in LPS)"""
+    rasToLps = numpy.diag([-1.0, -1.0, 1.0, 1.0])
+    fromParent = numpy.linalg.inv(numpy.dot(rasToLps, numpy.dot(matrix, rasToLps)))
+    parameters = list(fromParent[0:3, 0:3].ravel()) + list(fromParent[0:3, 3])
+    with open(path, "w") as transformFile:
+        transformFile.write("#Insight Transform File V1.0\n")
+        transformFile.write("#Transform 0\n")
+        transformFile.write("Transform: AffineTransform_double_3_3\n")
+        transformFile.write("Parameters: " + " ".join("%.17g" % value for value in parameters) + "\n")
+        transformFile.write("FixedParameters: 0 0 0\n")
+
+
+def _roiPolyData(polyData, landmarks, roiRadius):
+    # same region as the module: the points reached from the closest point of each landmark
+    if roiRadius <= 0:
+        raise ValueError("roiRadius must be positive for ROI registration")
+    points = polyDataPointsAsArray(polyData)
+    distances, seedIds = ClosestPointFinder(points).query(landmarks)
+    indptr, indices = pointAdjacency(polyData)
+    roiPointIds = growRegion(indptr, indices, seedIds, [roiRadius] * len(seedIds), len(points))
+    return extractROIPolyData(polyData, roiPointIds)
+
+
+def _register(case, trace):
+    parameters = case["parameters"]
+    mode = case["mode"].lower()
+    if mode == "fiducial":
+        fixedLandmarks = readLandmarks(case["fixedLandmarks"])
+        movingLandmarks = readLandmarks(case["movingLandmarks"])
+        if len(fixedLandmarks) != len(movingLandmarks):
+            raise ValueError("Both models must have the same numbers of landmarks")
+        if len(fixedLandmarks) < 3:
+            raise ValueError("Landmarks lists must have at least 3 landmarks")
+        matrix, rmsError = registerFiducials(fixedLandmarks, movingLandmarks, parameters["fiducialTransformType"])
+        trace.setResult(0, rmsError)
+        return matrix, 0, rmsError
+    fixed = readModel(case["fixedModel"])
+    moving = readModel(case["movingModel"])
+    matchCentroids = parameters["matchCentroids"]
+    if mode == "roi":
+        fixed = _roiPolyData(fixed, readLandmarks(case["fixedLandmarks"]), parameters["roiRadius"])
+        moving = _roiPolyData(moving, readLandmarks(case["movingLandmarks"]), parameters["roiRadius"])
+        if matchCentroids is None:
+            matchCentroids = True
+    elif mode != "surface":
+        raise ValueError("Unknown registration mode: " + case["mode"])
+    cache = RegistrationCache(directory=case["cacheDirectory"]) if case.get("cacheDirectory") else None
+    if cache is not None:
+        cacheParameters = dict(parameters, mode=mode, matchCentroids=bool(matchCentroids))
+        del cacheParameters["writeTrace"]
+        cacheKey = cache.key(fixed, moving, cacheParameters)
+        cachedResult = cache.get(cacheKey)
+        if cachedResult is not None:
+            matrix, cachedTrace = cachedResult
+            trace.extend(cachedTrace)
+            trace.setResult(cachedTrace.numberOfIterations, cachedTrace.meanDistance)
+            case["isCached"] = True
+            return matrix, cachedTrace.numberOfIterations, cachedTrace.meanDistance
+    icpParameters = (parameters["meanDistanceType"], parameters["landmarkTransformType"],
+                     parameters["numberOfLandmarks"], parameters["maxDistance"], parameters["numberOfIterations"],
+                     bool(matchCentroids), parameters["checkMeanDistance"])
+    # vtkIterativeClosestPointTransform has neither point to plane distances nor trimming
+    if (parameters["icpEngine"] == "NumPy" or parameters["landmarkTransformType"] == "PointToPlane"
+            or parameters["trimFraction"] > 0):
+        fixedNormals = None
+        if parameters["landmarkTransformType"] == "PointToPlane":
+            fixedNormals = polyDataPointNormals(fixed)
+        result = runICP(polyDataPointsAsArray(fixed), polyDataPointsAsArray(moving), *icpParameters, trace=trace,
+                        fixedNormals=fixedNormals, trimFraction=parameters["trimFraction"])
+    else:
+        result = runVTKICP(fixed, moving, *icpParameters, trace=trace)
+    if cache is not None:
+        cache.put(cacheKey, result.matrix, trace)
+    return result.matrix, result.numberOfIterations, result.meanDistance
+
+
+def registerCase(case):
+    """Register one case and write its transform. Return its row of the summary table."""
+    summary = dict((column, "") for column in SUMMARY_COLUMNS)
+    summary.update({"caseID": case["caseID"], "mode": case["mode"], "status": "failed"})
+    startTime = time.time()
+    trace = ICPTrace(case["parameters"], case["parameters"]["writeTrace"]).start()
+    try:
+        matrix, numberOfIterations, meanDistance = _register(case, trace)
+        trace.stop()
+        transformPath = os.path.join(case["outputDirectory"], case["caseID"] + ".tfm")
+        writeITKTransform(matrix, transformPath)
+        if case["parameters"]["writeTrace"]:
+            trace.writeJSON(os.path.join(case["outputDirectory"], case["caseID"] + "_ICPTrace.json"))
+        summary.update({"status": "succeeded",
+                        "transform": transformPath,
+                        "numberOfIterations": numberOfIterations,
+                        "meanDistance": meanDistance,
+                        "peakMemory": trace.peakMemory,
+                        "message": "cached result" if case.get("isCached") else ""})
+    except Exception as e:
+        if trace.wallTime is None:
+            trace.stop()
+        summary["message"] = "%s: %s" % (type(e).__name__, e)
+    summary["seconds"] = round(time.time() - startTime, 3)
+    return summary
+
+
+def runBatch(manifestPath, outputDirectory, numberOfWorkers=None, cacheDirectory=None):
+    """Register all the cases of the manifest in a process pool and write summary.csv"""
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    cases = readManifest(manifestPath, outputDirectory)
+    for case in cases:
+        case["cacheDirectory"] = cacheDirectory
+    summaries = [None] * len(cases)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+        futures = dict((executor.submit(registerCase, case), index) for index, case in enumerate(cases))
+        for future in concurrent.futures.as_completed(futures):
+            summary = future.result()
+            summaries[futures[future]] = summary
+            print(summary["caseID"], summary["status"], summary["message"])
+    with open(os.path.join(outputDirectory, "summary.csv"), "w", newline="") as summaryFile:
+        writer = csv.DictWriter(summaryFile, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(summaries)
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Surface registration of the cases of a cohort manifest.")
+    parser.add_argument("manifest", help="CSV file with one case per row")
+    parser.add_argument("outputDirectory", help="directory of the transforms and of summary.csv")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument("--cache", default=None,
+                        help="directory where the ICP results are kept and reused between runs")
+    args = parser.parse_args(argv)
+    summaries = runBatch(args.manifest, args.outputDirectory, args.workers, args.cache)
+    return 0 if all(summary["status"] == "succeeded" for summary in summaries) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import json
+import time
+import tracemalloc
+
+import numpy
+
+__all__ = ["ICPTrace"]
+
+
+class ICPTrace(object):
+    """Convergence and timing record of one ICP registration.
+
+    Each iteration of the NumPy engine records the mean distance between the
+    landmarks and their closest fixed points, the rotation (in degrees) and
+    the translation of the transform found by this iteration, and the time
+    spent in the closest point search and in the landmark transform solve.
+    The VTK engine only reports its number of iterations and final mean
+    distance.
+
+    With traceMemory, the peak memory is measured by tracemalloc between
+    start() and stop(): it includes the numpy arrays but not the memory
+    allocated by VTK. Tracing the allocations makes the NumPy engine several
+    times slower, it is off by default.
+    """
+
+    def __init__(self, parameters=None, traceMemory=False):
+        self.parameters = dict(parameters or dict())
+        self.traceMemory = traceMemory
+        self.stage = ""
+        self.iterations = list()
+        self.numberOfIterations = 0
+        self.meanDistance = None
+        self.wallTime = None
+        self.peakMemory = None
+        self._startTime = None
+        self._startedTracemalloc = False
+
+    @classmethod
+    def fromDict(cls, dictionary):
+        """Trace from its toDict() dictionary"""
+        trace = cls(dictionary.get("parameters"))
+        trace.iterations = list(dictionary.get("iterations", list()))
+        trace.setResult(dictionary.get("numberOfIterations", 0), dictionary.get("meanDistance"))
+        trace.wallTime = dictionary.get("wallTime")
+        trace.peakMemory = dictionary.get("peakMemory")
+        return trace
+
+    def start(self):
+        self._startTime = time.perf_counter()
+        if self.traceMemory:
+            self._startedTracemalloc = not tracemalloc.is_tracing()
+            if self._startedTracemalloc:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        return self
+
+    def stop(self):
+        self.wallTime = time.perf_counter() - self._startTime
+        if self.traceMemory:
+            self.peakMemory = tracemalloc.get_traced_memory()[1]
+            if self._startedTracemalloc:
+                tracemalloc.stop()
+        return self
+
+    def addIteration(self, meanDistance, landmarkMatrix, searchTime, solveTime):
+        rotationCosine = (numpy.trace(landmarkMatrix[0:3, 0:3]) - 1.0) / 2.0
+        self.iterations.append({"stage": self.stage,
+                                "meanDistance": float(meanDistance),
+                                "rotationDelta": float(numpy.degrees(numpy.arccos(numpy.clip(rotationCosine, -1, 1)))),
+                                "translationDelta": float(numpy.linalg.norm(landmarkMatrix[0:3, 3])),
+                                "searchTime": searchTime,
+                                "solveTime": solveTime})
+
+    def extend(self, trace):
+        """Append the iterations of another trace, e.g. of one level or one start"""
+        self.iterations.extend(trace.iterations)
+
+    def setResult(self, numberOfIterations, meanDistance):
+        self.numberOfIterations = int(numberOfIterations)
+        self.meanDistance = None if meanDistance is None else float(meanDistance)
+
+    def totalSearchTime(self):
+        return sum(iteration["searchTime"] for iteration in self.iterations)
+
+    def totalSolveTime(self):
+        return sum(iteration["solveTime"] for iteration in self.iterations)
+
+    def toDict(self):
+        return {"parameters": self.parameters,
+                "numberOfIterations": self.numberOfIterations,
+                "meanDistance": self.meanDistance,
+                "wallTime": self.wallTime,
+                "searchTime": self.totalSearchTime(),
+                "solveTime": self.totalSolveTime(),
+                "peakMemory": self.peakMemory,
+                "iterations": self.iterations}
+
+    def writeJSON(self, path):
+        with open(path, "w") as traceFile:
+            json.dump(self.toDict(), traceFile, indent=2)
+
+    def summary(self):
+        text = "ICP: %d iterations in %.3f s" % (self.numberOfIterations, self.wallTime or 0.0)
+        if self.iterations:
+            text += " (search %.3f s, solve %.3f s)" % (self.totalSearchTime(), self.totalSolveTime())
+        if self.meanDistance is not None:
+            text += ", mean distance %g" % self.meanDistance
+        if self.peakMemory is not None:
+            text += ", peak memory %.1f MB" % (self.peakMemory / 1e6)
+        return text
@@ -0,0 +1,553 @@
+import concurrent.futures
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from .ICPTrace import ICPTrace
+
+__all__ = ["ClosestPointFinder", "ICPResult", "computeLandmarkTransform", "computePointToPlaneTransform",
+           "polyDataPointNormals", "polyDataPointsAsArray",
+           "registerFiducials", "runICP", "runMultiStartICP", "runVTKICP", "sampleRotations", "matrixToVTK"]
+
+
+def polyDataPointsAsArray(polyData):
+    """Return the points of a vtkPolyData as a (n, 3) numpy array sharing the vtk buffer."""
+    points = polyData.GetPoints()
+    if points is None:
+        return numpy.zeros((0, 3))
+    return numpy_support.vtk_to_numpy(points.GetData())
+
+
+def polyDataPointNormals(polyData):
+    """(n, 3) array of the point normals of a vtkPolyData, computed by vtkPolyDataNormals if it has none."""
+    normals = polyData.GetPointData().GetNormals()
+    if normals is None:
+        # without splitting, the output has the same points as the input
+        normalsFilter = vtk.vtkPolyDataNormals()
+        normalsFilter.SetInputData(polyData)
+        normalsFilter.ComputePointNormalsOn()
+        normalsFilter.ComputeCellNormalsOff()
+        normalsFilter.SplittingOff()
+        normalsFilter.Update()
+        normals = normalsFilter.GetOutput().GetPointData().GetNormals()
+    if normals is None:
+        return numpy.zeros((polyData.GetNumberOfPoints(), 3))
+    return numpy_support.vtk_to_numpy(normals)
+
+
+def matrixToVTK(matrix):
+    """Copy a 4x4 numpy matrix in a new vtkMatrix4x4."""
+    outputMatrix = vtk.vtkMatrix4x4()
+    for i in range(0, 4):
+        for j in range(0, 4):
+            outputMatrix.SetElement(i, j, matrix[i, j])
+    return outputMatrix
+
+
+class ClosestPointFinder(object):
+    """Nearest neighbour search on a fixed set of points.
+
+    A scipy KD-tree is built once and queried with whole arrays of points. When
+    scipy is not available, a vtkStaticPointLocator is used instead.
+    """
+
+    def __init__(self, points):
+        self.points = numpy.asarray(points)
+        self.tree = None
+        self.locator = None
+        if cKDTree is not None:
+            self.tree = cKDTree(self.points)
+        else:
+            polyData = vtk.vtkPolyData()
+            vtkPoints = vtk.vtkPoints()
+            vtkPoints.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(self.points), deep=1))
+            polyData.SetPoints(vtkPoints)
+            self.locator = vtk.vtkStaticPointLocator()
+            self.locator.SetDataSet(polyData)
+            self.locator.BuildLocator()
+
+    def query(self, queryPoints):
+        """Return the distances and the indices of the closest points of queryPoints."""
+        queryPoints = numpy.asarray(queryPoints, dtype=numpy.float64)
+        if self.tree is not None:
+            distances, indices = self.tree.query(queryPoints)
+            return distances, indices
+        indices = numpy.empty(len(queryPoints), dtype=numpy.int64)
+        for i in range(0, len(queryPoints)):
+            indices[i] = self.locator.FindClosestPoint(queryPoints[i])
+        distances = numpy.linalg.norm(self.points[indices] - queryPoints, axis=1)
+        return distances, indices
+
+
+class ICPResult(object):
+    """Output of runICP: the 4x4 matrix from moving to fixed and the convergence state."""
+
+    def __init__(self, matrix, numberOfIterations, meanDistance):
+        self.matrix = matrix
+        self.numberOfIterations = numberOfIterations
+        self.meanDistance = meanDistance
+
+
+def _perpendicular(v1):
+    # same choice of perpendicular vector as vtkMath::Perpendiculars with theta = 0
+    x2, y2, z2 = v1[0] * v1[0], v1[1] * v1[1], v1[2] * v1[2]
+    r = numpy.sqrt(x2 + y2 + z2)
+    if x2 > y2 and x2 > z2:
+        dx, dy, dz = 0, 1, 2
+    elif y2 > z2:
+        dx, dy, dz = 1, 2, 0
+    else:
+        dx, dy, dz = 2, 0, 1
+    a = v1[dx] / r
+    c = v1[dz] / r
+    tmp = numpy.sqrt(a * a + c * c)
+    v2 = numpy.zeros(3)
+    v2[dx] = c / tmp
+    v2[dy] = 0.0
+    v2[dz] = -a / tmp
+    return v2
+
+
+def computeLandmarkTransform(source, target, landmarkTransformType):
+    """Closed-form least square transform mapping source on target.
+
+    This follows vtkLandmarkTransform: Horn's quaternion method for "RigidBody"
+    and "Similarity", linear least squares for "Affine".
+    """
+    matrix = numpy.identity(4)
+    numberOfPoints = len(source)
+    if numberOfPoints == 0:
+        return matrix
+    sourceCentroid = source.mean(axis=0)
+    targetCentroid = target.mean(axis=0)
+    if numberOfPoints == 1:
+        matrix[0:3, 3] = targetCentroid - sourceCentroid
+        return matrix
+    a = source - sourceCentroid
+    b = target - targetCentroid
+    M = numpy.dot(a.T, b)
+    if landmarkTransformType == "Affine":
+        AAT = numpy.linalg.inv(numpy.dot(a.T, a))
+        matrix[0:3, 0:3] = numpy.dot(AAT, M).T
+    else:
+        sa = numpy.sum(a * a)
+        sb = numpy.sum(b * b)
+        scale = numpy.sqrt(sb / sa)
+        N = numpy.empty((4, 4))
+        N[0, 0] = M[0, 0] + M[1, 1] + M[2, 2]
+        N[1, 1] = M[0, 0] - M[1, 1] - M[2, 2]
+        N[2, 2] = -M[0, 0] + M[1, 1] - M[2, 2]
+        N[3, 3] = -M[0, 0] - M[1, 1] + M[2, 2]
+        N[0, 1] = N[1, 0] = M[1, 2] - M[2, 1]
+        N[0, 2] = N[2, 0] = M[2, 0] - M[0, 2]
+        N[0, 3] = N[3, 0] = M[0, 1] - M[1, 0]
+        N[1, 2] = N[2, 1] = M[0, 1] + M[1, 0]
+        N[1, 3] = N[3, 1] = M[2, 0] + M[0, 2]
+        N[2, 3] = N[3, 2] = M[1, 2] + M[2, 1]
+        eigenvalues, eigenvectors = numpy.linalg.eigh(N)
+        # the eigenvector with the largest eigenvalue is the quaternion we want
+        w, x, y, z = eigenvectors[:, 3]
+        # if the points are collinear, choose the quaternion that results in the smallest rotation
+        if eigenvalues[3] == eigenvalues[2] or numberOfPoints == 2:
+            ds = source[1] - source[0]
+            dt = target[1] - target[0]
+            ds = ds / numpy.linalg.norm(ds)
+            dt = dt / numpy.linalg.norm(dt)
+            w = numpy.dot(ds, dt)
+            x, y, z = numpy.cross(ds, dt)
+            r = numpy.sqrt(x * x + y * y + z * z)
+            theta = numpy.arctan2(r, w)
+            w = numpy.cos(theta / 2)
+            if r != 0:
+                r = numpy.sin(theta / 2) / r
+                x, y, z = x * r, y * r, z * r
+            else:
+                # rotation by 180 degrees: rotate around a vector perpendicular to ds
+                r = numpy.sin(theta / 2)
+                x, y, z = _perpendicular(ds) * r
+        ww, xx, yy, zz = w * w, x * x, y * y, z * z
+        wx, wy, wz = w * x, w * y, w * z
+        xy, xz, yz = x * y, x * z, y * z
+        rotation = numpy.array([[ww + xx - yy - zz, 2.0 * (-wz + xy), 2.0 * (wy + xz)],
+                                [2.0 * (wz + xy), ww - xx + yy - zz, 2.0 * (-wx + yz)],
+                                [2.0 * (-wy + xz), 2.0 * (wx + yz), ww - xx - yy + zz]])
+        if landmarkTransformType != "RigidBody":
+            rotation *= scale
+        matrix[0:3, 0:3] = rotation
+    # the translation is given by the difference between the transformed source centroid and the target centroid
+    matrix[0:3, 3] = targetCentroid - numpy.dot(matrix[0:3, 0:3], sourceCentroid)
+    return matrix
+
+
+def computePointToPlaneTransform(source, target, targetNormals):
+    """Rigid transform minimizing the distances from source to the tangent planes of target.
+
+    The rotation is linearized around the source centroid, so the result is
+    exact for small rotations only: it is meant to be iterated by the ICP.
+    """
+    matrix = numpy.identity(4)
+    if len(source) < 3:
+        return computeLandmarkTransform(source, target, "RigidBody")
+    sourceCentroid = source.mean(axis=0)
+    a = source - sourceCentroid
+    # the lever arms are normalized so that the rotation and translation columns are comparable
+    scale = numpy.sqrt(numpy.mean(numpy.sum(a * a, axis=1))) or 1.0
+    # residual of a pair: n.(R p + t - q) ~ (p x n).w + n.t + n.(p - q)
+    A = numpy.hstack((numpy.cross(a / scale, targetNormals), targetNormals))
+    b = numpy.sum((target - source) * targetNormals, axis=1)
+    # the directions left unconstrained by the surface (e.g. rotations of a sphere) are not moved
+    x = numpy.linalg.lstsq(A, b, rcond=1e-3)[0]
+    x[0:3] /= scale
+    angle = numpy.linalg.norm(x[0:3])
+    if angle > 0:
+        # rotation of the linearized angles, kept orthonormal
+        k = x[0:3] / angle
+        K = numpy.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+        matrix[0:3, 0:3] = numpy.identity(3) + numpy.sin(angle) * K + (1 - numpy.cos(angle)) * numpy.dot(K, K)
+    matrix[0:3, 3] = sourceCentroid + x[3:6] - numpy.dot(matrix[0:3, 0:3], sourceCentroid)
+    return matrix
+
+
+def _setLandmarkTransformMode(landmarkTransform, landmarkTransformType):
+    if landmarkTransformType == "RigidBody":
+        landmarkTransform.SetModeToRigidBody()
+    elif landmarkTransformType == "Similarity":
+        landmarkTransform.SetModeToSimilarity()
+    elif landmarkTransformType == "Affine":
+        landmarkTransform.SetModeToAffine()
+
+
+def _matrixFromVTK(vtkMatrix):
+    return numpy.array([[vtkMatrix.GetElement(i, j) for j in range(0, 4)] for i in range(0, 4)])
+
+
+def runVTKICP(fixed, moving, meanDistanceType, landmarkTransformType,
+              numberOfLandmarks, maxDistance, numberOfIterations, matchCentroids,
+              checkMeanDistance, trace=None):
+    """vtkIterativeClosestPointTransform registration of the moving polydata on the fixed one.
+
+    vtkIterativeClosestPointTransform does not report its iterations. When an
+    ICPTrace is given, the same iterations are run here, one at a time, to
+    add them to the trace (see _runSteppedVTKICP).
+    """
+    if trace is not None:
+        return _runSteppedVTKICP(fixed, moving, meanDistanceType, landmarkTransformType, numberOfLandmarks,
+                                 maxDistance, numberOfIterations, matchCentroids, checkMeanDistance, trace)
+    icp = vtk.vtkIterativeClosestPointTransform()
+    icp.SetSource(moving)
+    icp.SetTarget(fixed)
+    _setLandmarkTransformMode(icp.GetLandmarkTransform(), landmarkTransformType)
+    if meanDistanceType == "Root Mean Square":
+        icp.SetMeanDistanceModeToRMS()
+    elif meanDistanceType == "Absolute Value":
+        icp.SetMeanDistanceModeToAbsoluteValue()
+    icp.SetMaximumNumberOfIterations(numberOfIterations)
+    icp.SetMaximumMeanDistance(maxDistance)
+    icp.SetMaximumNumberOfLandmarks(numberOfLandmarks)
+    icp.SetCheckMeanDistance(int(checkMeanDistance))
+    icp.SetStartByMatchingCentroids(int(matchCentroids))
+    icp.Update()
+    outputMatrix = vtk.vtkMatrix4x4()
+    icp.GetMatrix(outputMatrix)
+    return ICPResult(_matrixFromVTK(outputMatrix), icp.GetNumberOfIterations(), icp.GetMeanDistance())
+
+
+def _runSteppedVTKICP(fixed, moving, meanDistanceType, landmarkTransformType, numberOfLandmarks,
+                      maxDistance, numberOfIterations, matchCentroids, checkMeanDistance, trace):
+    # The iterations of vtkIterativeClosestPointTransform, which cannot be stepped since it rebuilds its
+    # locator at each update: same landmarks, closest points on the cells of a vtkCellLocator and
+    # vtkLandmarkTransform solve. The landmarks are kept in single precision and the matrices accumulated
+    # as vtk does, so that the result is the same.
+    movingPoints = polyDataPointsAsArray(moving)
+    accumulate = vtk.vtkMatrix4x4()
+    numberOfPoints = len(movingPoints)
+    if numberOfPoints == 0 or fixed.GetNumberOfPoints() == 0:
+        trace.setResult(0, 0.0)
+        return ICPResult(_matrixFromVTK(accumulate), 0, 0.0)
+    step = 1
+    if numberOfLandmarks < numberOfPoints:
+        step = numberOfPoints // numberOfLandmarks
+        numberOfPoints = numberOfPoints // step
+    landmarks = movingPoints[0:numberOfPoints * step:step].astype(numpy.float32)
+    if matchCentroids:
+        # sums in sequence, as vtk
+        fixedPoints = polyDataPointsAsArray(fixed)
+        translation = numpy.cumsum(fixedPoints, axis=0, dtype=numpy.float64)[-1] / len(fixedPoints) - \
+            numpy.cumsum(movingPoints, axis=0, dtype=numpy.float64)[-1] / len(movingPoints)
+        for i in range(0, 3):
+            accumulate.SetElement(i, 3, translation[i])
+        landmarks = (landmarks + translation).astype(numpy.float32)
+
+    locator = vtk.vtkCellLocator()
+    locator.SetDataSet(fixed)
+    locator.SetNumberOfCellsPerBucket(1)
+    locator.BuildLocator()
+    landmarkTransform = vtk.vtkLandmarkTransform()
+    _setLandmarkTransformMode(landmarkTransform, landmarkTransformType)
+    sourcePoints = vtk.vtkPoints()
+    targetPoints = vtk.vtkPoints()
+    landmarkTransform.SetSourceLandmarks(sourcePoints)
+    landmarkTransform.SetTargetLandmarks(targetPoints)
+    closestPoints = numpy.empty(landmarks.shape, dtype=numpy.float32)
+    closestPoint = [0.0, 0.0, 0.0]
+    cellId = vtk.reference(0)
+    subId = vtk.reference(0)
+    distance2 = vtk.reference(0.0)
+    iteration = 0
+    meanDistance = 0.0
+    while True:
+        searchStart = time.perf_counter()
+        for i in range(0, len(landmarks)):
+            locator.FindClosestPoint(landmarks[i].tolist(), closestPoint, cellId, subId, distance2)
+            closestPoints[i] = closestPoint
+        solveStart = time.perf_counter()
+        sourcePoints.SetData(numpy_support.numpy_to_vtk(landmarks, deep=1))
+        targetPoints.SetData(numpy_support.numpy_to_vtk(closestPoints, deep=1))
+        landmarkTransform.Modified()
+        landmarkTransform.Update()
+        vtk.vtkMatrix4x4.Multiply4x4(landmarkTransform.GetMatrix(), accumulate, accumulate)
+        landmarkMatrix = _matrixFromVTK(landmarkTransform.GetMatrix())
+        solveEnd = time.perf_counter()
+        trace.addIteration(_meanDistance(numpy.linalg.norm(closestPoints - landmarks, axis=1), meanDistanceType),
+                           landmarkMatrix, solveStart - searchStart, solveEnd - solveStart)
+        iteration += 1
+        if iteration >= numberOfIterations:
+            break
+        # same order of the operations as vtkLinearTransform
+        landmarks64 = landmarks.astype(numpy.float64)
+        movedLandmarks = numpy.empty(landmarks.shape, dtype=numpy.float32)
+        for i in range(0, 3):
+            movedLandmarks[:, i] = landmarkMatrix[i, 0] * landmarks64[:, 0] + landmarkMatrix[i, 1] * landmarks64[:, 1] \
+                + landmarkMatrix[i, 2] * landmarks64[:, 2] + landmarkMatrix[i, 3]
+        if checkMeanDistance:
+            meanDistance = _meanDistance(numpy.linalg.norm(movedLandmarks.astype(numpy.float64) - landmarks64, axis=1),
+                                         meanDistanceType)
+            if meanDistance <= maxDistance:
+                break
+        landmarks = movedLandmarks
+    trace.setResult(iteration, meanDistance)
+    return ICPResult(_matrixFromVTK(accumulate), iteration, meanDistance)
+
+
+def registerFiducials(fixedPoints, movingPoints, transformType):
+    """Least square "Translation", "Rigid" or "Similarity" transform from the moving to the fixed points.
+
+    Return the 4x4 matrix and the root mean square distance between the
+    transformed moving points and the fixed points.
+    """
+    fixedPoints = numpy.asarray(fixedPoints, dtype=numpy.float64)
+    movingPoints = numpy.asarray(movingPoints, dtype=numpy.float64)
+    if transformType == "Translation":
+        matrix = numpy.identity(4)
+        matrix[0:3, 3] = fixedPoints.mean(axis=0) - movingPoints.mean(axis=0)
+    elif transformType == "Rigid":
+        matrix = computeLandmarkTransform(movingPoints, fixedPoints, "RigidBody")
+    elif transformType == "Similarity":
+        matrix = computeLandmarkTransform(movingPoints, fixedPoints, "Similarity")
+    else:
+        raise ValueError("Unknown fiducial transform type: " + transformType)
+    residuals = numpy.dot(movingPoints, matrix[0:3, 0:3].T) + matrix[0:3, 3] - fixedPoints
+    rmsError = float(numpy.sqrt(numpy.mean(numpy.sum(residuals * residuals, axis=1)))) if len(residuals) else 0.0
+    return matrix, rmsError
+
+
+def _meanDistance(distances, meanDistanceType):
+    if len(distances) == 0:
+        return 0.0
+    if meanDistanceType == "Root Mean Square":
+        return float(numpy.sqrt(numpy.mean(distances * distances)))
+    return float(numpy.mean(distances))
+
+
+def runICP(fixedPoints, movingPoints, meanDistanceType, landmarkTransformType,
+           numberOfLandmarks, maxDistance, numberOfIterations, matchCentroids,
+           checkMeanDistance, closestPointFinder=None, trace=None, fixedNormals=None, trimFraction=0.0):
+    """Iterative closest point registration of movingPoints on fixedPoints.
+
+    The parameters and the stopping criteria are the ones of
+    vtkIterativeClosestPointTransform, but the closest points of all the
+    landmarks are found with one query per iteration and the transform is
+    solved on numpy arrays. The correspondences are the closest vertices of
+    the fixed mesh instead of the closest points on its cells.
+
+    landmarkTransformType can also be "PointToPlane": a rigid transform
+    minimizing the distances to the tangent planes of the fixed points, given
+    by fixedNormals, which usually converges in much less iterations on
+    smooth surfaces. With a trimFraction, this fraction of the pairs having
+    the largest distances is left out of each transform estimation, so that
+    the regions without overlap do not bias the result.
+
+    When an ICPTrace is given, the mean distance, transform and timings of
+    each iteration are added to it.
+    """
+    movingPoints = numpy.asarray(movingPoints)
+    if closestPointFinder is None:
+        closestPointFinder = ClosestPointFinder(fixedPoints)
+    fixedPoints = closestPointFinder.points
+    if landmarkTransformType == "PointToPlane":
+        if fixedNormals is None or len(fixedNormals) != len(fixedPoints):
+            raise ValueError("PointToPlane ICP needs one normal per fixed point")
+        fixedNormals = numpy.asarray(fixedNormals, dtype=numpy.float64)
+    accumulate = numpy.identity(4)
+    numberOfPoints = len(movingPoints)
+    if numberOfPoints == 0 or len(fixedPoints) == 0:
+        return ICPResult(accumulate, 0, 0.0)
+
+    # Take a subset of the moving points as landmarks, the same way vtk does
+    step = 1
+    if numberOfLandmarks < numberOfPoints:
+        step = numberOfPoints // numberOfLandmarks
+        numberOfPoints = numberOfPoints // step
+    landmarks = movingPoints[0:numberOfPoints * step:step].astype(numpy.float64)
+
+    if matchCentroids:
+        translation = fixedPoints.mean(axis=0, dtype=numpy.float64) - movingPoints.mean(axis=0, dtype=numpy.float64)
+        accumulate[0:3, 3] = translation
+        landmarks += translation
+
+    numberOfPairs = len(landmarks)
+    if trimFraction > 0:
+        numberOfPairs = min(numberOfPairs, max(3, int(round(numberOfPairs * (1.0 - trimFraction)))))
+    iteration = 0
+    meanDistance = 0.0
+    while True:
+        searchStart = time.perf_counter()
+        distances, indices = closestPointFinder.query(landmarks)
+        solveStart = time.perf_counter()
+        source = landmarks
+        if numberOfPairs < len(landmarks):
+            pairs = numpy.argpartition(distances, numberOfPairs - 1)[0:numberOfPairs]
+            source, distances, indices = landmarks[pairs], distances[pairs], indices[pairs]
+        if landmarkTransformType == "PointToPlane":
+            landmarkMatrix = computePointToPlaneTransform(source, fixedPoints[indices], fixedNormals[indices])
+        else:
+            landmarkMatrix = computeLandmarkTransform(source, fixedPoints[indices], landmarkTransformType)
+        if trace is not None:
+            solveEnd = time.perf_counter()
+            trace.addIteration(_meanDistance(distances, meanDistanceType), landmarkMatrix,
+                               solveStart - searchStart, solveEnd - solveStart)
+        accumulate = numpy.dot(landmarkMatrix, accumulate)
+        iteration += 1
+        if iteration >= numberOfIterations:
+            break
+        movedLandmarks = numpy.dot(landmarks, landmarkMatrix[0:3, 0:3].T) + landmarkMatrix[0:3, 3]
+        if checkMeanDistance:
+            meanDistance = _meanDistance(numpy.linalg.norm(movedLandmarks - landmarks, axis=1), meanDistanceType)
+            if meanDistance <= maxDistance:
+                break
+        landmarks = movedLandmarks
+    if trace is not None:
+        trace.setResult(iteration, meanDistance)
+    return ICPResult(accumulate, iteration, meanDistance)
+
+
+def sampleRotations(numberOfRotations):
+    """(n, 3, 3) rotation matrices spread uniformly over SO(3), the first one being the identity.
+
+    The other rotations are given by a super-Fibonacci spiral of quaternions,
+    which is deterministic and covers SO(3) evenly for any n.
+    """
+    rotations = [numpy.identity(3)]
+    numberOfSamples = numberOfRotations - 1
+    phi = numpy.sqrt(2.0)
+    psi = 1.533751168755204288118041
+    for i in range(0, numberOfSamples):
+        s = i + 0.5
+        r = numpy.sqrt(s / numberOfSamples)
+        R = numpy.sqrt(1.0 - s / numberOfSamples)
+        alpha = 2.0 * numpy.pi * s / phi
+        beta = 2.0 * numpy.pi * s / psi
+        x, y, z, w = r * numpy.sin(alpha), r * numpy.cos(alpha), R * numpy.sin(beta), R * numpy.cos(beta)
+        rotations.append(numpy.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                                      [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                                      [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]]))
+    return numpy.array(rotations[0:max(1, numberOfRotations)])
+
+
+def _transformPoints(points, matrix):
+    return numpy.dot(points, matrix[0:3, 0:3].T) + matrix[0:3, 3]
+
+
+def _subsample(points, numberOfPoints):
+    if len(points) <= numberOfPoints:
+        return numpy.asarray(points, dtype=numpy.float64)
+    step = len(points) // numberOfPoints
+    return numpy.asarray(points[0:numberOfPoints * step:step], dtype=numpy.float64)
+
+
+def runMultiStartICP(fixedPoints, movingPoints, meanDistanceType, landmarkTransformType,
+                     numberOfLandmarks, maxDistance, numberOfIterations, checkMeanDistance,
+                     numberOfStarts, numberOfRefinedStarts=3, numberOfSubsampledPoints=2000,
+                     maxWorkers=None, trace=None, fixedNormals=None, trimFraction=0.0, refine=None):
+    """ICP started from several rotations of the moving points around their centroid.
+
+    Each start rotates the moving points around their centroid and moves it on
+    the fixed centroid. All the starts are run concurrently on subsampled
+    points, then the numberOfRefinedStarts with the lowest residual are run
+    again from their result on all the points. Return the ICPResult of the
+    start with the lowest residual, its meanDistance being this residual
+    (mean distance from the moving points to their closest fixed point).
+    The iterations of the refinement of this start are added to the trace.
+
+    refine(startMatrix, startTrace) replaces the NumPy ICP of the refinement:
+    it returns the ICPResult registering the moving points transformed by
+    startMatrix. The refined starts are then run one after the other.
+    """
+    fixedPoints = numpy.asarray(fixedPoints)
+    movingPoints = numpy.asarray(movingPoints)
+    if len(fixedPoints) == 0 or len(movingPoints) == 0:
+        return ICPResult(numpy.identity(4), 0, 0.0)
+    fixedCentroid = fixedPoints.mean(axis=0, dtype=numpy.float64)
+    movingCentroid = movingPoints.mean(axis=0, dtype=numpy.float64)
+    startMatrices = list()
+    for rotation in sampleRotations(numberOfStarts):
+        startMatrix = numpy.identity(4)
+        startMatrix[0:3, 0:3] = rotation
+        startMatrix[0:3, 3] = fixedCentroid - numpy.dot(rotation, movingCentroid)
+        startMatrices.append(startMatrix)
+
+    def register(finder, normals, points, startMatrix, iterations, startTrace=None):
+        result = runICP(finder.points, _transformPoints(points, startMatrix), meanDistanceType,
+                        landmarkTransformType, numberOfLandmarks, maxDistance, iterations,
+                        False, checkMeanDistance, finder, startTrace, normals, trimFraction)
+        matrix = numpy.dot(result.matrix, startMatrix)
+        distances, indices = finder.query(_transformPoints(points, matrix))
+        return ICPResult(matrix, result.numberOfIterations, float(numpy.mean(distances)))
+
+    # the KD-tree queries release the GIL, the starts are run in threads sharing the trees
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        coarseFinder = ClosestPointFinder(_subsample(fixedPoints, numberOfSubsampledPoints))
+        coarseNormals = None if fixedNormals is None else _subsample(fixedNormals, numberOfSubsampledPoints)
+        coarseMoving = _subsample(movingPoints, numberOfSubsampledPoints)
+        coarseResults = list(executor.map(lambda startMatrix: register(coarseFinder, coarseNormals, coarseMoving,
+                                                                       startMatrix, numberOfIterations),
+                                          startMatrices))
+        coarseResults.sort(key=lambda result: result.meanDistance)
+        finder = ClosestPointFinder(fixedPoints)
+        refinedStarts = coarseResults[0:max(1, numberOfRefinedStarts)]
+        startTraces = [None if trace is None else ICPTrace() for result in refinedStarts]
+        if refine is None:
+            refinedResults = list(executor.map(lambda result, startTrace: register(finder, fixedNormals,
+                                                                                   movingPoints, result.matrix,
+                                                                                   numberOfIterations, startTrace),
+                                               refinedStarts, startTraces))
+        else:
+            refinedResults = list()
+            for result, startTrace in zip(refinedStarts, startTraces):
+                refinedResult = refine(result.matrix, startTrace)
+                matrix = numpy.dot(refinedResult.matrix, result.matrix)
+                distances, indices = finder.query(_transformPoints(movingPoints, matrix))
+                refinedResults.append(ICPResult(matrix, refinedResult.numberOfIterations,
+                                                float(numpy.mean(distances))))
+    best = min(range(0, len(refinedResults)), key=lambda index: refinedResults[index].meanDistance)
+    if trace is not None:
+        trace.extend(startTraces[best])
+        trace.setResult(refinedResults[best].numberOfIterations, refinedResults[best].meanDistance)
+    return refinedResults[best]
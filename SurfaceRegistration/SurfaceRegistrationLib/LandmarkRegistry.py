@@ -0,0 +1,118 @@
+__all__ = ["LandmarkRecord", "LandmarkRegistry"]
+
+
+class LandmarkRecord(object):
+    """State of one landmark: label, ROI radius, projection on the model and midpoint definition."""
+
+    __slots__ = ("landmarkLabel", "ROIradius", "isProjected", "closestPointIndex",
+                 "definedByThisMarkup", "isMidPoint", "point1", "point2")
+
+    def __init__(self, landmarkLabel, ROIradius=0, isProjected=False, closestPointIndex=None):
+        self.landmarkLabel = landmarkLabel
+        self.ROIradius = ROIradius
+        self.isProjected = isProjected
+        self.closestPointIndex = closestPointIndex
+        self.definedByThisMarkup = list()
+        self.isMidPoint = False
+        self.point1 = None
+        self.point2 = None
+
+    @classmethod
+    def fromDescription(cls, description):
+        """Record from its dictionary in the landmarkDescription attribute"""
+        projection = description.get("projection", dict())
+        midPoint = description.get("midPoint", dict())
+        record = cls(description.get("landmarkLabel"), description.get("ROIradius", 0),
+                     projection.get("isProjected", False), projection.get("closestPointIndex"))
+        record.definedByThisMarkup = list(midPoint.get("definedByThisMarkup", list()))
+        record.isMidPoint = midPoint.get("isMidPoint", False)
+        record.point1 = midPoint.get("Point1")
+        record.point2 = midPoint.get("Point2")
+        return record
+
+    def toDescription(self):
+        return {"landmarkLabel": self.landmarkLabel,
+                "ROIradius": self.ROIradius,
+                "projection": {"isProjected": self.isProjected,
+                               "closestPointIndex": self.closestPointIndex},
+                "midPoint": {"definedByThisMarkup": list(self.definedByThisMarkup),
+                             "isMidPoint": self.isMidPoint,
+                             "Point1": self.point1,
+                             "Point2": self.point2}}
+
+
+class LandmarkRegistry(object):
+    """Landmark records of a fiducial list, indexed by markup ID and by label.
+
+    When several landmarks share a label, the label refers to the first one
+    added, as the linear search on the landmarkDescription attribute did.
+    """
+
+    def __init__(self):
+        self.records = dict()
+        self.labelIndex = dict()
+
+    @classmethod
+    def fromDescription(cls, landmarkDescription):
+        """Registry from the decoded landmarkDescription attribute"""
+        registry = cls()
+        for markupID, description in landmarkDescription.items():
+            registry.add(markupID, LandmarkRecord.fromDescription(description))
+        return registry
+
+    def toDescription(self):
+        """Dictionary to store in the landmarkDescription attribute"""
+        return dict((markupID, record.toDescription()) for markupID, record in self.records.items())
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, markupID):
+        return markupID in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, markupID):
+        return self.records[markupID]
+
+    def get(self, markupID):
+        return self.records.get(markupID)
+
+    def items(self):
+        return self.records.items()
+
+    def add(self, markupID, record):
+        self.remove(markupID)
+        self.records[markupID] = record
+        self.labelIndex.setdefault(record.landmarkLabel, markupID)
+        return record
+
+    def remove(self, markupID):
+        record = self.records.pop(markupID, None)
+        if record is not None:
+            self._unindexLabel(markupID, record.landmarkLabel)
+        return record
+
+    def setLabel(self, markupID, landmarkLabel):
+        record = self.records[markupID]
+        if record.landmarkLabel == landmarkLabel:
+            return
+        previousLabel = record.landmarkLabel
+        record.landmarkLabel = landmarkLabel
+        self._unindexLabel(markupID, previousLabel)
+        self.labelIndex.setdefault(landmarkLabel, markupID)
+
+    def findID(self, landmarkLabel):
+        """ID of the landmark with this label, None if there is none"""
+        return self.labelIndex.get(landmarkLabel)
+
+    def _unindexLabel(self, markupID, landmarkLabel):
+        if self.labelIndex.get(landmarkLabel) != markupID:
+            return
+        del self.labelIndex[landmarkLabel]
+        # the label now refers to the next landmark having it, if any
+        for otherID, record in self.records.items():
+            if record.landmarkLabel == landmarkLabel:
+                self.labelIndex[landmarkLabel] = otherID
+                return
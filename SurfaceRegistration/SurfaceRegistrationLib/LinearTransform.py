@@ -0,0 +1,34 @@
+import numpy
+
+__all__ = ["matrixFromVTK", "transformPoints", "transformNormals"]
+
+
+def matrixFromVTK(vtkMatrix):
+    """Copy a vtkMatrix4x4 in a new 4x4 numpy matrix."""
+    return numpy.array([[vtkMatrix.GetElement(i, j) for j in range(0, 4)] for i in range(0, 4)])
+
+
+def transformPoints(points, matrix, output):
+    """Write in output the (n, 3) points transformed by the 4x4 matrix.
+
+    Each coordinate is computed in double precision and in the same order as
+    vtkLinearTransform, before being cast to the type of output, so that the
+    result is identical to the one of vtkTransformFilter.
+    """
+    x = points[:, 0].astype(numpy.float64)
+    y = points[:, 1].astype(numpy.float64)
+    z = points[:, 2].astype(numpy.float64)
+    for i in range(0, 3):
+        output[:, i] = matrix[i, 0] * x + matrix[i, 1] * y + matrix[i, 2] * z + matrix[i, 3]
+    return output
+
+
+def transformNormals(normals, matrix, output):
+    """Write in output the (n, 3) normals transformed by the inverse transpose of the matrix, normalized."""
+    normalMatrix = numpy.linalg.inv(matrix[0:3, 0:3])
+    # row vectors: n' = (M^-T n)^T = n^T M^-1
+    transformed = numpy.dot(normals.astype(numpy.float64), normalMatrix)
+    norms = numpy.linalg.norm(transformed, axis=1)
+    norms[norms == 0] = 1.0
+    output[:] = transformed / norms[:, numpy.newaxis]
+    return output
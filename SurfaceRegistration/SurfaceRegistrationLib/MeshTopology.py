@@ -0,0 +1,203 @@
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from .IterativeClosestPoint import ClosestPointFinder, polyDataPointsAsArray
+
+__all__ = ["pointAdjacency", "gatherNeighbors", "growRegion", "extractROIPolyData", "cleanPolyData"]
+
+
+def _cellArrays(polyData):
+    for cellArray in (polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()):
+        if cellArray is not None and cellArray.GetNumberOfCells() > 0:
+            offsets = numpy_support.vtk_to_numpy(cellArray.GetOffsetsArray()).astype(numpy.int64)
+            connectivity = numpy_support.vtk_to_numpy(cellArray.GetConnectivityArray()).astype(numpy.int64)
+            yield offsets, connectivity
+
+
+def pointAdjacency(polyData):
+    """Point to point adjacency of a vtkPolyData in compressed sparse row form.
+
+    Two points are neighbors when they belong to the same cell, a point used by
+    a cell being its own neighbor. Returns (indptr, indices): the neighbors of
+    point i are indices[indptr[i]:indptr[i + 1]].
+    """
+    numberOfPoints = polyData.GetNumberOfPoints()
+    if numberOfPoints == 0:
+        return numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    rows = [numpy.zeros(0, dtype=numpy.int64)]
+    columns = [numpy.zeros(0, dtype=numpy.int64)]
+    for offsets, connectivity in _cellArrays(polyData):
+        sizes = numpy.diff(offsets)
+        for size in numpy.unique(sizes):
+            if size == 0:
+                continue
+            starts = offsets[:-1][sizes == size]
+            cellPoints = connectivity[starts[:, numpy.newaxis] + numpy.arange(size)]
+            rows.append(numpy.repeat(cellPoints, size, axis=1).ravel())
+            columns.append(numpy.tile(cellPoints, (1, size)).ravel())
+    pairs = numpy.unique(numpy.concatenate(rows) * numberOfPoints + numpy.concatenate(columns))
+    rows = pairs // numberOfPoints
+    indices = pairs % numberOfPoints
+    indptr = numpy.zeros(numberOfPoints + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=numberOfPoints), out=indptr[1:])
+    return indptr, indices
+
+
+def gatherNeighbors(indptr, indices, pointIds):
+    """Concatenation of the neighbors of all the pointIds (with repetitions)."""
+    starts = indptr[pointIds]
+    counts = indptr[pointIds + 1] - starts
+    total = counts.sum()
+    if total == 0:
+        return numpy.zeros(0, dtype=indices.dtype)
+    # position of each gathered neighbor in indices
+    shifts = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+    return indices[shifts + numpy.arange(total)]
+
+
+def growRegion(indptr, indices, seedIds, seedWeights, numberOfPoints):
+    """Sorted ids of the points reached by a weighted breadth-first traversal.
+
+    Each seed point is expanded to its neighbors as many times as its weight
+    (the ROI radius). The points reached from several seeds are expanded with
+    the highest remaining weight, which gives the union of the region of each
+    seed.
+    """
+    seedIds = numpy.asarray(seedIds, dtype=numpy.int64)
+    seedWeights = numpy.asarray(seedWeights, dtype=numpy.int64)
+    visited = numpy.zeros(numberOfPoints, dtype=bool)
+    if len(seedIds) == 0 or seedWeights.max() <= 0:
+        return numpy.flatnonzero(visited)
+    frontiers = dict()
+    for weight in numpy.unique(seedWeights[seedWeights > 0]):
+        frontiers[weight] = seedIds[seedWeights == weight]
+    for weight in range(int(seedWeights.max()), 0, -1):
+        frontier = frontiers.pop(weight, None)
+        if frontier is None or len(frontier) == 0:
+            continue
+        neighbors = gatherNeighbors(indptr, indices, numpy.unique(frontier))
+        newPoints = numpy.unique(neighbors[~visited[neighbors]])
+        visited[newPoints] = True
+        # those new points are traversed next, with a lesser weight
+        if weight - 1 in frontiers:
+            frontiers[weight - 1] = numpy.concatenate((frontiers[weight - 1], newPoints))
+        else:
+            frontiers[weight - 1] = newPoints
+    return numpy.flatnonzero(visited)
+
+
+def _takeAttributes(source, destination, ids):
+    """Copy the tuples ids of the data arrays of source into destination, keeping the active attributes"""
+    for i in range(source.GetNumberOfArrays()):
+        array = source.GetArray(i)
+        if array is None:
+            continue
+        values = numpy_support.vtk_to_numpy(array)[ids]
+        arrayToAdd = numpy_support.numpy_to_vtk(values, deep=1, array_type=array.GetDataType())
+        arrayToAdd.SetName(array.GetName())
+        if array.GetLookupTable():
+            arrayToAdd.SetLookupTable(array.GetLookupTable())
+        destination.AddArray(arrayToAdd)
+        attribute = source.IsArrayAnAttribute(i)
+        if attribute >= 0:
+            destination.SetActiveAttribute(destination.GetNumberOfArrays() - 1, attribute)
+
+
+def extractROIPolyData(polyData, pointIds):
+    """Surface made of the cells of polyData containing at least one of the pointIds.
+
+    The cells are selected with a mask over the connectivity arrays and the
+    points they use are renumbered, the point and cell data follow.
+    """
+    numberOfPoints = polyData.GetNumberOfPoints()
+    isROIPoint = numpy.zeros(numberOfPoints, dtype=bool)
+    isROIPoint[numpy.asarray(pointIds, dtype=numpy.int64)] = True
+    isUsedPoint = numpy.zeros(numberOfPoints, dtype=bool)
+    cellIdStart = 0
+    keptCellIds = list()
+    keptCells = list()
+    for cellArray in (polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()):
+        if cellArray is None or cellArray.GetNumberOfCells() == 0:
+            keptCells.append(None)
+            continue
+        offsets = numpy.asarray(numpy_support.vtk_to_numpy(cellArray.GetOffsetsArray()), dtype=numpy.int64)
+        connectivity = numpy.asarray(numpy_support.vtk_to_numpy(cellArray.GetConnectivityArray()), dtype=numpy.int64)
+        sizes = numpy.diff(offsets)
+        if sizes[0] > 0 and numpy.all(sizes == sizes[0]):
+            # only cells of one size, e.g. triangles: the connectivity is a table of their points
+            cellPoints = connectivity.reshape(-1, sizes[0])
+            isKeptCell = isROIPoint[cellPoints[:, 0]]
+            for column in range(1, sizes[0]):
+                isKeptCell |= isROIPoint[cellPoints[:, column]]
+            keptConnectivity = cellPoints[isKeptCell].ravel()
+            keptOffsets = numpy.arange(0, len(keptConnectivity) + 1, sizes[0])
+        else:
+            # number of ROI points of each cell, from the cumulative count along the connectivity
+            roiCounts = numpy.concatenate(([0], numpy.cumsum(isROIPoint[connectivity])))
+            isKeptCell = roiCounts[offsets[1:]] > roiCounts[offsets[:-1]]
+            keptConnectivity = connectivity[numpy.repeat(isKeptCell, sizes)]
+            keptOffsets = numpy.concatenate(([0], numpy.cumsum(sizes[isKeptCell])))
+        isUsedPoint[keptConnectivity] = True
+        keptCells.append((keptOffsets, keptConnectivity))
+        keptCellIds.append(cellIdStart + numpy.flatnonzero(isKeptCell))
+        cellIdStart += len(sizes)
+    usedPointIds = numpy.flatnonzero(isUsedPoint)
+    pointIdMap = numpy.full(numberOfPoints, -1, dtype=numpy.int64)
+    pointIdMap[usedPointIds] = numpy.arange(len(usedPointIds))
+
+    roiPolyData = vtk.vtkPolyData()
+    roiPoints = vtk.vtkPoints()
+    if len(usedPointIds):
+        roiPoints.SetData(numpy_support.numpy_to_vtk(polyDataPointsAsArray(polyData)[usedPointIds], deep=1))
+    roiPolyData.SetPoints(roiPoints)
+    cellArrays = list()
+    for cells in keptCells:
+        cellArray = vtk.vtkCellArray()
+        if cells is not None:
+            keptOffsets, keptConnectivity = cells
+            cellArray.SetData(numpy_support.numpy_to_vtkIdTypeArray(keptOffsets, deep=1),
+                              numpy_support.numpy_to_vtkIdTypeArray(pointIdMap[keptConnectivity], deep=1))
+        cellArrays.append(cellArray)
+    roiPolyData.SetVerts(cellArrays[0])
+    roiPolyData.SetLines(cellArrays[1])
+    roiPolyData.SetPolys(cellArrays[2])
+    roiPolyData.SetStrips(cellArrays[3])
+    _takeAttributes(polyData.GetPointData(), roiPolyData.GetPointData(), usedPointIds)
+    keptCellIds = numpy.concatenate(keptCellIds) if keptCellIds else numpy.zeros(0, dtype=numpy.int64)
+    _takeAttributes(polyData.GetCellData(), roiPolyData.GetCellData(), keptCellIds)
+    return roiPolyData
+
+
+def cleanPolyData(polyData):
+    """Merge the duplicate points of polyData, remove its unused points and degenerate cells, and triangulate it.
+
+    Returns (cleanedPolyData, pointIdMap): pointIdMap[i] is the point of
+    cleanedPolyData replacing the point i of polyData. A merged or removed
+    point is replaced by the closest point kept.
+    """
+    numberOfPoints = polyData.GetNumberOfPoints()
+    # the input points are numbered in a copy, the cleaning passes this number to the points it keeps
+    numberedPolyData = vtk.vtkPolyData()
+    numberedPolyData.ShallowCopy(polyData)
+    originalIds = numpy_support.numpy_to_vtkIdTypeArray(numpy.arange(numberOfPoints, dtype=numpy.int64), deep=1)
+    originalIds.SetName("cleanPolyDataOriginalIds")
+    numberedPolyData.GetPointData().AddArray(originalIds)
+    cleaner = vtk.vtkCleanPolyData()
+    cleaner.SetInputData(numberedPolyData)
+    cleaner.Update()
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(cleaner.GetOutput())
+    triangleFilter.Update()
+    cleanedPolyData = triangleFilter.GetOutput()
+    cleanedPointData = cleanedPolyData.GetPointData()
+    keptIds = numpy_support.vtk_to_numpy(cleanedPointData.GetArray("cleanPolyDataOriginalIds")).astype(numpy.int64)
+    cleanedPointData.RemoveArray("cleanPolyDataOriginalIds")
+    pointIdMap = numpy.full(numberOfPoints, -1, dtype=numpy.int64)
+    pointIdMap[keptIds] = numpy.arange(len(keptIds))
+    replacedIds = numpy.flatnonzero(pointIdMap < 0)
+    if len(replacedIds) and len(keptIds):
+        cleanedPoints = polyDataPointsAsArray(cleanedPolyData)
+        pointIdMap[replacedIds] = ClosestPointFinder(cleanedPoints).query(
+            polyDataPointsAsArray(polyData)[replacedIds])[1]
+    return cleanedPolyData, pointIdMap
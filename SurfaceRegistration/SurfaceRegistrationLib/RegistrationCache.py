@@ -0,0 +1,99 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy
+from vtk.util import numpy_support
+
+from .ICPTrace import ICPTrace
+from .IterativeClosestPoint import polyDataPointsAsArray
+
+__all__ = ["RegistrationCache", "polyDataDigest"]
+
+
+def _updateDigest(digest, array):
+    array = numpy.ascontiguousarray(array)
+    digest.update(("%s%s" % (array.dtype.str, array.shape)).encode())
+    digest.update(array.view(numpy.uint8))
+
+
+def polyDataDigest(polyData):
+    """SHA-1 of what the registration reads in a vtkPolyData: its points, cells and point normals"""
+    digest = hashlib.sha1()
+    _updateDigest(digest, polyDataPointsAsArray(polyData))
+    for cells in (polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()):
+        if cells is None:
+            digest.update(b"-")
+        elif hasattr(cells, "GetConnectivityArray"):
+            _updateDigest(digest, numpy_support.vtk_to_numpy(cells.GetOffsetsArray()))
+            _updateDigest(digest, numpy_support.vtk_to_numpy(cells.GetConnectivityArray()))
+        else:
+            _updateDigest(digest, numpy_support.vtk_to_numpy(cells.GetData()))
+    normals = polyData.GetPointData().GetNormals()
+    if normals is not None:
+        _updateDigest(digest, numpy_support.vtk_to_numpy(normals))
+    return digest.hexdigest()
+
+
+class RegistrationCache(object):
+    """Registration results, keyed by the content of the fixed and moving polydata and the parameters.
+
+    The maxSize most recently used results are kept in memory. When a
+    directory is given, the results are also written there as JSON files, so
+    that they are shared with later sessions and with the batch workers.
+    """
+
+    def __init__(self, maxSize=64, directory=None):
+        self.maxSize = maxSize
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, fixed, moving, parameters):
+        digest = hashlib.sha1()
+        digest.update(polyDataDigest(fixed).encode())
+        digest.update(polyDataDigest(moving).encode())
+        digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """(matrix, ICPTrace) stored for this key, None if there is none"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.directory:
+            path = os.path.join(self.directory, key + ".json")
+            if not os.path.exists(path):
+                return None
+            with open(path) as entryFile:
+                entry = json.load(entryFile)
+            self._insert(key, entry)
+        else:
+            return None
+        return numpy.array(entry["matrix"]), ICPTrace.fromDict(entry["trace"])
+
+    def put(self, key, matrix, trace):
+        entry = {"matrix": numpy.asarray(matrix).tolist(), "trace": trace.toDict()}
+        self._insert(key, entry)
+        if self.directory:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, exist_ok=True)
+            # written under a temporary name first, for the processes reading the directory at the same time
+            entryFile, temporaryPath = tempfile.mkstemp(suffix=".json", dir=self.directory)
+            with os.fdopen(entryFile, "w") as entryFile:
+                json.dump(entry, entryFile)
+            os.replace(temporaryPath, os.path.join(self.directory, key + ".json"))
+
+    def clear(self):
+        """Forget the results kept in memory, the files of the directory are left"""
+        self.entries.clear()
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
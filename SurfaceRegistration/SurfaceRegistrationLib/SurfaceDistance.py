@@ -0,0 +1,56 @@
+import concurrent.futures
+
+import numpy
+
+from .IterativeClosestPoint import ClosestPointFinder
+
+__all__ = ["closestPointDistances", "surfaceDistanceMetrics"]
+
+
+def closestPointDistances(points, closestPointFinder, chunkSize=65536, maxWorkers=None):
+    """Distances and indices of the closest points of closestPointFinder, queried by chunks in threads."""
+    points = numpy.asarray(points)
+    distances = numpy.empty(len(points))
+    indices = numpy.empty(len(points), dtype=numpy.int64)
+
+    def queryChunk(start):
+        # the KD-tree queries release the GIL
+        distances[start:start + chunkSize], indices[start:start + chunkSize] = \
+            closestPointFinder.query(points[start:start + chunkSize])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        list(executor.map(queryChunk, range(0, len(points), chunkSize)))
+    return distances, indices
+
+
+def surfaceDistanceMetrics(movingPoints, fixedPoints, fixedNormals=None, fixedFinder=None, movingFinder=None,
+                           chunkSize=65536, maxWorkers=None):
+    """Distances between the vertices of two surfaces.
+
+    Return a dictionary with the mean, RMS, median and 95th percentile of
+    the distances from each moving vertex to the closest fixed vertex, and
+    the symmetric Hausdorff distance, with the array of the distances of the
+    moving vertices. These distances are signed by the fixed normals when
+    they are given: positive outside of the fixed surface.
+    """
+    movingPoints = numpy.asarray(movingPoints)
+    fixedPoints = numpy.asarray(fixedPoints)
+    if len(movingPoints) == 0 or len(fixedPoints) == 0:
+        raise ValueError("Both surfaces must have points to measure their distance")
+    if fixedFinder is None:
+        fixedFinder = ClosestPointFinder(fixedPoints)
+    if movingFinder is None:
+        movingFinder = ClosestPointFinder(movingPoints)
+    distances, indices = closestPointDistances(movingPoints, fixedFinder, chunkSize, maxWorkers)
+    reverseDistances, reverseIndices = closestPointDistances(fixedPoints, movingFinder, chunkSize, maxWorkers)
+    metrics = {"mean": float(numpy.mean(distances)),
+               "rms": float(numpy.sqrt(numpy.mean(distances * distances))),
+               "median": float(numpy.median(distances)),
+               "percentile95": float(numpy.percentile(distances, 95)),
+               "hausdorff": float(max(numpy.max(distances), numpy.max(reverseDistances)))}
+    if fixedNormals is not None:
+        offsets = movingPoints - fixedPoints[indices]
+        signs = numpy.sign(numpy.sum(offsets * numpy.asarray(fixedNormals)[indices], axis=1))
+        signs[signs == 0] = 1
+        distances = distances * signs
+    return metrics, distances
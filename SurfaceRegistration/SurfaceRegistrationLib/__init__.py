@@ -0,0 +1,7 @@
+from .ICPTrace import *
+from .IterativeClosestPoint import *
+from .LandmarkRegistry import *
+from .LinearTransform import *
+from .MeshTopology import *
+from .RegistrationCache import *
+from .SurfaceDistance import *
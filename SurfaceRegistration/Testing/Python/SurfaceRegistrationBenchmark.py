@@ -0,0 +1,245 @@
+"""Benchmark of the hot paths of SurfaceRegistrationLogic on synthetic meshes.
+
+The fixed surface is a sphere of the requested number of points. The moving
+surface is a part of it (partial overlap) with gaussian noise, moved by a
+known rigid transform. Nothing is downloaded. Run it in Slicer:
+
+    Slicer --no-main-window --python-script SurfaceRegistrationBenchmark.py \\
+        --sizes 10000 100000 1000000 --output benchmark.json
+
+The results are written as JSON, one record per function and mesh size with
+the time of each repeat, so that two runs can be compared.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy
+import slicer
+import vtk
+
+import SurfaceRegistration
+import SurfaceRegistrationLib
+
+
+def makeSphere(numberOfPoints, radius=100.0):
+    # a sphere of resolution r has r * (r - 2) + 2 points
+    resolution = max(8, int(round(numpy.sqrt(numberOfPoints))) + 1)
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(radius)
+    sphereSource.SetThetaResolution(resolution)
+    sphereSource.SetPhiResolution(resolution)
+    sphereSource.Update()
+    return sphereSource.GetOutput()
+
+
+def makeMoving(fixed, matrix, overlap, noise, seed=0):
+    """Part of fixed kept along x by the overlap fraction, with gaussian noise, moved by matrix"""
+    bounds = fixed.GetBounds()
+    plane = vtk.vtkPlane()
+    plane.SetOrigin(bounds[0] + overlap * (bounds[1] - bounds[0]), 0, 0)
+    plane.SetNormal(-1, 0, 0)
+    clipper = vtk.vtkClipPolyData()
+    clipper.SetInputData(fixed)
+    clipper.SetClipFunction(plane)
+    clipper.Update()
+    moving = vtk.vtkPolyData()
+    moving.DeepCopy(clipper.GetOutput())
+    points = SurfaceRegistrationLib.polyDataPointsAsArray(moving)
+    points += numpy.random.RandomState(seed).normal(scale=noise, size=points.shape)
+    SurfaceRegistrationLib.transformPoints(points, matrix, points)
+    moving.GetPoints().Modified()
+    return moving
+
+
+def rigidMatrix(angle, axis, translation):
+    transform = vtk.vtkTransform()
+    transform.Translate(translation)
+    transform.RotateWXYZ(angle, axis)
+    return SurfaceRegistrationLib.matrixFromVTK(transform.GetMatrix())
+
+
+def addModel(polyData, name):
+    model = slicer.modules.models.logic().AddModel(polyData)
+    model.SetName(name)
+    return model
+
+
+def timeCall(function, repeat, setup=None):
+    """Seconds taken by each of the repeat calls of function, setup being called before each of them"""
+    seconds = list()
+    for i in range(0, repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+class Benchmark(object):
+
+    def __init__(self, repeat, numberOfLandmarks, roiRadius, overlap, noise):
+        self.repeat = repeat
+        self.numberOfLandmarks = numberOfLandmarks
+        self.roiRadius = roiRadius
+        self.overlap = overlap
+        self.noise = noise
+        self.results = list()
+
+    def record(self, function, numberOfPoints, seconds, **details):
+        result = {"function": function,
+                  "numberOfPoints": numberOfPoints,
+                  "seconds": seconds,
+                  "best": min(seconds),
+                  "median": float(numpy.median(seconds))}
+        result.update(details)
+        self.results.append(result)
+        print("%-30s %9d points: best %.4f s, median %.4f s" % (function, numberOfPoints, result["best"],
+                                                               result["median"]))
+
+    def run(self, numberOfPoints):
+        slicer.mrmlScene.Clear(0)
+        slicer.modules.surfaceregistration.widgetRepresentation()
+        logic = SurfaceRegistration.SurfaceRegistrationLogic(slicer.modules.SurfaceRegistrationWidget)
+        fixed = makeSphere(numberOfPoints)
+        size = fixed.GetNumberOfPoints()
+        movingMatrix = rigidMatrix(5.0, [1, 1, 0], [3, -2, 1])
+        fixedModel = addModel(fixed, "benchmarkFixed")
+        movingModel = addModel(makeMoving(fixed, movingMatrix, self.overlap, self.noise), "benchmarkMoving")
+        parentTransform = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(parentTransform)
+        parentMatrix = vtk.vtkMatrix4x4()
+        parentMatrix.SetElement(0, 3, 1.0)
+        parentTransform.SetMatrixTransformToParent(parentMatrix)
+        movingModel.SetAndObserveTransformNodeID(parentTransform.GetID())
+
+        # harden models, as when the models are selected in the module: from scratch (cold), and again after a
+        # change of the parent transform, where the points are transformed in the buffer of the harden model
+        hardenModels = [logic.createIntermediateHardenModel(movingModel)]
+
+        def removeHardenModel():
+            hardenModel = hardenModels.pop()
+            logic.hardenModelStates.pop(hardenModel.GetID(), None)
+            slicer.mrmlScene.RemoveNode(hardenModel)
+
+        self.record("createIntermediateHardenModel cold", size,
+                    timeCall(lambda: hardenModels.append(logic.createIntermediateHardenModel(movingModel)),
+                             self.repeat, removeHardenModel))
+
+        def moveParentTransform():
+            parentMatrix.SetElement(0, 3, parentMatrix.GetElement(0, 3) + 1.0)
+            parentTransform.SetMatrixTransformToParent(parentMatrix)
+
+        self.record("createIntermediateHardenModel warm", size,
+                    timeCall(lambda: logic.createIntermediateHardenModel(movingModel), self.repeat,
+                             moveParentTransform))
+        parentMatrix.SetElement(0, 3, 1.0)
+        parentTransform.SetMatrixTransformToParent(parentMatrix)
+        for model in [fixedModel, movingModel]:
+            model.SetAttribute("hardenModelID", logic.createIntermediateHardenModel(model).GetID())
+        fixedHarden = logic.getHardenModel(fixedModel)
+        movingHarden = logic.getHardenModel(movingModel)
+
+        # landmarks close to the fixed surface
+        fidList = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(fidList)
+        fixedPoints = SurfaceRegistrationLib.polyDataPointsAsArray(fixed)
+        randomState = numpy.random.RandomState(1)
+        landmarkPointIds = randomState.choice(len(fixedPoints), self.numberOfLandmarks, replace=False)
+        for position in fixedPoints[landmarkPointIds] * 1.01:
+            fidList.AddFiducial(*position)
+        markupIDs = [fidList.GetNthMarkupID(n) for n in range(0, fidList.GetNumberOfMarkups())]
+
+        self.record("getPointLocator", size,
+                    timeCall(lambda: logic.getPointLocator(fixedHarden), self.repeat,
+                             lambda: logic.invalidateMeshCache(fixedHarden)))
+        pointLocator = logic.getPointLocator(fixedHarden)
+        self.record("getClosestPointIndex", size,
+                    timeCall(lambda: [logic.getClosestPointIndex(fidList, fixedHarden.GetPolyData(), n, pointLocator)
+                                      for n in range(0, len(markupIDs))], self.repeat),
+                    numberOfLandmarks=len(markupIDs))
+        self.record("projectOnSurface", size,
+                    timeCall(lambda: [logic.projectOnSurface(fixedHarden, fidList, markupID)
+                                      for markupID in markupIDs], self.repeat),
+                    numberOfLandmarks=len(markupIDs))
+
+        # ROI of all the landmarks, computed from scratch each time
+        logic.createNewDataStructure(fidList, fixedModel, True)
+        for markupID, landmarkRecord in logic.getLandmarkRegistry(fidList).items():
+            landmarkRecord.ROIradius = self.roiRadius
+        self.record("findROI", size,
+                    timeCall(lambda: logic.findROI(fidList), self.repeat,
+                             lambda: logic.invalidateMeshCache(fixedHarden)),
+                    numberOfLandmarks=len(markupIDs), roiRadius=self.roiRadius)
+        roiPointIds = logic.findROI(fidList)
+        self.record("addArrayFromIdList", size,
+                    timeCall(lambda: logic.addArrayFromIdList(roiPointIds, fixedModel, "benchmark_ROI"),
+                             self.repeat),
+                    numberOfROIPoints=roiPointIds.GetNumberOfIds())
+
+        cleanedModel = addModel(vtk.vtkPolyData(), "benchmarkCleaned")
+
+        def resetCleanedModel():
+            polyData = vtk.vtkPolyData()
+            polyData.DeepCopy(fixed)
+            cleanedModel.SetAndObservePolyData(polyData)
+
+        self.record("cleanerAndTriangleFilter", size,
+                    timeCall(lambda: logic.cleanerAndTriangleFilter(cleanedModel), self.repeat, resetCleanedModel))
+
+        # surface registration with the default parameters of the module
+        expectedMatrix = numpy.linalg.inv(numpy.dot(SurfaceRegistrationLib.matrixFromVTK(parentMatrix),
+                                                    movingMatrix))
+        outputTransform = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(outputTransform)
+        for icpEngine in ["VTK", "NumPy"]:
+            traces = list()
+
+            def register():
+                traces.append(logic.runICP(fixedHarden.GetPolyData(), movingHarden.GetPolyData(), outputTransform,
+                                           "Absolute Value", "RigidBody", 200, 0.001, 2000, False, False,
+                                           icpEngine, useCache=False))
+
+            seconds = timeCall(register, self.repeat)
+            outputMatrix = vtk.vtkMatrix4x4()
+            outputTransform.GetMatrixTransformToParent(outputMatrix)
+            error = numpy.dot(SurfaceRegistrationLib.matrixFromVTK(outputMatrix), numpy.linalg.inv(expectedMatrix))
+            rotationCosine = numpy.clip((numpy.trace(error[0:3, 0:3]) - 1.0) / 2.0, -1.0, 1.0)
+            self.record("runICP " + icpEngine, size, seconds,
+                        numberOfMovingPoints=movingHarden.GetPolyData().GetNumberOfPoints(),
+                        numberOfIterations=traces[-1].numberOfIterations,
+                        rotationError=float(numpy.degrees(numpy.arccos(rotationCosine))),
+                        translationError=float(numpy.linalg.norm(error[0:3, 3])))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark of SurfaceRegistrationLogic on synthetic meshes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="approximate numbers of points of the fixed mesh")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed calls of each function")
+    parser.add_argument("--landmarks", type=int, default=20, help="number of landmarks")
+    parser.add_argument("--radius", type=int, default=3, help="ROI radius of each landmark")
+    parser.add_argument("--overlap", type=float, default=0.8, help="fraction of the fixed mesh kept in the moving one")
+    parser.add_argument("--noise", type=float, default=0.1, help="standard deviation of the noise of the moving mesh")
+    parser.add_argument("--output", default="SurfaceRegistrationBenchmark.json", help="JSON file of the results")
+    args = parser.parse_args(argv)
+    benchmark = Benchmark(args.repeat, args.landmarks, args.radius, args.overlap, args.noise)
+    for numberOfPoints in args.sizes:
+        benchmark.run(numberOfPoints)
+    report = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "slicerVersion": slicer.app.applicationVersion,
+              "platform": platform.platform(),
+              "pythonVersion": platform.python_version(),
+              "parameters": vars(args),
+              "results": benchmark.results}
+    with open(args.output, "w") as reportFile:
+        json.dump(report, reportFile, indent=2)
+    print("Results written in", args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    slicer.util.exit(0)